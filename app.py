@@ -1,17 +1,36 @@
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import base64
 import time
 import hashlib
+import hmac
 from datetime import datetime
 import re
 import os
+import sys
+import bisect
+import math
+import zlib
+import tarfile
+import tempfile
+import threading
+import multiprocessing
+import atexit
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from urllib.parse import urlparse
 import firebase_admin
 from firebase_admin import credentials, auth, firestore
 import uuid # Import uuid for session ID generation
+import numpy as np
+from collections import OrderedDict
+from static_metadata import extract_static_metadata
 
 app = Flask(__name__)
 CORS(app)
@@ -21,63 +40,391 @@ cred = credentials.Certificate("codecompass-efffc-firebase-adminsdk-fbsvc-074a2c
 firebase_admin.initialize_app(cred)
 db = firestore.client()
 
+# Instrumentation. Timing spans around GitHub, LLM and Firestore calls and the processing stages feed
+# latency histograms and counters, served in Prometheus text format at /metrics. Requests that ask
+# for it get their own spans back as a per-request breakdown.
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Metrics:
+    """Thread-safe counters and latency histograms keyed by metric name and label set"""
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}  # name -> {labels: value}
+        self.histograms = {}  # name -> {labels: [per-bucket counts..., +Inf count, sum]}
+        self.lock = threading.Lock()
+    
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+    
+    def observe(self, name, seconds, **labels):
+        key = tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            values = series.setdefault(key, [0] * (len(self.buckets) + 2))
+            values[bisect.bisect_left(self.buckets, seconds)] += 1
+            values[-1] += seconds
+    
+    @staticmethod
+    def format_labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + '}'
+    
+    def render(self, gauges=None):
+        """All metrics in the Prometheus text exposition format; gauges is {name: {labels dict: value}}"""
+        lines = []
+        with self.lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+            histograms = {name: {key: list(values) for key, values in series.items()} for name, series in self.histograms.items()}
+        for name, series in sorted(counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{self.format_labels(key)} {value}" for key, value in sorted(series.items()))
+        for name, series in sorted(histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for key, values in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ['+Inf'], values[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self.format_labels(key, [('le', str(bound))])} {cumulative}")
+                lines.append(f"{name}_sum{self.format_labels(key)} {values[-1]}")
+                lines.append(f"{name}_count{self.format_labels(key)} {cumulative}")
+        for name, series in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in series:
+                key = tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+                lines.append(f"{name}{self.format_labels(key)} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+_trace = threading.local()
+
+@contextmanager
+def span(name, **labels):
+    """Time a block into codecompass_span_seconds{span=name, ...}.
+
+    Yields a dict for details (e.g. token counts) that only go into the per-request breakdown,
+    so they don't multiply the metric's label sets."""
+    details = {}
+    started = time.perf_counter()
+    try:
+        yield details
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('codecompass_span_seconds', elapsed, span=name, **labels)
+        spans = getattr(_trace, 'spans', None)
+        if spans is not None:
+            spans.append(dict(labels, span=name, ms=round(elapsed * 1000, 2), **details))
+
+def traced(name, **labels):
+    """Decorator form of span for plain (non-generator) functions"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_llm_usage(usage):
+    """Add an OpenRouter usage object to the token counters; returns the counts for the request breakdown"""
+    if not usage:
+        return {}
+    counts = {'prompt_tokens': usage.get('prompt_tokens', 0), 'completion_tokens': usage.get('completion_tokens', 0)}
+    metrics.inc('codecompass_llm_tokens_total', counts['prompt_tokens'], model=LLM_MODEL, type='prompt')
+    metrics.inc('codecompass_llm_tokens_total', counts['completion_tokens'], model=LLM_MODEL, type='completion')
+    return counts
+
+class StageTimer:
+    """Times consecutive stages of a long-running generator without wrapping each stage in a block;
+    starting a stage ends the previous one"""
+    def __init__(self, name):
+        self.name = name
+        self.current = None
+        self.durations = {}
+    
+    def start(self, stage):
+        self.stop()
+        self.current = (stage, time.perf_counter())
+    
+    def stop(self):
+        if self.current is None:
+            return
+        stage, started = self.current
+        elapsed = time.perf_counter() - started
+        metrics.observe('codecompass_span_seconds', elapsed, span=self.name, stage=stage)
+        self.durations[stage] = self.durations.get(stage, 0.0) + elapsed
+        self.current = None
+    
+    def describe(self, limit=6):
+        """The slowest stages, e.g. analyze_files 41.2s, architecture 6.0s"""
+        slowest = sorted(self.durations.items(), key=lambda entry: -entry[1])[:limit]
+        return ', '.join(f"{stage} {seconds:.1f}s" for stage, seconds in slowest)
+
+def start_trace():
+    """Collect the spans of the current thread until finish_trace"""
+    _trace.spans = []
+    _trace.started = time.perf_counter()
+
+def finish_trace():
+    """The collected spans with per-span totals, e.g. {'total_ms', 'by_span': {'llm': {'count', 'ms'}}, 'spans'}"""
+    spans = getattr(_trace, 'spans', None) or []
+    total_ms = round((time.perf_counter() - getattr(_trace, 'started', time.perf_counter())) * 1000, 2)
+    _trace.spans = None
+    by_span = {}
+    for recorded in spans:
+        totals = by_span.setdefault(recorded['span'], {'count': 0, 'ms': 0.0})
+        totals['count'] += 1
+        totals['ms'] = round(totals['ms'] + recorded['ms'], 2)
+    return {'total_ms': total_ms, 'by_span': by_span, 'spans': spans}
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    _trace.spans = None  # worker threads are reused; a breakdown never carries over between requests
+
+@app.after_request
+def record_request_metrics(response):
+    if hasattr(g, 'request_started'):
+        metrics.observe('codecompass_http_request_seconds', time.perf_counter() - g.request_started,
+                        endpoint=request.endpoint or 'unknown', method=request.method, status=response.status_code)
+    return response
+
 # User limits
 MAX_REPOS_PER_DAY =2
 MAX_MESSAGES_PER_DAY = 10
 
-def get_user_limits(uid):
-    user_ref = db.collection('users').document(uid)
-    user_doc = user_ref.get()
+# Usage is counted in one document per user and day, users/{uid}/usage/{YYYY-MM-DD}, so a new day
+# starts from zero without resetting anything
+QUOTA_LIMITS = {'repo': MAX_REPOS_PER_DAY, 'message': MAX_MESSAGES_PER_DAY}
+QUOTA_FIELDS = {'repo': 'repos_processed', 'message': 'messages_sent'}
+# Local counters are written back and refreshed from Firestore this often
+QUOTA_SYNC_SECONDS = 5
+# Counters idle for this long are dropped from memory after they are synced
+QUOTA_IDLE_SECONDS = 3600
+
+def usage_ref(uid, day):
+    return db.collection('users').document(uid).collection('usage').document(day)
+
+class QuotaManager:
+    """Daily usage quotas with a per-process cache of counters.
+
+    When a process has not loaded a user's counters yet, the check and increment run together in
+    a Firestore transaction; after that, checks and increments happen in memory and a background
+    thread writes the increments back with firestore.Increment and refreshes the counts, so usage
+    from other processes is seen within QUOTA_SYNC_SECONDS."""
+    def __init__(self, sync_seconds=QUOTA_SYNC_SECONDS):
+        self.sync_seconds = sync_seconds
+        self.counters = {}  # (uid, day) -> {'used': {kind: n}, 'pending': {kind: n}, 'touched': t}
+        self.lock = threading.Lock()
+        self.sync_thread = None
     
-    today = datetime.now().date()
+    def today(self):
+        return datetime.now().date().isoformat()
     
-    if user_doc.exists:
-        user_data = user_doc.to_dict()
-        last_reset_str = user_data.get('last_reset_date')
-        last_reset_date = datetime.fromisoformat(last_reset_str).date() if last_reset_str else None
-        
-        if last_reset_date == today:
-            return {
-                'repos_processed': user_data.get('repos_processed_today', 0),
-                'messages_sent': user_data.get('messages_sent_today', 0)
-            }
-        else:
-            # Reset limits for a new day
-            user_ref.update({
-                'repos_processed_today': 0,
-                'messages_sent_today': 0,
-                'last_reset_date': today.isoformat()
-            })
-            return {
-                'repos_processed': 0,
-                'messages_sent': 0
-            }
-    else:
-        # New user, initialize limits
-        user_ref.set({
-            'repos_processed_today': 0,
-            'messages_sent_today': 0,
-            'last_reset_date': today.isoformat()
-        })
+    def _counter(self, usage):
         return {
-            'repos_processed': 0,
-            'messages_sent': 0
+            'used': {kind: usage.get(field, 0) for kind, field in QUOTA_FIELDS.items()},
+            'pending': {kind: 0 for kind in QUOTA_FIELDS},
+            'touched': time.time(),
         }
+    
+    def try_consume(self, uid, kind):
+        """Count one use if the user is under today's limit; returns False when the limit is reached"""
+        key = (uid, self.today())
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is not None:
+                counter['touched'] = time.time()
+                if counter['used'][kind] + counter['pending'][kind] >= QUOTA_LIMITS[kind]:
+                    return False
+                counter['pending'][kind] += 1
+                self._start_sync()
+                return True
+        return self._consume_transactional(key, kind)
+    
+    def _consume_transactional(self, key, kind):
+        uid, day = key
+        ref = usage_ref(uid, day)
+        field = QUOTA_FIELDS[kind]
+        
+        @firestore.transactional
+        def check_and_increment(transaction):
+            snapshot = ref.get(transaction=transaction)
+            usage = snapshot.to_dict() if snapshot.exists else {}
+            allowed = usage.get(field, 0) < QUOTA_LIMITS[kind]
+            if allowed:
+                usage[field] = usage.get(field, 0) + 1
+                transaction.set(ref, {field: usage[field], 'date': day}, merge=True)
+            return allowed, usage
+        
+        allowed, usage = check_and_increment(db.transaction())
+        with self.lock:
+            # Another request may have loaded the counter meanwhile; its pending increments are kept
+            counter = self.counters.setdefault(key, self._counter(usage))
+            counter['used'] = {k: max(counter['used'][k], usage.get(f, 0)) for k, f in QUOTA_FIELDS.items()}
+        return allowed
+    
+    def refund(self, uid, kind):
+        """Give back a use that was counted for a request that did not complete"""
+        self.usage(uid)  # loads today's counter if this process has not seen the user yet
+        with self.lock:
+            counter = self.counters.get((uid, self.today()))
+            if counter is not None and counter['used'][kind] + counter['pending'][kind] > 0:
+                counter['pending'][kind] -= 1
+                self._start_sync()
+    
+    def usage(self, uid):
+        """Today's counts for a user, e.g. {'repos_processed': 1, 'messages_sent': 4}"""
+        key = (uid, self.today())
+        with self.lock:
+            counter = self.counters.get(key)
+        if counter is None:
+            usage_doc = usage_ref(uid, key[1]).get()
+            with self.lock:
+                counter = self.counters.setdefault(key, self._counter(usage_doc.to_dict() if usage_doc.exists else {}))
+        with self.lock:
+            return {QUOTA_FIELDS[kind]: max(counter['used'][kind] + counter['pending'][kind], 0) for kind in QUOTA_FIELDS}
+    
+    def _start_sync(self):
+        if self.sync_thread is None:
+            self.sync_thread = threading.Thread(target=self._sync_loop, name='quota-sync', daemon=True)
+            self.sync_thread.start()
+    
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.sync_seconds)
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"Error syncing usage counters: {str(e)}")
+    
+    def sync(self):
+        """Write pending increments back, then refresh the counts of recently used counters"""
+        with self.lock:
+            writes = {}
+            for key, counter in self.counters.items():
+                delta = {kind: n for kind, n in counter['pending'].items() if n}
+                if delta:
+                    writes[key] = delta
+                    for kind, n in delta.items():
+                        counter['used'][kind] += n
+                        counter['pending'][kind] = 0
+            cutoff = time.time() - QUOTA_IDLE_SECONDS
+            today = self.today()
+            for key in [key for key, counter in self.counters.items() if key[1] != today or counter['touched'] < cutoff]:
+                if key not in writes:
+                    del self.counters[key]
+            refresh = [key for key in self.counters if key[1] == today]
+        
+        # One commit per batch, so a failure only puts back the increments that were not written
+        failed = {}
+        items = list(writes.items())
+        for start in range(0, len(items), FIRESTORE_BATCH_MAX_WRITES):
+            chunk = items[start:start + FIRESTORE_BATCH_MAX_WRITES]
+            try:
+                writer = BatchWriter()
+                for (uid, day), delta in chunk:
+                    update = {QUOTA_FIELDS[kind]: firestore.Increment(n) for kind, n in delta.items()}
+                    update['date'] = day
+                    writer.set(usage_ref(uid, day), update, merge=True)
+                writer.commit()
+            except Exception as e:
+                print(f"Error writing usage counters, retrying on the next sync: {str(e)}")
+                failed.update(chunk)
+        if failed:
+            with self.lock:
+                for key, delta in failed.items():
+                    counter = self.counters.setdefault(key, self._counter({}))
+                    for kind, n in delta.items():
+                        counter['used'][kind] -= n
+                        counter['pending'][kind] += n
+        if refresh:
+            for usage_doc in db.get_all([usage_ref(uid, day) for uid, day in refresh]):
+                uid, day = usage_doc.reference.parent.parent.id, usage_doc.id
+                usage = usage_doc.to_dict() if usage_doc.exists else {}
+                with self.lock:
+                    counter = self.counters.get((uid, day))
+                    if counter is not None:
+                        counter['used'] = {kind: usage.get(field, 0) for kind, field in QUOTA_FIELDS.items()}
 
-def increment_user_limit(uid, limit_type):
-    user_ref = db.collection('users').document(uid)
-    today = datetime.now().date().isoformat()
+quota = QuotaManager()
+atexit.register(quota.sync)
+
+def get_user_limits(uid):
+    return quota.usage(uid)
+
+# Verified ID tokens kept in memory until they expire
+ID_TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("ID_TOKEN_CACHE_MAX_ENTRIES", "10000"))
+# Endpoints that are reachable without a Firebase ID token; /metrics checks METRICS_TOKEN itself
+PUBLIC_ENDPOINTS = {'verify_google_token', 'health_check', 'metrics_endpoint'}
+# Shared secret Prometheus sends as "Authorization: Bearer <token>"; when unset, /metrics is disabled
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+class IdTokenVerifier:
+    """Verifies Firebase ID tokens once and keeps the decoded claims until the token's exp.
+
+    auth.verify_id_token already caches Google's signing certificates for as long as their
+    Cache-Control headers allow, so a first verification is a local signature check; repeat
+    requests with the same token are a dictionary lookup."""
+    def __init__(self, max_entries=ID_TOKEN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.claims_by_token = OrderedDict()  # sha256(token) -> decoded claims
+        self.known_users = set()  # uids whose users/{uid} profile is known to exist
+        self.lock = threading.Lock()
     
-    if limit_type == 'repo':
-        user_ref.update({
-            'repos_processed_today': firestore.Increment(1),
-            'last_reset_date': today
-        })
-    elif limit_type == 'message':
-        user_ref.update({
-            'messages_sent_today': firestore.Increment(1),
-            'last_reset_date': today
-        })
+    def verify(self, id_token):
+        """Decoded claims of a valid token; raises auth errors for invalid or expired tokens"""
+        key = hashlib.sha256(id_token.encode()).hexdigest()
+        with self.lock:
+            claims = self.claims_by_token.get(key)
+            if claims is not None:
+                if claims['exp'] > time.time():
+                    self.claims_by_token.move_to_end(key)
+                    return claims
+                del self.claims_by_token[key]
+        claims = auth.verify_id_token(id_token)
+        with self.lock:
+            self.claims_by_token[key] = claims
+            while len(self.claims_by_token) > self.max_entries:
+                self.claims_by_token.popitem(last=False)
+        return claims
+    
+    def ensure_profile(self, claims):
+        """Create the users/{uid} profile on first sign-in; only checked once per process"""
+        uid = claims['uid']
+        if uid in self.known_users:
+            return
+        user_ref = db.collection('users').document(uid)
+        if not user_ref.get().exists:
+            user_ref.set({
+                'email': claims['email'],
+                'name': claims.get('name', claims['email']),
+                'created_at': datetime.now().isoformat()
+            })
+        with self.lock:
+            self.known_users.add(uid)
+
+id_token_verifier = IdTokenVerifier()
+
+@app.before_request
+def authenticate_request():
+    """Verify the Bearer ID token in the Authorization header and expose its uid as g.uid"""
+    # Unknown routes fall through to the normal 404
+    if request.method == 'OPTIONS' or request.endpoint is None or request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+    scheme, _, id_token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not id_token:
+        return jsonify({"error": "User not authenticated. Please log in."}), 401
+    try:
+        g.uid = id_token_verifier.verify(id_token.strip())['uid']
+    except Exception as e:
+        return jsonify({"error": f"Invalid or expired ID token: {str(e)}"}), 401
+    return None
 
 @app.route('/verify-google-token', methods=['POST'])
 def verify_google_token():
@@ -87,23 +434,13 @@ def verify_google_token():
             return jsonify({"error": "ID token is required"}), 400
 
         # Verify the ID token
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = id_token_verifier.verify(id_token)
         uid = decoded_token['uid']
         email = decoded_token['email']
         name = decoded_token.get('name', email)
 
-        # Ensure user profile exists in Firestore and initialize limits if new
-        user_ref = db.collection('users').document(uid)
-        user_doc = user_ref.get()
-        if not user_doc.exists:
-            user_ref.set({
-                'email': email,
-                'name': name,
-                'created_at': datetime.now().isoformat(),
-                'repos_processed_today': 0,
-                'messages_sent_today': 0,
-                'last_reset_date': datetime.now().date().isoformat()
-            })
+        # Ensure user profile exists in Firestore
+        id_token_verifier.ensure_profile(decoded_token)
         
         # Get current limits for the user
         limits = get_user_limits(uid)
@@ -127,8 +464,1581 @@ def verify_google_token():
 
 
 # Configuration
-OPENROUTER_API_KEY = "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"
-GITHUB_API_BASE = "https://api.github.com"
+OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY", "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")
+# Both endpoints can be pointed elsewhere, e.g. at the local stand-ins in bench/
+OPENROUTER_API_URL = os.environ.get("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+GITHUB_API_BASE = os.environ.get("GITHUB_API_BASE", "https://api.github.com")
+LLM_MODEL = "deepseek/deepseek-v3-base:free"
+# Bump whenever the file analysis prompts change so cached analyses are regenerated
+ANALYSIS_PROMPT_VERSION = 2
+# Fetch the whole tree with one Git Trees API call instead of walking the Contents API per directory
+USE_GIT_TREES_API = True
+# Download file contents as a single tarball instead of one Contents API call per file
+USE_ARCHIVE_DOWNLOAD = True
+# Below this many files (e.g. a small refresh) individual fetches are cheaper than the whole archive
+ARCHIVE_DOWNLOAD_MIN_FILES = 10
+# On refresh, re-run the architecture analysis when more than this fraction of files were added or deleted
+STRUCTURE_REFRESH_THRESHOLD = 0.05
+# Number of files fetched and analyzed in parallel by /process-repo
+FILE_PROCESSING_CONCURRENCY = int(os.environ.get("FILE_PROCESSING_CONCURRENCY", 8))
+# "combined" asks for a file's metadata and summary in one LLM call; "separate" makes the older two calls
+FILE_ANALYSIS_MODE = os.environ.get("FILE_ANALYSIS_MODE", "combined")
+# Files up to this size are analyzed several to a request when their contents are already downloaded
+BATCH_FILE_MAX_TOKENS = 1500
+BATCH_MAX_FILES = 8
+BATCH_PROMPT_TOKEN_BUDGET = 8000
+# Output room per file in a batched request, on top of the usual response budget
+BATCH_OUTPUT_TOKENS_PER_FILE = 400
+
+class RateLimiter:
+    """Shared gate that pauses every worker thread when an API reports rate limiting"""
+    def __init__(self, name, default_backoff=5):
+        self.name = name
+        self.default_backoff = default_backoff
+        self.lock = threading.Lock()
+        self.blocked_until = 0.0
+    
+    def wait(self):
+        """Block until the API may be called again"""
+        while True:
+            with self.lock:
+                delay = self.blocked_until - time.time()
+            if delay <= 0:
+                return
+            time.sleep(min(delay, 5))
+    
+    def block_for(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+        print(f"{self.name} rate limited, pausing requests for {seconds:.1f}s")
+    
+    def seconds_until_reset(self, headers):
+        reset = headers.get('X-RateLimit-Reset')
+        if not reset:
+            return None
+        reset = float(reset)
+        # GitHub sends epoch seconds, OpenRouter epoch milliseconds
+        if reset > 1e12:
+            reset /= 1000
+        return max(reset - time.time(), 0)
+    
+    def update(self, response):
+        """Record rate-limit signals from a response; returns True if the request was throttled"""
+        headers = response.headers
+        exhausted = headers.get('X-RateLimit-Remaining') == '0'
+        throttled = response.status_code == 429 or (response.status_code == 403 and exhausted)
+        if throttled:
+            retry_after = headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                delay = float(retry_after)
+            else:
+                delay = self.seconds_until_reset(headers) or self.default_backoff
+            self.block_for(delay)
+        elif exhausted:
+            delay = self.seconds_until_reset(headers)
+            if delay:
+                self.block_for(delay)
+        return throttled
+
+github_rate_limiter = RateLimiter("GitHub API")
+llm_rate_limiter = RateLimiter("OpenRouter API")
+
+# Shared HTTP transport for GitHub and OpenRouter
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 30
+# Completions can take minutes to generate; streamed ones only wait this long between deltas
+LLM_READ_TIMEOUT = int(os.environ.get("LLM_READ_TIMEOUT", 180))
+HTTP_CACHE_DIR = os.environ.get("HTTP_CACHE_DIR", "http_cache")
+# Entries unused for longer than the age limit are dropped, then the least recently used ones until
+# the cache fits the size limit; the directory is swept every HTTP_CACHE_PRUNE_INTERVAL stores
+HTTP_CACHE_MAX_BYTES = int(os.environ.get("HTTP_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+HTTP_CACHE_MAX_AGE_SECONDS = int(os.environ.get("HTTP_CACHE_MAX_AGE_SECONDS", 7 * 24 * 3600))
+HTTP_CACHE_PRUNE_INTERVAL = 500
+
+class HttpTransport:
+    """One keep-alive connection pool shared by all requests to an API.
+
+    All threads use the same session: requests are sent with per-call headers and the
+    session's state is never changed after setup, and urllib3's pool hands each thread
+    its own connection. The session is closed at exit. Connection failures and 5xx
+    responses to GET requests are retried by urllib3; 429/403 rate limiting is left to
+    the RateLimiter gates so every thread pauses together."""
+    def __init__(self, name, read_timeout=HTTP_READ_TIMEOUT, pool_size=FILE_PROCESSING_CONCURRENCY):
+        self.name = name
+        self.timeout = (HTTP_CONNECT_TIMEOUT, read_timeout)
+        retry = Retry(total=3, connect=3, read=2, status=2, backoff_factor=0.5,
+                      status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(['GET', 'HEAD']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        atexit.register(self.close)
+    
+    def close(self):
+        self.session.close()
+    
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+    
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+class HttpCache:
+    """On-disk cache of GitHub API responses, revalidated with If-None-Match/If-Modified-Since.
+
+    GitHub does not count 304 Not Modified responses against the rate limit, so re-processing
+    a repository costs almost nothing for directories and files that have not changed.
+    Requests made with a PAT bypass the cache, so private content is never written to disk."""
+    def __init__(self, directory, max_bytes=HTTP_CACHE_MAX_BYTES, max_age=HTTP_CACHE_MAX_AGE_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.prune_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        # Sweep on the first store, which also cleans up after earlier processes
+        self.stores_since_prune = HTTP_CACHE_PRUNE_INTERVAL
+    
+    def cache_key(self, url, params, headers):
+        key_source = json.dumps([url, sorted((params or {}).items()), headers.get('Accept')])
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+    
+    def paths(self, key):
+        base = os.path.join(self.directory, key[:2], key)
+        return base + '.json', base + '.body'
+    
+    def load(self, key):
+        meta_path, body_path = self.paths(key)
+        try:
+            if time.time() - os.path.getmtime(meta_path) > self.max_age:
+                return None, None
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            with open(body_path, 'rb') as body_file:
+                return meta, body_file.read()
+        except (OSError, ValueError):
+            return None, None
+    
+    def touch(self, key):
+        """Mark an entry as used; its metadata file's mtime is its last use"""
+        try:
+            os.utime(self.paths(key)[0])
+        except OSError:
+            pass
+    
+    def store(self, key, response):
+        meta_path, body_path = self.paths(key)
+        meta = {
+            'url': response.url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'headers': {name: response.headers[name] for name in ('Content-Type', 'ETag', 'Last-Modified', 'Link') if name in response.headers},
+        }
+        try:
+            os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+            # Body first, then metadata, each replaced atomically so readers never see a torn entry
+            for path, data, mode in ((body_path, response.content, 'wb'), (meta_path, json.dumps(meta), 'w')):
+                with open(path + '.tmp', mode) as cache_file:
+                    cache_file.write(data)
+                os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"Could not write HTTP cache entry: {str(e)}")
+        
+        with self.lock:
+            self.stores_since_prune += 1
+            due = self.stores_since_prune >= HTTP_CACHE_PRUNE_INTERVAL
+            if due:
+                self.stores_since_prune = 0
+        if due:
+            self.prune()
+    
+    def prune(self):
+        """Drop entries unused for longer than max_age, then the least recently used beyond max_bytes"""
+        if not self.prune_lock.acquire(blocking=False):
+            return  # another thread is already sweeping
+        try:
+            entries = []
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    if not name.endswith('.json'):
+                        continue
+                    meta_path = os.path.join(root, name)
+                    body_path = meta_path[:-len('.json')] + '.body'
+                    try:
+                        size = os.path.getsize(meta_path) + (os.path.getsize(body_path) if os.path.exists(body_path) else 0)
+                        entries.append((os.path.getmtime(meta_path), size, meta_path, body_path))
+                    except OSError:
+                        continue
+            entries.sort()
+            total = sum(entry[1] for entry in entries)
+            cutoff = time.time() - self.max_age
+            removed = 0
+            for used_at, size, meta_path, body_path in entries:
+                if used_at >= cutoff and total <= self.max_bytes:
+                    break
+                for path in (meta_path, body_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+                removed += 1
+            if removed:
+                print(f"HTTP cache: evicted {removed} entries, {total} bytes remain")
+        finally:
+            self.prune_lock.release()
+    
+    def get(self, transport, url, headers, params=None):
+        """GET through the cache; a 304 is answered with the cached body as a 200 response"""
+        if headers.get('Authorization'):
+            with self.lock:
+                self.bypassed += 1
+            return transport.get(url, headers=headers, params=params)
+        key = self.cache_key(url, params, headers)
+        meta, body = self.load(key)
+        request_headers = dict(headers)
+        if meta:
+            if meta.get('etag'):
+                request_headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                request_headers['If-Modified-Since'] = meta['last_modified']
+        
+        response = transport.get(url, headers=request_headers, params=params)
+        if response.status_code == 304 and meta:
+            with self.lock:
+                self.hits += 1
+            self.touch(key)
+            cached = requests.Response()
+            cached.status_code = 200
+            cached._content = body
+            cached.url = meta['url']
+            cached.headers.update(meta['headers'])
+            # Rate-limit headers come from the live 304 response
+            cached.headers.update({name: value for name, value in response.headers.items() if name.startswith('X-RateLimit')})
+            cached.encoding = 'utf-8'
+            cached.from_cache = True
+            return cached
+        
+        with self.lock:
+            self.misses += 1
+        if response.status_code == 200 and (response.headers.get('ETag') or response.headers.get('Last-Modified')):
+            self.store(key, response)
+        return response
+    
+    def stats(self):
+        with self.lock:
+            return {'directory': self.directory, 'hits': self.hits, 'misses': self.misses, 'bypassed': self.bypassed}
+
+github_transport = HttpTransport("GitHub API")
+llm_transport = HttpTransport("OpenRouter API", read_timeout=LLM_READ_TIMEOUT)
+github_http_cache = HttpCache(HTTP_CACHE_DIR)
+
+# Static metadata extraction. Functions, classes, imports and dependencies are facts the
+# code states directly, so they are read locally instead of asking the LLM for them. The
+# extractors live in static_metadata.py, which pool workers can import without starting the app.
+
+# Files at or above this count have their metadata extracted in a process pool
+STATIC_ANALYSIS_POOL_THRESHOLD = 200
+
+# One process pool shared by all jobs, started on first use. Workers are spawned rather than forked
+# because the server process runs many threads (jobs, quota sync, HTTP handlers) whose locks a fork would copy.
+# A spawned worker imports only static_metadata (plus the entry script, so a server started with
+# "python app.py" pays for one app import per worker, once for the life of the pool).
+_static_analysis_pool = None
+_static_analysis_pool_lock = threading.Lock()
+
+def static_analysis_pool():
+    global _static_analysis_pool
+    with _static_analysis_pool_lock:
+        if _static_analysis_pool is None:
+            _static_analysis_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+        return _static_analysis_pool
+
+def reset_static_analysis_pool():
+    """Shut the pool down; the next bulk extraction starts a fresh one"""
+    global _static_analysis_pool
+    with _static_analysis_pool_lock:
+        pool, _static_analysis_pool = _static_analysis_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+atexit.register(reset_static_analysis_pool)
+
+def extract_static_metadata_bulk(file_contents):
+    """Extract static metadata for many files at once, spreading the CPU work over a process pool"""
+    file_paths = [path for path, content in file_contents.items() if content]
+    try:
+        results = static_analysis_pool().map(extract_static_metadata, [file_contents[path] for path in file_paths], file_paths, chunksize=16)
+        return dict(zip(file_paths, results))
+    except Exception as e:
+        # Not expected: the caller's worker threads extract the metadata instead, which is slower
+        print(f"Error in the static metadata process pool, extracting in worker threads instead: {e!r}")
+        metrics.inc('codecompass_static_pool_failures_total')
+        if isinstance(e, BrokenProcessPool):
+            reset_static_analysis_pool()
+        return {}
+
+def git_blob_sha(file_content):
+    """Compute the git blob SHA of a file, the same id GitHub reports in tree listings"""
+    data = file_content.encode('utf-8') if isinstance(file_content, str) else file_content
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+class AnalysisCache:
+    """Content-addressed cache of per-file metadata and summaries, shared across users and repos.
+
+    Entries are keyed by the file's git blob SHA plus the prompt version and model, so identical
+    files are only analyzed once and bumping ANALYSIS_PROMPT_VERSION invalidates every entry.
+    Summaries mention the file path, so the key also covers the path and a visibility scope:
+    analyses of private files are only reused by the same user's runs of the same repository."""
+    def __init__(self, collection_name='analysis_cache', max_local_entries=10000):
+        self.collection_name = collection_name
+        self.max_local_entries = max_local_entries
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def make_key(self, blob_sha, file_path, scope):
+        version = hashlib.md5(f"{ANALYSIS_PROMPT_VERSION}:{LLM_MODEL}:{scope}:{file_path.strip('/')}".encode()).hexdigest()[:12]
+        return f"{blob_sha}-{version}"
+    
+    def _remember(self, key, entry):
+        with self.lock:
+            self.local[key] = entry
+            self.local.move_to_end(key)
+            while len(self.local) > self.max_local_entries:
+                self.local.popitem(last=False)
+    
+    def _count(self, hit, run_stats):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if run_stats is not None:
+                run_stats['hits' if hit else 'misses'] += 1
+    
+    def get(self, blob_sha, file_path, scope, run_stats=None):
+        """Return the cached {'metadata', 'summary'} for a blob at file_path, or None"""
+        key = self.make_key(blob_sha, file_path, scope)
+        with self.lock:
+            entry = self.local.get(key)
+        if entry is None:
+            try:
+                with span('firestore', op='analysis_cache_get'):
+                    doc = db.collection(self.collection_name).document(key).get()
+                if doc.exists:
+                    entry = doc.to_dict()
+                    self._remember(key, entry)
+            except Exception as e:
+                print(f"Error reading analysis cache: {str(e)}")
+        self._count(entry is not None, run_stats)
+        return entry
+    
+    def put(self, blob_sha, file_path, scope, metadata, summary):
+        key = self.make_key(blob_sha, file_path, scope)
+        entry = {
+            'blob_sha': blob_sha,
+            'metadata': metadata,
+            'summary': summary,
+            'scope': scope,
+            'prompt_version': ANALYSIS_PROMPT_VERSION,
+            'model': LLM_MODEL,
+            'created_at': datetime.now().isoformat()
+        }
+        self._remember(key, entry)
+        try:
+            with span('firestore', op='analysis_cache_put'):
+                db.collection(self.collection_name).document(key).set(entry)
+        except Exception as e:
+            print(f"Error writing analysis cache: {str(e)}")
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'local_entries': len(self.local),
+                'prompt_version': ANALYSIS_PROMPT_VERSION
+            }
+
+analysis_cache = AnalysisCache()
+
+def analysis_scope(owner, repo, uid, is_private):
+    """Visibility scope for cached analyses: public files are shared, private ones only within one user's repository"""
+    return f"private:{uid}:{owner.lower()}/{repo.lower()}" if is_private else 'public'
+
+# Repository storage layout: a small header document in 'repositories', one document per file in its
+# 'files' subcollection (content split into 'chunks' when large) and the structure JSON in 'blobs'.
+# Keeps every document far below Firestore's 1 MiB limit and lets readers fetch only what they need.
+# A snapshot of a new commit stores only the files that changed; its 'file_sources' blob maps every
+# unchanged file to the earlier snapshot whose document it shares, so a refresh writes O(changed) files.
+REPOSITORY_STORAGE_VERSION = 2
+FIRESTORE_BATCH_MAX_WRITES = 400
+FIRESTORE_BATCH_MAX_BYTES = 8 * 1024 * 1024
+# Characters per content/blob chunk; even all-4-byte UTF-8 stays under the 1 MiB document limit
+STORAGE_CHUNK_CHARS = 200000
+FILE_LISTING_FIELDS = ['path', 'metadata', 'summary', 'size', 'blob_sha', 'processed_at', 'content_preview', 'content_chunks']
+
+class BatchWriter:
+    """Groups Firestore writes into batches that stay under the per-commit write count and size limits"""
+    def __init__(self):
+        self.batch = None
+        self.writes = 0
+        self.bytes = 0
+    
+    def _reserve(self, size):
+        if self.batch is not None and (self.writes >= FIRESTORE_BATCH_MAX_WRITES or self.bytes + size > FIRESTORE_BATCH_MAX_BYTES):
+            self.commit()
+        if self.batch is None:
+            self.batch = db.batch()
+        self.writes += 1
+        self.bytes += size
+    
+    def set(self, ref, data, merge=False):
+        self._reserve(len(json.dumps(data, default=str)))
+        self.batch.set(ref, data, merge=merge)
+    
+    def update(self, ref, data):
+        self._reserve(len(json.dumps(data, default=str)))
+        self.batch.update(ref, data)
+    
+    def delete(self, ref):
+        self._reserve(0)
+        self.batch.delete(ref)
+    
+    @traced('firestore', op='batch_commit')
+    def commit(self):
+        if self.batch is not None and self.writes:
+            self.batch.commit()
+            metrics.inc('codecompass_firestore_writes_total', self.writes)
+        self.batch = None
+        self.writes = 0
+        self.bytes = 0
+
+def split_chunks(text):
+    return [text[i:i + STORAGE_CHUNK_CHARS] for i in range(0, len(text), STORAGE_CHUNK_CHARS)] or ['']
+
+def file_doc_id(file_path):
+    """Firestore document ID for a file path (paths contain '/', which IDs cannot)"""
+    return hashlib.sha1(file_path.encode()).hexdigest()
+
+def repository_ref(repo_id):
+    return db.collection('repositories').document(repo_id)
+
+def write_blob(writer, repo_ref, name, data):
+    """Write a JSON value as chunked documents in the 'blobs' subcollection; returns the part count"""
+    parts = split_chunks(json.dumps(data))
+    for index, part in enumerate(parts):
+        writer.set(repo_ref.collection('blobs').document(f"{name}-{index}"), {'data': part})
+    return len(parts)
+
+@traced('firestore', op='load_blob')
+def load_blob(repo_id, header, name):
+    """Load a JSON value written by write_blob, or None if the repository has no such blob"""
+    part_count = header.get('blob_parts', {}).get(name)
+    if not part_count:
+        return None
+    blobs_ref = repository_ref(repo_id).collection('blobs')
+    parts = db.get_all([blobs_ref.document(f"{name}-{index}") for index in range(part_count)])
+    parts = sorted(parts, key=lambda part: int(part.id.rsplit('-', 1)[1]))
+    return json.loads(''.join(part.to_dict()['data'] for part in parts))
+
+def write_file_records(writer, files_ref, file_records):
+    """Write file documents, splitting large contents into the 'chunks' subcollection"""
+    for file_path, record in file_records.items():
+        content = record.get('content', '')
+        file_doc = {key: value for key, value in record.items() if key != 'content'}
+        file_doc['path'] = file_path
+        file_doc['content_preview'] = content[:300]
+        chunks = split_chunks(content)
+        file_ref = files_ref.document(file_doc_id(file_path))
+        if len(chunks) == 1:
+            file_doc['content'] = content
+            file_doc['content_chunks'] = 0
+        else:
+            file_doc['content_chunks'] = len(chunks)
+            for index, chunk in enumerate(chunks):
+                writer.set(file_ref.collection('chunks').document(str(index)), {'content': chunk})
+        writer.set(file_ref, file_doc)
+
+@traced('firestore', op='save_repository')
+def save_repository(repo_id, repo_data, file_records, deleted_records=None, blobs=None):
+    """Write changed file documents, delete removed ones, then the blobs (structure, indexes) and header.
+
+    The header is written last so a reader never sees a header whose files are missing."""
+    writer = BatchWriter()
+    repo_ref = repository_ref(repo_id)
+    files_ref = repo_ref.collection('files')
+    write_file_records(writer, files_ref, file_records)
+    
+    for file_path, record in (deleted_records or {}).items():
+        file_ref = files_ref.document(file_doc_id(file_path))
+        for index in range(record.get('content_chunks') or 0):
+            writer.delete(file_ref.collection('chunks').document(str(index)))
+        writer.delete(file_ref)
+    
+    header = {key: value for key, value in repo_data.items() if key not in ('files', 'structure')}
+    header['storage_version'] = REPOSITORY_STORAGE_VERSION
+    header['blob_parts'] = {'structure': write_blob(writer, repo_ref, 'structure', repo_data.get('structure', []))}
+    for name, data in (blobs or {}).items():
+        header['blob_parts'][name] = write_blob(writer, repo_ref, name, data)
+    writer.set(repo_ref, header)
+    writer.commit()
+    repo_cache.invalidate(repo_id)
+    answer_cache.invalidate(repo_id)
+
+# Checkpointing: analyzed files are written as they complete, so an interrupted run resumes where it stopped
+CHECKPOINT_FLUSH_FILES = 20
+CHECKPOINT_FLUSH_SECONDS = 5
+# Extra passes over files that failed, after the main pass
+PROCESSING_RETRY_ROUNDS = 2
+
+def manifest_ref(repo_id):
+    return repository_ref(repo_id).collection('processing').document('manifest')
+
+@traced('firestore', op='load_manifest')
+def load_manifest(repo_id):
+    manifest_doc = manifest_ref(repo_id).get()
+    return manifest_doc.to_dict() if manifest_doc.exists else None
+
+class ProcessingCheckpoint:
+    """Persists file records as they are analyzed, together with a manifest of the commit being
+    processed and its pending, done and failed paths. Writes are buffered and flushed every
+    CHECKPOINT_FLUSH_FILES files or CHECKPOINT_FLUSH_SECONDS seconds."""
+    def __init__(self, repo_id, commit_sha, pending, resumed_manifest=None):
+        self.ref = manifest_ref(repo_id)
+        self.files_ref = repository_ref(repo_id).collection('files')
+        self.records = {}
+        self.failed = []
+        self.recovered = []
+        self.last_flush = time.time()
+        manifest = {
+            'commit_sha': commit_sha,
+            'status': 'in_progress',
+            'pending': sorted(pending),
+            'updated_at': datetime.now().isoformat(),
+        }
+        if resumed_manifest is None:
+            manifest.update({'done': [], 'failed': [], 'started_at': manifest['updated_at']})
+        self.ref.set(manifest, merge=True)
+    
+    def file_done(self, file_path, record):
+        self.records[file_path] = record
+        self.maybe_flush()
+    
+    def file_failed(self, file_path):
+        self.failed.append(file_path)
+        self.maybe_flush()
+    
+    def file_recovered(self, file_path, record):
+        """A file that failed earlier and succeeded on a retry pass (record is None for skipped files)"""
+        self.recovered.append(file_path)
+        if record:
+            self.records[file_path] = record
+        self.maybe_flush()
+    
+    def maybe_flush(self):
+        if len(self.records) + len(self.failed) >= CHECKPOINT_FLUSH_FILES or time.time() - self.last_flush >= CHECKPOINT_FLUSH_SECONDS:
+            self.flush()
+    
+    def flush(self):
+        if not self.records and not self.failed and not self.recovered:
+            return
+        writer = BatchWriter()
+        write_file_records(writer, self.files_ref, self.records)
+        update = {'updated_at': datetime.now().isoformat()}
+        if self.records:
+            update['done'] = firestore.ArrayUnion(list(self.records))
+        if self.failed:
+            update['failed'] = firestore.ArrayUnion(self.failed)
+        writer.update(self.ref, update)
+        if self.recovered:
+            writer.update(self.ref, {'failed': firestore.ArrayRemove(self.recovered)})
+        writer.commit()
+        self.records, self.failed, self.recovered = {}, [], []
+        self.last_flush = time.time()
+    
+    def complete(self, failed_paths):
+        self.flush()
+        self.ref.update({'status': 'complete', 'pending': [], 'failed': sorted(failed_paths), 'updated_at': datetime.now().isoformat()})
+
+@traced('firestore', op='load_repository_header')
+def load_repository_header(repo_id):
+    """Load the repository header document (no files or structure), or None if it doesn't exist"""
+    repo_doc = repository_ref(repo_id).get()
+    return repo_doc.to_dict() if repo_doc.exists else None
+
+def group_file_sources(file_sources):
+    """{path: snapshot_id} as the stored {snapshot_id: [paths]} form"""
+    grouped = {}
+    for file_path, source_id in sorted(file_sources.items()):
+        grouped.setdefault(source_id, []).append(file_path)
+    return grouped
+
+def load_file_sources(repo_id, header):
+    """Files a snapshot shares with earlier snapshots, as {path: id of the snapshot storing the document}"""
+    grouped = load_blob(repo_id, header, 'file_sources') or {}
+    return {file_path: source_id for source_id, file_paths in grouped.items() for file_path in file_paths}
+
+@traced('firestore', op='load_file_records')
+def load_file_records(repo_id, header):
+    """Load every file's metadata, summary and content preview, without file contents"""
+    if 'files' in header:
+        # Repositories saved before the sharded layout keep everything in the header
+        return header['files']
+    query = repository_ref(repo_id).collection('files').select(FILE_LISTING_FIELDS)
+    records = {record['path']: record for record in (doc.to_dict() for doc in query.stream())}
+    for source_id, file_paths in (load_blob(repo_id, header, 'file_sources') or {}).items():
+        files_ref = repository_ref(source_id).collection('files')
+        refs = [files_ref.document(file_doc_id(path)) for path in file_paths if path not in records]
+        for doc in db.get_all(refs, field_paths=FILE_LISTING_FIELDS):
+            if doc.exists:
+                record = doc.to_dict()
+                records[record['path']] = record
+    return records
+
+def strip_listing_fields(record):
+    """A file record as returned by process_file, from a listing record"""
+    return {key: value for key, value in record.items() if key not in ('path', 'content_preview', 'content_chunks')}
+
+@traced('firestore', op='load_file_contents')
+def load_file_contents(repo_id, file_paths, header=None):
+    """Load full contents for just the given files, following shared files to the snapshot storing them"""
+    contents = read_file_contents(repo_id, file_paths)
+    missing = [path for path in file_paths if path not in contents]
+    if missing:
+        header = header if header is not None else load_repository_header(repo_id) or {}
+        file_sources = load_file_sources(repo_id, header)
+        for source_id, source_paths in group_file_sources({path: file_sources[path] for path in missing if path in file_sources}).items():
+            contents.update(read_file_contents(source_id, source_paths))
+    return contents
+
+def read_file_contents(repo_id, file_paths):
+    """Contents of the given files from the snapshot's own file documents"""
+    files_ref = repository_ref(repo_id).collection('files')
+    contents = {}
+    for doc in db.get_all([files_ref.document(file_doc_id(path)) for path in file_paths]):
+        if not doc.exists:
+            continue
+        file_doc = doc.to_dict()
+        if file_doc.get('content_chunks'):
+            chunk_refs = [doc.reference.collection('chunks').document(str(index)) for index in range(file_doc['content_chunks'])]
+            chunks = sorted(db.get_all(chunk_refs), key=lambda chunk: int(chunk.id))
+            file_doc['content'] = ''.join(chunk.to_dict()['content'] for chunk in chunks)
+        contents[file_doc['path']] = file_doc.get('content', '')
+    return contents
+
+class RepositoryCache:
+    """Bounded in-process LRU cache of repository headers, file listings and file contents.
+
+    Sized in bytes with a TTL, and invalidated when a repository is saved, so follow-up questions
+    in a chat session are answered without any Firestore reads."""
+    def __init__(self, max_bytes=256 * 1024 * 1024, ttl_seconds=600):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # key -> (value, size, expires_at)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+    
+    def _get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < time.time():
+                self._evict(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+    
+    def _put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self._evict(key)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size, time.time() + self.ttl_seconds)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self._evict(next(iter(self.entries)))
+    
+    def _evict(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+    
+    def invalidate(self, repo_id):
+        """Drop everything cached for a repository, e.g. after it was reprocessed"""
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == repo_id]:
+                self._evict(key)
+    
+    def snapshot_id(self, uid, repo_id):
+        snapshot_id = self._get(('access', repo_id, uid))
+        if snapshot_id is None:
+            snapshot_id = resolve_snapshot(uid, repo_id)
+            if snapshot_id is None:
+                return None
+            self._put(('access', repo_id, uid), snapshot_id, len(snapshot_id))
+        return snapshot_id
+    
+    def header(self, repo_id):
+        header = self._get(('header', repo_id))
+        if header is None:
+            header = load_repository_header(repo_id)
+            if header is None:
+                return None
+            self._put(('header', repo_id), header, len(json.dumps(header, default=str)))
+        # Callers attach 'files' to the header, so hand out a copy
+        return dict(header)
+    
+    def file_records(self, repo_id, header):
+        records = self._get(('files', repo_id))
+        if records is None:
+            records = load_file_records(repo_id, header)
+            self._put(('files', repo_id), records, len(json.dumps(records, default=str)))
+        return records
+    
+    def file_contents(self, repo_id, file_paths, header=None):
+        """Full file bodies, loaded lazily and only for the requested files"""
+        contents = {}
+        missing = []
+        for file_path in file_paths:
+            content = self._get(('content', repo_id, file_path))
+            if content is None:
+                missing.append(file_path)
+            else:
+                contents[file_path] = content
+        if missing:
+            for file_path, content in load_file_contents(repo_id, missing, header).items():
+                self._put(('content', repo_id, file_path), content, len(content))
+                contents[file_path] = content
+        return contents
+    
+    def search_index(self, repo_id, header, file_records):
+        index = self._get(('search_index', repo_id))
+        if index is None:
+            index = load_search_index(repo_id, header, file_records)
+            self._put(('search_index', repo_id), index, sum(32 * len(document[3]) for document in index.documents))
+        return index
+    
+    def vector_index(self, repo_id, header, file_records):
+        index = self._get(('vector_index', repo_id))
+        if index is None:
+            index = load_vector_index(repo_id, header, file_records)
+            # The matrix is memory-mapped, so only the row labels count against the cache
+            self._put(('vector_index', repo_id), index, len(json.dumps(index.rows)))
+        return index
+    
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes}
+
+repo_cache = RepositoryCache(
+    max_bytes=int(os.environ.get("REPO_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+    ttl_seconds=int(os.environ.get("REPO_CACHE_TTL_SECONDS", 600))
+)
+
+@traced('firestore', op='load_structure')
+def load_structure(repo_id, header):
+    """Load the full repository structure tree"""
+    if 'structure' in header:
+        return header['structure']
+    return load_blob(repo_id, header, 'structure') or []
+
+# Snapshots: a processed repository is stored once per owner/repo@commit under a snapshot id, and
+# each user reaches it through an access record at users/{uid}/repos/{repo_id}. The repo_id users
+# see is stable across refreshes; private snapshots are keyed per user so they are never shared.
+def snapshot_id_for(owner, repo, commit_sha, uid, is_private):
+    if not commit_sha:
+        # Without a commit to key on, fall back to one snapshot per user
+        return hashlib.md5(f"{uid}/{owner}/{repo}".encode()).hexdigest()
+    key = f"{owner}/{repo}@{commit_sha}".lower()
+    if is_private:
+        key = f"{uid}/{key}"
+    return hashlib.md5(key.encode()).hexdigest()
+
+def access_ref(uid, repo_id):
+    return db.collection('users').document(uid).collection('repos').document(repo_id)
+
+def public_repository_ref(owner, repo):
+    """Latest snapshot of a public repository, the starting point for incremental processing"""
+    return db.collection('public_repositories').document(hashlib.md5(f"{owner}/{repo}".lower().encode()).hexdigest())
+
+@traced('firestore', op='load_access')
+def load_access(uid, repo_id):
+    access_doc = access_ref(uid, repo_id).get()
+    return access_doc.to_dict() if access_doc.exists else None
+
+def resolve_snapshot(uid, repo_id):
+    """The snapshot a user's repo_id points to, or None if the user has no access to it"""
+    access = load_access(uid, repo_id)
+    if access:
+        return access['snapshot_id']
+    # Repositories processed before snapshots were shared live under the user's own repo_id
+    header = load_repository_header(repo_id)
+    if header and header.get('processed_by_uid') == uid and not header.get('snapshot_key'):
+        return repo_id
+    return None
+
+def snapshot_incomplete(header):
+    """Whether a finished snapshot left files unanalyzed (budget deferrals or failures) that a refresh picks up"""
+    return bool(header.get('deferred_files') or header.get('failed_files'))
+
+@traced('firestore', op='grant_access')
+def grant_access(uid, repo_id, header):
+    """Point a user's repo_id at a snapshot"""
+    access_ref(uid, repo_id).set({
+        'repo_id': repo_id,
+        'snapshot_id': header['repo_id'],
+        'owner': header.get('owner'),
+        'repo': header.get('repo'),
+        'github_url': header.get('github_url'),
+        'commit_sha': header.get('commit_sha'),
+        'is_private': header.get('is_private', False),
+        'processed_at': header.get('processed_at'),
+        'partial': header.get('partial', False),
+        'granted_at': datetime.now().isoformat(),
+    })
+    repo_cache.invalidate(repo_id)
+
+# Keyword retrieval. Every file is indexed as a header document (path, symbols, summary) plus
+# content chunks, ranked with BM25, and persisted with the repository so questions need no LLM
+# call to find candidate files.
+SEARCH_CHUNK_LINES = 60
+# Files passed to the answer prompt, and candidates shown to the LLM when it picks among them
+SEARCH_RESULT_FILES = 5
+SEARCH_CANDIDATE_FILES = 15
+# Let the LLM choose among the top BM25 candidates (one extra round trip per question)
+USE_LLM_FILE_SELECTION = False
+SEARCH_STOP_WORDS = {
+    'the', 'and', 'for', 'with', 'this', 'that', 'from', 'are', 'was', 'how', 'what', 'where', 'which',
+    'does', 'into', 'when', 'who', 'why', 'can', 'you', 'use', 'used', 'using', 'its', 'has', 'have',
+    'not', 'but', 'all', 'any', 'get', 'set', 'self', 'return', 'def', 'var', 'let', 'const', 'new'
+}
+_IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|\d{2,}')
+_CAMEL_CASE_PATTERN = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+')
+
+def tokenize_code(text):
+    """Split text into lowercase search terms, breaking camelCase and snake_case identifiers apart"""
+    tokens = []
+    for identifier in _IDENTIFIER_PATTERN.findall(text):
+        parts = [part for piece in identifier.split('_') for part in _CAMEL_CASE_PATTERN.findall(piece)]
+        lowered = identifier.lower().strip('_')
+        if len(parts) > 1 and lowered not in SEARCH_STOP_WORDS:
+            tokens.append(lowered)
+        for part in parts:
+            part = part.lower()
+            if len(part) > 1 and part not in SEARCH_STOP_WORDS:
+                tokens.append(part)
+    return tokens
+
+def search_documents(file_path, record):
+    """Split a file record into searchable (kind, text) documents: one header plus content chunks"""
+    metadata = record.get('metadata') or {}
+    header_text = ' '.join([
+        # Path and symbol names are the strongest signals, so they are repeated
+        ' '.join([file_path.replace('/', ' ').replace('.', ' ')] * 3),
+        ' '.join([str(name) for name in (metadata.get('functions') or []) + (metadata.get('classes') or [])] * 2),
+        str(metadata.get('main_purpose', '')),
+        ' '.join(str(concept) for concept in metadata.get('key_concepts') or []),
+        str(record.get('summary', ''))
+    ])
+    documents = [('header', header_text)]
+    lines = (record.get('content') or '').splitlines()
+    for start in range(0, len(lines), SEARCH_CHUNK_LINES):
+        documents.append((f"lines {start + 1}-{min(start + SEARCH_CHUNK_LINES, len(lines))}",
+                          '\n'.join(lines[start:start + SEARCH_CHUNK_LINES])))
+    return documents
+
+class BM25Index:
+    """Inverted index over file header documents and content chunks, queried with BM25.
+
+    Documents are kept as per-document term counts so files can be added and removed on refresh;
+    the postings lists are derived from them when the index is loaded."""
+    def __init__(self, documents=None, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents = documents or []  # [file_path, kind, length, {term: count}]
+        self._postings = None
+    
+    def add_file(self, file_path, record):
+        for kind, text in search_documents(file_path, record):
+            self._add_document(file_path, kind, tokenize_code(text))
+    
+    def _add_document(self, file_path, kind, tokens):
+        if not tokens:
+            return
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        self.documents.append([file_path, kind, len(tokens), counts])
+        self._postings = None
+    
+    def remove_files(self, file_paths):
+        file_paths = set(file_paths)
+        self.documents = [document for document in self.documents if document[0] not in file_paths]
+        self._postings = None
+    
+    def _build_postings(self):
+        postings = {}
+        for doc_id, (_, _, _, counts) in enumerate(self.documents):
+            for term, count in counts.items():
+                postings.setdefault(term, []).append((doc_id, count))
+        total_length = sum(document[2] for document in self.documents)
+        self.average_length = total_length / len(self.documents) if self.documents else 0
+        self._postings = postings
+    
+    def search(self, query, top_k=None):
+        """Rank files for a query; a file scores its header document plus its best content chunk"""
+        if self._postings is None:
+            self._build_postings()
+        document_count = len(self.documents)
+        doc_scores = {}
+        for term in set(tokenize_code(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, count in postings:
+                length = self.documents[doc_id][2]
+                norm = count + self.k1 * (1 - self.b + self.b * length / self.average_length)
+                doc_scores[doc_id] = doc_scores.get(doc_id, 0.0) + idf * count * (self.k1 + 1) / norm
+        
+        file_scores = {}
+        best_chunks = {}
+        for doc_id, score in doc_scores.items():
+            file_path, kind = self.documents[doc_id][0], self.documents[doc_id][1]
+            scores = file_scores.setdefault(file_path, {'header': 0.0, 'chunk': 0.0})
+            if kind == 'header':
+                scores['header'] = score
+            elif score > scores['chunk']:
+                scores['chunk'] = score
+                best_chunks[file_path] = kind
+        ranked = sorted(
+            ((file_path, scores['header'] + scores['chunk'], best_chunks.get(file_path)) for file_path, scores in file_scores.items()),
+            key=lambda item: item[1], reverse=True
+        )
+        return ranked[:top_k] if top_k else ranked
+    
+    def to_dict(self):
+        return {'version': 1, 'documents': self.documents}
+    
+    @classmethod
+    def from_dict(cls, data):
+        return cls(documents=data.get('documents', []))
+    
+    @classmethod
+    def from_file_records(cls, file_records):
+        index = cls()
+        for file_path, record in file_records.items():
+            index.add_file(file_path, record)
+        return index
+
+def load_search_index(repo_id, header, file_records):
+    """Load the persisted BM25 index, or build one from file summaries for repositories without it"""
+    data = load_blob(repo_id, header, 'bm25')
+    if data is not None:
+        return BM25Index.from_dict(data)
+    return BM25Index.from_file_records(file_records)
+
+# Semantic retrieval. File and chunk embeddings from a pluggable local embedder are kept in one
+# contiguous float32 matrix (saved as a memory-mappable .npy per repository), so a query is a single
+# matrix-vector product. Works offline; nothing is sent to an embedding API. The index is also stored
+# with the snapshot as the 'vectors' blob, so other hosts load the same vectors instead of rebuilding
+# them (a per-repository embedder refitted from scratch would not match incrementally updated ones).
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR", "vector_index")
+EMBEDDER_NAME = os.environ.get("EMBEDDER", "hashing")
+VECTOR_DIM = 384
+# Matches below this cosine similarity are treated as noise from hash collisions
+VECTOR_MIN_SIMILARITY = 0.05
+
+def encode_array(array):
+    return {'dtype': str(array.dtype), 'shape': list(array.shape),
+            'data': base64.b64encode(np.ascontiguousarray(array).tobytes()).decode('ascii')}
+
+def decode_array(data):
+    return np.frombuffer(base64.b64decode(data['data']), dtype=data['dtype']).reshape(data['shape'])
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (matrix / norms).astype(np.float32)
+
+def hashed_term_frequencies(texts, features):
+    """Sublinear term frequencies of code tokens, hashed into a fixed number of signed features"""
+    matrix = np.zeros((len(texts), features), dtype=np.float32)
+    for row, text in enumerate(texts):
+        counts = {}
+        for token in tokenize_code(text):
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            # crc32 rather than hash(), which is salted per process
+            token_hash = zlib.crc32(token.encode())
+            sign = 1.0 if token_hash & 0x80000000 else -1.0
+            matrix[row, token_hash % features] += sign * (1 + math.log(count))
+    return matrix
+
+class HashingEmbedder:
+    """Stateless baseline embedder: signed feature hashing of code tokens"""
+    name = 'hashing'
+    
+    def __init__(self, dim=VECTOR_DIM):
+        self.dim = dim
+    
+    def fit(self, texts):
+        return self
+    
+    def embed(self, texts):
+        return normalize_rows(hashed_term_frequencies(texts, self.dim))
+    
+    def arrays(self):
+        return {}
+    
+    @classmethod
+    def from_arrays(cls, dim, arrays):
+        return cls(dim)
+
+class TfidfSvdEmbedder:
+    """TF-IDF over hashed features reduced by a truncated SVD (latent semantic analysis), fitted per repository"""
+    name = 'tfidf-svd'
+    
+    def __init__(self, dim=VECTOR_DIM, features=4096, idf=None, components=None):
+        self.dim = dim
+        self.features = features
+        self.idf = idf
+        self.components = components
+    
+    def fit(self, texts):
+        term_frequencies = hashed_term_frequencies(texts, self.features)
+        document_frequencies = (term_frequencies != 0).sum(axis=0)
+        self.idf = (np.log((1 + len(texts)) / (1 + document_frequencies)) + 1).astype(np.float32)
+        _, _, vt = np.linalg.svd(normalize_rows(term_frequencies * self.idf), full_matrices=False)
+        self.components = np.ascontiguousarray(vt[:self.dim].T, dtype=np.float32)
+        return self
+    
+    def embed(self, texts):
+        weighted = normalize_rows(hashed_term_frequencies(texts, self.features) * self.idf)
+        return normalize_rows(weighted @ self.components)
+    
+    def arrays(self):
+        return {'idf': self.idf, 'components': self.components}
+    
+    @classmethod
+    def from_arrays(cls, dim, arrays):
+        return cls(dim, arrays['components'].shape[0], arrays['idf'], arrays['components'])
+
+EMBEDDERS = {
+    HashingEmbedder.name: HashingEmbedder,
+    TfidfSvdEmbedder.name: TfidfSvdEmbedder,
+}
+
+class VectorIndex:
+    """Embeddings of file header documents and content chunks in one contiguous float32 matrix"""
+    def __init__(self, embedder, rows=None, matrix=None):
+        self.embedder = embedder
+        self.rows = rows or []  # [file_path, kind] per matrix row
+        self.matrix = matrix if matrix is not None else np.zeros((0, 0), dtype=np.float32)
+    
+    @classmethod
+    def build(cls, file_records, embedder_name=None):
+        rows, texts = cls._documents(file_records)
+        embedder = EMBEDDERS[embedder_name or EMBEDDER_NAME]().fit(texts)
+        return cls(embedder, rows, embedder.embed(texts) if texts else None)
+    
+    @staticmethod
+    def _documents(file_records):
+        rows, texts = [], []
+        for file_path, record in file_records.items():
+            for kind, text in search_documents(file_path, record):
+                rows.append([file_path, kind])
+                texts.append(text)
+        return rows, texts
+    
+    def add_files(self, file_records):
+        rows, texts = self._documents(file_records)
+        if not texts:
+            return
+        vectors = self.embedder.embed(texts)
+        self.matrix = np.ascontiguousarray(np.vstack([self.matrix, vectors]) if len(self.rows) else vectors)
+        self.rows.extend(rows)
+    
+    def remove_files(self, file_paths):
+        file_paths = set(file_paths)
+        keep = np.array([row[0] not in file_paths for row in self.rows], dtype=bool)
+        if len(self.rows) and not keep.all():
+            self.matrix = np.ascontiguousarray(self.matrix[keep])
+            self.rows = [row for row, kept in zip(self.rows, keep) if kept]
+    
+    def search(self, query, top_k=10):
+        """Best files by cosine similarity, each scored by its best matching row"""
+        if not self.rows:
+            return []
+        scores = self.matrix @ self.embedder.embed([query])[0]
+        # Several rows can belong to one file, so over-fetch before collapsing rows into files
+        candidate_count = min(len(scores), top_k * 8)
+        candidates = np.argpartition(-scores, candidate_count - 1)[:candidate_count]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        results = []
+        seen = set()
+        for row_id in candidates:
+            file_path, kind = self.rows[row_id]
+            if file_path in seen or scores[row_id] < VECTOR_MIN_SIMILARITY:
+                continue
+            seen.add(file_path)
+            results.append((file_path, float(scores[row_id]), kind))
+            if len(results) >= top_k:
+                break
+        return results
+    
+    def save(self, directory, version):
+        """Write the vectors, embedder arrays and row labels; the version ties the files to one processing run.
+
+        Every save writes uniquely named files, and rows.json, which names them, is replaced last: readers
+        and concurrent writers see either the previous index or the new one, never a mix."""
+        os.makedirs(directory, exist_ok=True)
+        previous = self._file_names(directory)
+        written = []
+        try:
+            for prefix, suffix, write in (
+                ('vectors-', '.npy', lambda f: np.save(f, np.ascontiguousarray(self.matrix, dtype=np.float32))),
+                ('embedder-', '.npz', lambda f: np.savez(f, **self.embedder.arrays())),
+                ('rows-', '.json.tmp', lambda f: f.write(json.dumps({
+                    'version': version, 'embedder': self.embedder.name, 'dim': self.embedder.dim, 'rows': self.rows,
+                    'vectors_file': os.path.basename(written[0]), 'embedder_file': os.path.basename(written[1]),
+                }).encode())),
+            ):
+                fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=directory)
+                written.append(path)
+                with os.fdopen(fd, 'wb') as f:
+                    write(f)
+            os.replace(written[2], os.path.join(directory, 'rows.json'))
+        except BaseException:
+            for path in written:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            raise
+        # The files of the replaced index; open memory maps keep their data until they are closed
+        for name in previous:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+    
+    def to_dict(self, version):
+        """The index as a JSON value for the snapshot's 'vectors' blob"""
+        return {
+            'version': version, 'embedder': self.embedder.name, 'dim': self.embedder.dim, 'rows': self.rows,
+            'matrix': encode_array(np.asarray(self.matrix, dtype=np.float32)),
+            'embedder_arrays': {name: encode_array(array) for name, array in self.embedder.arrays().items()},
+        }
+    
+    @classmethod
+    def from_dict(cls, data, version):
+        """Rebuild an index from to_dict output; returns None if it is from another processing run"""
+        if data.get('version') != version:
+            return None
+        arrays = {name: decode_array(array) for name, array in data.get('embedder_arrays', {}).items()}
+        embedder = EMBEDDERS[data['embedder']].from_arrays(data['dim'], arrays)
+        return cls(embedder, data['rows'], decode_array(data['matrix']))
+    
+    @staticmethod
+    def _file_names(directory):
+        """The vectors and embedder files the current rows.json points at"""
+        try:
+            with open(os.path.join(directory, 'rows.json')) as f:
+                meta = json.load(f)
+            return [meta.get('vectors_file', 'vectors.npy'), meta.get('embedder_file', 'embedder.npz')]
+        except (OSError, ValueError):
+            return []
+    
+    @classmethod
+    def load(cls, directory, version):
+        """Memory-map a saved index; returns None if it is missing or from another processing run"""
+        try:
+            with open(os.path.join(directory, 'rows.json')) as f:
+                meta = json.load(f)
+            if meta['version'] != version:
+                return None
+            with np.load(os.path.join(directory, meta.get('embedder_file', 'embedder.npz'))) as arrays:
+                embedder = EMBEDDERS[meta['embedder']].from_arrays(meta['dim'], dict(arrays))
+            matrix = np.load(os.path.join(directory, meta.get('vectors_file', 'vectors.npy')), mmap_mode='r')
+            return cls(embedder, meta['rows'], matrix)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Vector index at {directory} unavailable: {str(e)}")
+            return None
+
+def vector_index_dir(repo_id):
+    return os.path.join(VECTOR_INDEX_DIR, repo_id)
+
+def load_saved_vector_index(repo_id, header):
+    """Memory-map the local copy of the repository's vector index, falling back to the snapshot's 'vectors'
+    blob (saved locally for next time); returns None if neither exists for this processing run"""
+    version = header.get('processed_at')
+    index = VectorIndex.load(vector_index_dir(repo_id), version)
+    if index is not None:
+        return index
+    try:
+        data = load_blob(repo_id, header, 'vectors')
+        index = VectorIndex.from_dict(data, version) if data is not None else None
+    except Exception as e:
+        print(f"Could not load the stored vector index of {repo_id}: {str(e)}")
+        return None
+    if index is not None:
+        try:
+            index.save(vector_index_dir(repo_id), version)
+        except OSError as e:
+            print(f"Could not save the vector index of {repo_id}: {str(e)}")
+    return index
+
+def load_vector_index(repo_id, header, file_records):
+    """The repository's vector index, rebuilt from file summaries for snapshots stored without one"""
+    index = load_saved_vector_index(repo_id, header)
+    if index is None:
+        index = VectorIndex.build(file_records)
+        try:
+            index.save(vector_index_dir(repo_id), header.get('processed_at'))
+        except OSError as e:
+            # The in-memory index still answers this question; the next load rebuilds it again
+            print(f"Could not save the vector index of {repo_id}: {str(e)}")
+    return index
+
+def fuse_rankings(*rankings, k=60):
+    """Reciprocal rank fusion of several ranked lists of file paths"""
+    scores = {}
+    for ranking in rankings:
+        for rank, file_path in enumerate(ranking):
+            scores[file_path] = scores.get(file_path, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+# Prompt assembly. Prompts are packed into the model's context window by priority instead of
+# pasting whole files; code is split at function/class boundaries found by the static extractors.
+MODEL_CONTEXT_TOKENS = 64000
+LLM_MAX_OUTPUT_TOKENS = 2000
+# Room left for the fixed instructions around the packed context
+PROMPT_TOKEN_BUDGET = MODEL_CONTEXT_TOKENS - LLM_MAX_OUTPUT_TOKENS - 1000
+# Per-file analysis prompts don't need the whole window, and smaller prompts are faster and cheaper
+FILE_PROMPT_TOKEN_BUDGET = 16000
+CODE_CHUNK_TARGET_TOKENS = 400
+CODE_CHUNK_MAX_TOKENS = 1500
+
+def estimate_tokens(text):
+    """Fast token estimate (~3.5 characters per token for code and English)"""
+    return int(len(text) / 3.5) + 1
+
+def truncate_to_tokens(text, tokens):
+    """Cut text to roughly the given token count, at a line boundary where possible"""
+    limit = int(tokens * 3.5)
+    if len(text) <= limit:
+        return text
+    cut = text.rfind('\n', 0, limit)
+    return text[:cut if cut > limit // 2 else limit]
+
+def iter_json_objects(text):
+    """Yield every top-level JSON object found in an LLM answer.
+
+    Objects are decoded one at a time, so a truncated or partly malformed array still yields its
+    complete entries; nested objects of an entry that decodes are not yielded separately."""
+    decoder = json.JSONDecoder()
+    position = text.find('{')
+    while position != -1:
+        try:
+            value, end = decoder.raw_decode(text, position)
+        except ValueError:
+            position = text.find('{', position + 1)
+            continue
+        if isinstance(value, dict):
+            yield value
+        position = text.find('{', end)
+
+def chunk_code(content, file_path, symbols=None):
+    """Split code into chunks at function/class boundaries, using the static extractor's symbols.
+
+    Returns [{'start_line', 'end_line', 'symbols', 'text'}]. Small neighbouring definitions are merged
+    up to CODE_CHUNK_TARGET_TOKENS; oversized ones are split by lines."""
+    lines = content.splitlines()
+    if not lines:
+        return []
+    if symbols is None:
+        static_metadata = extract_static_metadata(content, file_path)
+        symbols = static_metadata['symbols'] if static_metadata else []
+    
+    # Top-level definitions and their direct members (methods) start new segments
+    boundaries = sorted({symbol['line'] for symbol in symbols if symbol['name'].count('.') <= 1 and 1 < symbol['line'] <= len(lines)})
+    starts = [1] + boundaries
+    segments = []
+    for index, start in enumerate(starts):
+        end = starts[index + 1] - 1 if index + 1 < len(starts) else len(lines)
+        names = [symbol['name'] for symbol in symbols if start <= symbol['line'] <= end]
+        segment_lines = lines[start - 1:end]
+        if estimate_tokens('\n'.join(segment_lines)) <= CODE_CHUNK_MAX_TOKENS:
+            segments.append({'start_line': start, 'end_line': end, 'symbols': names})
+            continue
+        window = max(1, int(len(segment_lines) * CODE_CHUNK_MAX_TOKENS / estimate_tokens('\n'.join(segment_lines))))
+        for offset in range(0, len(segment_lines), window):
+            segments.append({
+                'start_line': start + offset,
+                'end_line': min(start + offset + window - 1, end),
+                'symbols': names if offset == 0 else []
+            })
+    
+    chunks = []
+    for segment in segments:
+        if chunks:
+            previous = chunks[-1]
+            merged_tokens = estimate_tokens('\n'.join(lines[previous['start_line'] - 1:segment['end_line']]))
+            if merged_tokens <= CODE_CHUNK_TARGET_TOKENS:
+                previous['end_line'] = segment['end_line']
+                previous['symbols'] = previous['symbols'] + segment['symbols']
+                continue
+        chunks.append(dict(segment))
+    for chunk in chunks:
+        chunk['text'] = '\n'.join(lines[chunk['start_line'] - 1:chunk['end_line']])
+    return chunks
+
+class PromptBuilder:
+    """Packs prompt sections into a token budget by priority (lower first) and reports what was dropped.
+
+    Sections keep the order they were added in, whatever their priority."""
+    def __init__(self, budget_tokens=PROMPT_TOKEN_BUDGET):
+        self.budget_tokens = budget_tokens
+        self.sections = []
+    
+    def add(self, text, priority=0, label=None, truncatable=False):
+        self.sections.append({
+            'order': len(self.sections),
+            'priority': priority,
+            'label': label,
+            'text': text,
+            'tokens': estimate_tokens(text),
+            'truncatable': truncatable
+        })
+    
+    def build(self, separator="\n"):
+        """Return (text, report) where report lists the dropped and truncated section labels"""
+        remaining = self.budget_tokens
+        chosen = {}
+        dropped = []
+        truncated = []
+        for section in sorted(self.sections, key=lambda section: (section['priority'], section['order'])):
+            if section['tokens'] <= remaining:
+                chosen[section['order']] = section['text']
+                remaining -= section['tokens']
+            elif section['truncatable'] and remaining > 100:
+                chosen[section['order']] = truncate_to_tokens(section['text'], remaining - 10) + "\n..."
+                remaining = 0
+                if section['label']:
+                    truncated.append(section['label'])
+            elif section['label']:
+                dropped.append(section['label'])
+        text = separator.join(chosen[order] for order in sorted(chosen))
+        return text, {
+            'budget_tokens': self.budget_tokens,
+            'used_tokens': self.budget_tokens - remaining,
+            'dropped': dropped,
+            'truncated': truncated
+        }
+
+def pack_code(content, file_path, budget_tokens, symbols=None, question=None):
+    """Fit a file into a token budget chunk by chunk, noting omitted chunks by their definitions.
+
+    Without a question, earlier chunks win; with one, chunks sharing more terms with it win."""
+    if estimate_tokens(content) <= budget_tokens:
+        return content, []
+    chunks = chunk_code(content, file_path, symbols)
+    
+    question_terms = set(tokenize_code(question)) if question else set()
+    ranked = sorted(range(len(chunks)), key=lambda i: (-len(question_terms & set(tokenize_code(chunks[i]['text']))), i))
+    priority = {chunk_index: rank for rank, chunk_index in enumerate(ranked)}
+    builder = PromptBuilder(budget_tokens)
+    for index, chunk in enumerate(chunks):
+        label = f"{file_path}:{chunk['start_line']}-{chunk['end_line']}"
+        if chunk['symbols']:
+            label += f" ({', '.join(chunk['symbols'][:5])})"
+        builder.add(f"[lines {chunk['start_line']}-{chunk['end_line']}]\n{chunk['text']}", priority=priority[index], label=label)
+    text, report = builder.build()
+    if report['dropped']:
+        text += "\n[omitted to fit the context window: " + "; ".join(report['dropped']) + "]"
+    return text, report['dropped']
+
+# File filtering. Vendored, generated and oversized files are dropped from the tree before any content
+# is fetched, and minified or generated-looking contents are dropped after. Repositories can adjust the
+# rules with .gitattributes (linguist-generated / linguist-vendored) and a .codecompass.json file.
+VENDORED_PATH_PATTERN = re.compile(
+    r'(^|/)(node_modules|bower_components|jspm_packages|vendor|vendors|third[_-]party|\.yarn|Pods|Carthage)/', re.IGNORECASE)
+GENERATED_PATH_PATTERN = re.compile(
+    r'(^|/)(dist|coverage|__snapshots__|\.next|\.nuxt)/'
+    r'|(\.min\.(js|css)|-min\.js|\.bundle\.js|_pb2(_grpc)?\.py|\.pb\.(go|cc|h)|_pb\.js|\.g\.dart|\.generated\.\w+|\.designer\.cs)$'
+    r'|(^|/)(package-lock\.json|npm-shrinkwrap\.json|pnpm-lock\.yaml|composer\.lock)$', re.IGNORECASE)
+# Size ceilings in bytes, from the tree's size field; data-like formats get a lower one
+DEFAULT_FILE_SIZE_LIMIT = 500000
+FILE_SIZE_LIMITS = {'.json': 50000, '.yaml': 50000, '.yml': 50000, '.sql': 100000, '.html': 100000, '.css': 100000, '.scss': 100000, '.sass': 100000}
+# Contents are treated as minified when their average line is this long
+MINIFIED_MIN_BYTES = 2000
+MINIFIED_AVG_LINE_LENGTH = 200
+GENERATED_MARKER_PATTERN = re.compile(r'@generated|DO NOT EDIT|<auto-generated', re.IGNORECASE)
+# Optional per-repository settings at the repository root, e.g.
+# {"exclude": ["docs/**"], "include": ["vendor/ours/**"], "size_limits": {".json": 200000}, "skip_minified": true}
+REPO_CONFIG_PATH = '.codecompass.json'
+# At most this many .gitattributes files are fetched per repository
+MAX_GITATTRIBUTES_FILES = 20
+
+def glob_to_regex(pattern, base_dir='', anchored=None):
+    """Compile a gitignore-style glob; patterns without a slash match at any depth below base_dir"""
+    if anchored is None:
+        anchored = '/' in pattern.rstrip('/')
+    pattern = pattern.strip('/')
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    prefix = re.escape(base_dir.strip('/') + '/') if base_dir.strip('/') else ''
+    return re.compile(prefix + ('' if anchored else '(?:.*/)?') + regex + '(?:/.*)?$')
+
+def parse_gitattributes(text, base_dir=''):
+    """Linguist rules from a .gitattributes file as [(regex, attribute, value)], in file order"""
+    rules = []
+    for line in text.splitlines():
+        parts = line.split()
+        if not parts or parts[0].startswith('#'):
+            continue
+        for attribute in parts[1:]:
+            value = True
+            if attribute.startswith('-'):
+                attribute, value = attribute[1:], False
+            elif '=' in attribute:
+                attribute, setting = attribute.split('=', 1)
+                value = setting.lower() not in ('false', '0')
+            if attribute in ('linguist-generated', 'linguist-vendored'):
+                rules.append((glob_to_regex(parts[0], base_dir), attribute, value))
+    return rules
+
+def looks_minified(content):
+    if len(content) < MINIFIED_MIN_BYTES:
+        return False
+    return len(content) / (content.count('\n') + 1) > MINIFIED_AVG_LINE_LENGTH
+
+def validate_repo_config(config):
+    """The usable part of a parsed .codecompass.json and a list of problems with the rest"""
+    if not isinstance(config, dict):
+        return {}, [f"expected an object, got {type(config).__name__}"]
+    valid, problems = {}, []
+    for key, value in config.items():
+        if key in ('include', 'exclude'):
+            if isinstance(value, list) and all(isinstance(pattern, str) for pattern in value):
+                valid[key] = value
+            else:
+                problems.append(f"'{key}' must be a list of glob strings")
+        elif key == 'size_limits':
+            if isinstance(value, dict) and all(isinstance(ext, str) and isinstance(limit, int) and not isinstance(limit, bool) and limit > 0
+                                               for ext, limit in value.items()):
+                valid[key] = value
+            else:
+                problems.append("'size_limits' must map extensions to positive integer byte counts")
+        elif key == 'skip_minified':
+            if isinstance(value, bool):
+                valid[key] = value
+            else:
+                problems.append("'skip_minified' must be true or false")
+        else:
+            problems.append(f"unknown key '{key}'")
+    return valid, problems
+
+class FileFilter:
+    """Decides which files of a repository tree are worth fetching and analyzing"""
+    def __init__(self, gitattribute_rules=None, config=None):
+        config = config or {}
+        self.gitattribute_rules = gitattribute_rules or []
+        self.include = [glob_to_regex(pattern) for pattern in config.get('include', [])]
+        self.exclude = [glob_to_regex(pattern) for pattern in config.get('exclude', [])]
+        self.size_limits = dict(FILE_SIZE_LIMITS, **{ext.lower(): int(limit) for ext, limit in config.get('size_limits', {}).items()})
+        self.skip_minified = config.get('skip_minified', True)
+    
+    def skip_reason(self, file_path, size=0):
+        """Why a file is skipped before fetching ('excluded', 'vendored', 'generated', 'too_large'), or None"""
+        included = any(pattern.match(file_path) for pattern in self.include)
+        if not included:
+            if any(pattern.match(file_path) for pattern in self.exclude):
+                return 'excluded'
+            attributes = {}
+            for regex, attribute, value in self.gitattribute_rules:
+                if regex.match(file_path):
+                    attributes[attribute] = value
+            # An explicit "false" in .gitattributes overrides the built-in path rules
+            if attributes.get('linguist-vendored', VENDORED_PATH_PATTERN.search(file_path) is not None):
+                return 'vendored'
+            if attributes.get('linguist-generated', GENERATED_PATH_PATTERN.search(file_path) is not None):
+                return 'generated'
+        _, ext = os.path.splitext(file_path.lower())
+        if size and size > self.size_limits.get(ext, DEFAULT_FILE_SIZE_LIMIT):
+            return 'too_large'
+        return None
+    
+    def content_skip_reason(self, content):
+        """Why downloaded content is skipped ('minified', 'generated'), or None"""
+        if not self.skip_minified:
+            return None
+        if looks_minified(content):
+            return 'minified'
+        if GENERATED_MARKER_PATTERN.search(content[:1000]):
+            return 'generated'
+        return None
+    
+    def apply(self, structure):
+        """Mark skipped files in the tree (dropping 'processable') and return counts by reason"""
+        skipped = {}
+        
+        def walk(items):
+            for item in items:
+                if item['type'] == 'dir':
+                    walk(item.get('children', []))
+                elif item.get('processable'):
+                    reason = self.skip_reason(item['path'], item.get('size', 0))
+                    if reason:
+                        del item['processable']
+                        item['skipped'] = reason
+                        skipped[reason] = skipped.get(reason, 0) + 1
+        
+        walk(structure)
+        return skipped
+
+def count_skipped(*counts):
+    total = {}
+    for skipped in counts:
+        for reason, count in skipped.items():
+            total[reason] = total.get(reason, 0) + count
+    return total
+
+def describe_skipped(skipped):
+    return ', '.join(f"{count} {reason.replace('_', ' ')}" for reason, count in sorted(skipped.items(), key=lambda entry: -entry[1]))
+
+class FileAnalysisError(Exception):
+    """The LLM analysis of a file failed; nothing is cached and the file is reported as failed"""
 
 class RepositoryProcessor:
     def __init__(self):
@@ -157,33 +2067,91 @@ class RepositoryProcessor:
         """Generate unique repository ID per user"""
         return hashlib.md5(f"{uid}/{owner}/{repo}".encode()).hexdigest()
     
-    def get_github_content(self, owner, repo, path="", pat_token=None):
-        """Fetch content from GitHub API"""
-        url = f"{GITHUB_API_BASE}/repos/{owner}/{repo}/contents/{path}"
-        headers = {'Accept': 'application/vnd.github.v3+json'}
+    def github_request(self, endpoint, pat_token=None, params=None, accept='application/vnd.github.v3+json', max_retries=3):
+        """Make a GET request to the GitHub API, returning None for missing or empty repositories"""
+        url = f"{GITHUB_API_BASE}{endpoint}"
+        headers = {'Accept': accept}
         if pat_token:
             headers['Authorization'] = f'token {pat_token}'
         
-        response = requests.get(url, headers=headers)
+        # Label by API area (contents, git, commits, ...) rather than full path to keep the series few
+        kind = endpoint.split('/')[4] if endpoint.startswith('/repos/') and endpoint.count('/') >= 4 else endpoint.strip('/').split('/')[0]
+        for attempt in range(max_retries):
+            github_rate_limiter.wait()
+            with span('github', kind=kind):
+                response = github_http_cache.get(github_transport, url, headers, params)
+            metrics.inc('codecompass_github_requests_total', kind=kind, status=response.status_code)
+            if not github_rate_limiter.update(response):
+                break
+        
         if response.status_code == 200:
-            return response.json()
+            return response
         elif response.status_code == 404:
             print(f"GitHub API 404 Not Found for {url}")
             return None
+        elif response.status_code == 409:
+            # GitHub answers 409 Conflict for repositories without any commits
+            print(f"GitHub API 409 Empty repository for {url}")
+            return None
         else:
             print(f"GitHub API Error: {response.status_code} - {response.text} for URL: {url}")
             response.raise_for_status()
+
+    def get_github_content(self, owner, repo, path="", pat_token=None):
+        """Fetch content from GitHub API"""
+        response = self.github_request(f"/repos/{owner}/{repo}/contents/{path}", pat_token)
+        return response.json() if response is not None else None
     
     def get_file_content(self, owner, repo, file_path, pat_token=None):
         """Get decoded file content"""
         content_data = self.get_github_content(owner, repo, file_path, pat_token)
         if content_data and content_data.get('content'):
             try:
-                decoded_content = base64.b64decode(content_data['content']).decode('utf-8')
-                return decoded_content
+                return self.decode_file_content(base64.b64decode(content_data['content']))
             except:
                 return None
         return None
+
+    def decode_file_content(self, raw_content):
+        """Decode raw file bytes as UTF-8, returning None for binary or undecodable files"""
+        # Same heuristic git uses: a NUL byte near the start means the file is binary
+        if b'\0' in raw_content[:8000]:
+            return None
+        try:
+            return raw_content.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    def iter_archive_files(self, owner, repo, ref="HEAD", pat_token=None, wanted_paths=None):
+        """Download the repository tarball once and yield (path, bytes) for processable files.
+
+        The archive is streamed straight through tarfile, so nothing is written to disk
+        and files over the Contents API's 1 MB limit are included."""
+        url = f"{GITHUB_API_BASE}/repos/{owner}/{repo}/tarball/{ref}"
+        headers = {'Accept': 'application/vnd.github.v3+json'}
+        if pat_token:
+            headers['Authorization'] = f'token {pat_token}'
+        
+        github_rate_limiter.wait()
+        with span('github', kind='tarball'), github_transport.get(url, headers=headers, stream=True) as response:
+            metrics.inc('codecompass_github_requests_total', kind='tarball', status=response.status_code)
+            github_rate_limiter.update(response)
+            if response.status_code != 200:
+                print(f"GitHub API Error: {response.status_code} - {response.text} for URL: {url}")
+                response.raise_for_status()
+            response.raw.decode_content = True
+            
+            with tarfile.open(fileobj=response.raw, mode='r|*') as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    # Every member sits under a top-level "{owner}-{repo}-{short_sha}/" directory
+                    _, _, file_path = member.name.partition('/')
+                    if not file_path or not self.should_process_file(file_path):
+                        continue
+                    if wanted_paths is not None and file_path not in wanted_paths:
+                        continue
+                    yield file_path, archive.extractfile(member).read()
     
     def should_process_file(self, file_path):
         """Check if file should be processed based on extension"""
@@ -209,37 +2177,181 @@ class RepositoryProcessor:
                 'size': item.get('size', 0)
             }
             
-            if item['type'] == 'dir':
-                item_info['children'] = self.get_repository_structure(
-                    owner, repo, item['path'], max_depth, current_depth + 1, pat_token
-                )
-            elif item['type'] == 'file' and self.should_process_file(item['path']):
+            if item['type'] == 'dir':
+                item_info['children'] = self.get_repository_structure(
+                    owner, repo, item['path'], max_depth, current_depth + 1, pat_token
+                )
+            elif item['type'] == 'file' and self.should_process_file(item['path']):
+                item_info['processable'] = True
+            
+            structure.append(item_info)
+        
+        return structure
+
+    def is_private_repository(self, owner, repo, pat_token=None):
+        """Visibility as GitHub reports it. Anonymous requests only reach public repositories; with a PAT
+        the repository is treated as private unless GitHub says otherwise, so it is never shared by mistake."""
+        if not pat_token:
+            return False
+        try:
+            response = self.github_request(f"/repos/{owner}/{repo}", pat_token)
+        except Exception as e:
+            print(f"Could not check the visibility of {owner}/{repo}: {str(e)}")
+            return True
+        return response is None or response.json().get('private') is not False
+
+    def resolve_commit_sha(self, owner, repo, ref=None, pat_token=None):
+        """Resolve a branch, tag or the default branch (HEAD) to a commit SHA"""
+        response = self.github_request(
+            f"/repos/{owner}/{repo}/commits/{ref or 'HEAD'}", pat_token,
+            accept='application/vnd.github.sha'
+        )
+        return response.text.strip() if response is not None else None
+
+    def load_file_filter(self, owner, repo, structure, pat_token=None):
+        """Build the repository's FileFilter from its .gitattributes files and .codecompass.json"""
+        attribute_paths = []
+        
+        def walk(items):
+            for item in items:
+                if item['type'] == 'dir':
+                    walk(item.get('children', []))
+                elif item['name'] == '.gitattributes':
+                    attribute_paths.append(item['path'])
+        
+        walk(structure)
+        rules = []
+        # Shallower files first, so rules in deeper directories take precedence
+        for path in sorted(attribute_paths, key=lambda path: path.count('/'))[:MAX_GITATTRIBUTES_FILES]:
+            text = self.get_file_content(owner, repo, path, pat_token)
+            if text:
+                rules.extend(parse_gitattributes(text, path.rsplit('/', 1)[0] if '/' in path else ''))
+        if any(item['type'] != 'dir' and item['path'] == REPO_CONFIG_PATH for item in structure):
+            try:
+                config, problems = validate_repo_config(json.loads(self.get_file_content(owner, repo, REPO_CONFIG_PATH, pat_token) or '{}'))
+                for problem in problems:
+                    print(f"Ignoring part of {REPO_CONFIG_PATH} in {owner}/{repo}: {problem}")
+                return FileFilter(rules, config)
+            except ValueError as e:
+                print(f"Ignoring invalid {REPO_CONFIG_PATH} in {owner}/{repo}: {str(e)}")
+        return FileFilter(rules)
+
+    def get_recently_changed_paths(self, owner, repo, commit_sha, pat_token=None, limit=5):
+        """Paths touched by the last few commits up to commit_sha (one call for the list, one per commit)"""
+        response = self.github_request(f"/repos/{owner}/{repo}/commits", pat_token, params={'sha': commit_sha, 'per_page': limit})
+        if response is None:
+            return set()
+        changed = set()
+        for commit in response.json()[:limit]:
+            # Commit details never change, so these are answered from the HTTP cache after the first run
+            detail = self.github_request(f"/repos/{owner}/{repo}/commits/{commit['sha']}", pat_token)
+            if detail is not None:
+                changed.update(changed_file['filename'] for changed_file in detail.json().get('files', []))
+        return changed
+
+    def get_tree_entries(self, owner, repo, tree_sha, max_depth=30, pat_token=None, prefix="", depth=0):
+        """Fetch flat Git tree entries with one recursive call, paging subtrees if GitHub truncates it"""
+        endpoint = f"/repos/{owner}/{repo}/git/trees/{tree_sha}"
+        response = self.github_request(endpoint, pat_token, params={'recursive': 1})
+        if response is None:
+            return []
+        
+        tree = response.json()
+        if not tree.get('truncated'):
+            return [dict(entry, path=prefix + entry['path']) for entry in tree.get('tree', [])]
+        
+        # The recursive listing was cut off, so list this level and walk each subtree separately.
+        # Subtrees are small enough to come back complete in one call in all but pathological cases.
+        print(f"Git tree truncated for {owner}/{repo}:{prefix or '/'}, paging subtrees")
+        response = self.github_request(endpoint, pat_token)
+        if response is None:
+            return []
+        
+        entries = []
+        for entry in response.json().get('tree', []):
+            entries.append(dict(entry, path=prefix + entry['path']))
+            if entry['type'] == 'tree' and depth < max_depth:
+                entries.extend(self.get_tree_entries(
+                    owner, repo, entry['sha'], max_depth, pat_token, prefix + entry['path'] + '/', depth + 1
+                ))
+        return entries
+
+    def build_structure_from_tree(self, entries, max_depth=30):
+        """Rebuild the nested Contents-API style structure from flat Git tree entries"""
+        structure = []
+        children_by_dir = {"": structure}
+        
+        # Parents must be placed before their children; the sort is stable so sibling order is kept
+        for entry in sorted(entries, key=lambda e: e['path'].count('/')):
+            depth = entry['path'].count('/')
+            if depth > max_depth:
+                continue
+            parent_path, _, name = entry['path'].rpartition('/')
+            siblings = children_by_dir.get(parent_path)
+            if siblings is None:
+                continue
+            
+            if entry['type'] == 'tree':
+                item_type = 'dir'
+            elif entry['type'] == 'commit':
+                item_type = 'submodule'
+            elif entry.get('mode') == '120000':
+                item_type = 'symlink'
+            else:
+                item_type = 'file'
+            
+            item_info = {
+                'name': name,
+                'path': entry['path'],
+                'type': item_type,
+                'size': entry.get('size', 0),
+                'sha': entry['sha']
+            }
+            
+            if item_type == 'dir':
+                item_info['children'] = []
+                children_by_dir[entry['path']] = item_info['children']
+            elif item_type == 'file' and self.should_process_file(entry['path']):
                 item_info['processable'] = True
             
-            structure.append(item_info)
+            siblings.append(item_info)
         
         return structure
 
-    def call_llm(self, messages, max_retries=3):
+    def get_repository_tree(self, owner, repo, ref=None, max_depth=30, pat_token=None):
+        """Get repository structure from the Git Trees API, returning (structure, commit_sha)"""
+        commit_sha = self.resolve_commit_sha(owner, repo, ref, pat_token)
+        if not commit_sha:
+            return [], None
+        entries = self.get_tree_entries(owner, repo, commit_sha, max_depth, pat_token)
+        return self.build_structure_from_tree(entries, max_depth), commit_sha
+
+    def call_llm(self, messages, max_retries=3, max_tokens=LLM_MAX_OUTPUT_TOKENS):
         """Call OpenRouter LLM API with retry logic"""
         for attempt in range(max_retries):
             try:
-                response = requests.post(
-                    url="https://openrouter.ai/api/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                        "Content-Type": "application/json",
-                        "HTTP-Referer": "http://localhost:5000",
-                        "X-Title": "CodeCompass",
-                    },
-                    data=json.dumps({
-                        "model": "deepseek/deepseek-v3-base:free",
-                        "messages": messages,
-                        "temperature": 0.2,
-                        "max_tokens": 2000
-                    })
-                )
+                llm_rate_limiter.wait()
+                with span('llm', model=LLM_MODEL) as details:
+                    response = llm_transport.post(
+                        url=OPENROUTER_API_URL,
+                        headers={
+                            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+                            "Content-Type": "application/json",
+                            "HTTP-Referer": "http://localhost:5000",
+                            "X-Title": "CodeCompass",
+                        },
+                        data=json.dumps({
+                            "model": LLM_MODEL,
+                            "messages": messages,
+                            "temperature": 0.2,
+                            "max_tokens": max_tokens
+                        })
+                    )
+                    metrics.inc('codecompass_llm_requests_total', model=LLM_MODEL, status=response.status_code)
+                    if response.status_code == 200:
+                        details.update(record_llm_usage(response.json().get('usage')))
                 
+                llm_rate_limiter.update(response)
                 if response.status_code == 200:
                     return response.json()['choices'][0]['message']['content']
                 else:
@@ -254,62 +2366,155 @@ class RepositoryProcessor:
         
         return "Error: Failed to get LLM response after multiple attempts"
 
-    def analyze_file_metadata(self, file_content, file_path):
-        """Extract metadata from file using LLM"""
+    def stream_llm(self, messages, max_retries=3):
+        """Call OpenRouter with stream: true and yield content deltas as they arrive.
+        Retries only happen before the first delta, so a partial answer is never repeated."""
+        for attempt in range(max_retries):
+            started = False
+            try:
+                llm_rate_limiter.wait()
+                # The span covers the whole stream, including a client disconnecting mid-answer
+                with span('llm', model=LLM_MODEL, stream='true') as details:
+                    response = llm_transport.post(
+                        url=OPENROUTER_API_URL,
+                        headers={
+                            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+                            "Content-Type": "application/json",
+                            "HTTP-Referer": "http://localhost:5000",
+                            "X-Title": "CodeCompass",
+                        },
+                        data=json.dumps({
+                            "model": LLM_MODEL,
+                            "messages": messages,
+                            "temperature": 0.2,
+                            "max_tokens": LLM_MAX_OUTPUT_TOKENS,
+                            "stream": True,
+                            "usage": {"include": True}
+                        }),
+                        stream=True
+                    )
+                    # Closing the response returns its connection to the pool, including on errors and retries
+                    with response:
+                        metrics.inc('codecompass_llm_requests_total', model=LLM_MODEL, status=response.status_code)
+                        
+                        llm_rate_limiter.update(response)
+                        if response.status_code != 200:
+                            print(f"LLM API error (attempt {attempt + 1}): {response.status_code}")
+                            if attempt == max_retries - 1:
+                                response.raise_for_status()
+                            time.sleep(2 ** attempt)
+                            continue
+                        
+                        # text/event-stream carries no charset, which requests would read as ISO-8859-1
+                        response.encoding = 'utf-8'
+                        for line in response.iter_lines(decode_unicode=True):
+                            # Lines starting with ':' are keep-alive comments
+                            if not line or not line.startswith('data: '):
+                                continue
+                            payload = line[len('data: '):]
+                            if payload == '[DONE]':
+                                return
+                            chunk = json.loads(payload)
+                            if chunk.get('error'):
+                                raise RuntimeError(chunk['error'].get('message', 'stream error'))
+                            if chunk.get('usage'):
+                                # Sent with the last chunk when usage accounting is requested
+                                details.update(record_llm_usage(chunk['usage']))
+                            delta = (chunk.get('choices') or [{}])[0].get('delta', {}).get('content')
+                            if delta:
+                                started = True
+                                yield delta
+                        return
+            except Exception as e:
+                print(f"LLM stream failed (attempt {attempt + 1}): {str(e)}")
+                if started or attempt == max_retries - 1:
+                    raise
+                time.sleep(2 ** attempt)  # Exponential backoff
+
+    def metadata_fields_prompt(self, structure_known):
+        """The metadata fields the LLM is asked for; structural facts are left out when the static extractors found them"""
+        if structure_known:
+            # Structural facts are already known; the LLM only has to describe the file
+            return """- main_purpose: Brief description of file's purpose
+- key_concepts: List of important concepts/patterns used"""
+        return """- functions: List of function/method names
+- classes: List of class names
+- imports: List of imported modules/libraries
+- main_purpose: Brief description of file's purpose
+- key_concepts: List of important concepts/patterns used
+- dependencies: List of external dependencies used"""
+
+    def default_file_metadata(self):
+        return {
+            "functions": [],
+            "classes": [],
+            "imports": [],
+            "main_purpose": "Code analysis failed",
+            "key_concepts": [],
+            "dependencies": []
+        }
+
+    def parse_file_analysis(self, entry, static_metadata):
+        """(metadata, summary) from one {"metadata": ..., "summary": ...} answer, or None if it is malformed"""
+        if not isinstance(entry, dict):
+            return None
+        summary = entry.get('summary')
+        llm_metadata = entry.get('metadata')
+        if not isinstance(summary, str) or not summary.strip() or not isinstance(llm_metadata, dict):
+            return None
+        metadata = self.default_file_metadata()
+        metadata.update(llm_metadata)
+        if static_metadata is not None:
+            metadata.update(static_metadata)
+        return metadata, summary.strip()
+
+    def analyze_file_metadata(self, file_content, file_path, static_metadata=None):
+        """Extract metadata from file, using the static extractors where possible and the LLM for the rest"""
+        if static_metadata is None:
+            static_metadata = extract_static_metadata(file_content, file_path)
+        requested_fields = self.metadata_fields_prompt(static_metadata is not None)
+        
+        # Pack large files chunk by chunk to prevent token overflow
+        packed_content, _ = pack_code(file_content, file_path, FILE_PROMPT_TOKEN_BUDGET, (static_metadata or {}).get('symbols'))
         prompt = f"""Analyze this code file and extract metadata in JSON format:
 
 File: {file_path}
 Content:
 ```
-{file_content[:1000000]}  # Limit content to prevent token overflow
+{packed_content}
 ```
 
 Extract and return ONLY a JSON object with these fields:
-- functions: List of function/method names
-- classes: List of class names
-- imports: List of imported modules/libraries
-- main_purpose: Brief description of file's purpose
-- key_concepts: List of important concepts/patterns used
-- dependencies: List of external dependencies used
+{requested_fields}
 
 Return only valid JSON, no other text."""
 
+        metadata = self.default_file_metadata()
         try:
             response = self.call_llm([{"role": "user", "content": prompt}])
             # Try to extract JSON from response
             json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                # Fallback if LLM doesn't return proper JSON
-                return {
-                    "functions": [],
-                    "classes": [],
-                    "imports": [],
-                    "main_purpose": "Code analysis failed",
-                    "key_concepts": [],
-                    "dependencies": []
-                }
+            if not json_match:
+                raise ValueError("no JSON object in the response")
+            metadata.update(json.loads(json_match.group()))
         except Exception as e:
             print(f"Error analyzing file metadata: {str(e)}")
-            return {
-                "functions": [],
-                "classes": [],
-                "imports": [],
-                "main_purpose": f"Error analyzing {file_path}",
-                "key_concepts": [],
-                "dependencies": []
-            }
+            raise FileAnalysisError(f"Metadata analysis failed for {file_path}: {str(e)}") from e
+        
+        if static_metadata is not None:
+            metadata.update(static_metadata)
+        return metadata
 
     def generate_file_summary(self, file_content, file_path, metadata):
         """Generate summary of file using LLM"""
+        packed_content, _ = pack_code(file_content, file_path, FILE_PROMPT_TOKEN_BUDGET, metadata.get('symbols'))
         prompt = f"""Summarize this code file for developers who are new to the codebase:
 
 File: {file_path}
-Metadata: {json.dumps(metadata, indent=2)}
+Metadata: {json.dumps({key: value for key, value in metadata.items() if key != 'symbols'}, indent=2)}
 Content:
 ```
-{file_content[:1000000]}
+{packed_content}
 ```
 
 Provide a clear, concise summary that includes:
@@ -325,7 +2530,178 @@ Keep the summary practical and focused on helping new developers understand the
             return self.call_llm([{"role": "user", "content": prompt}])
         except Exception as e:
             print(f"Error generating file summary: {str(e)}")
-            return f"Summary generation failed for {file_path}"
+            raise FileAnalysisError(f"Summary generation failed for {file_path}: {str(e)}") from e
+
+    def analyze_file(self, file_content, file_path, static_metadata=None):
+        """Metadata and summary of one file from a single LLM call, returning (metadata, summary).
+        Falls back to the separate metadata and summary calls when the answer can't be parsed,
+        and raises FileAnalysisError if those fail too."""
+        if static_metadata is None:
+            static_metadata = extract_static_metadata(file_content, file_path)
+        if FILE_ANALYSIS_MODE == 'separate':
+            metadata = self.analyze_file_metadata(file_content, file_path, static_metadata)
+            return metadata, self.generate_file_summary(file_content, file_path, metadata)
+        
+        packed_content, _ = pack_code(file_content, file_path, FILE_PROMPT_TOKEN_BUDGET, (static_metadata or {}).get('symbols'))
+        prompt = f"""Analyze this code file for developers who are new to the codebase.
+
+File: {file_path}
+Content:
+```
+{packed_content}
+```
+
+Return ONLY a JSON object of the form {{"metadata": {{...}}, "summary": "..."}} where metadata has these fields:
+{self.metadata_fields_prompt(static_metadata is not None)}
+
+and summary is a clear, concise summary that covers:
+1. What this file does
+2. How it fits into the larger application
+3. Key functions/classes and their purposes
+4. Important dependencies or patterns used
+5. Any setup or usage notes for developers
+
+Return only valid JSON, no other text."""
+
+        try:
+            response = self.call_llm([{"role": "user", "content": prompt}])
+            json_match = re.search(r'\{.*\}', response, re.DOTALL)
+            analysis = self.parse_file_analysis(json.loads(json_match.group()), static_metadata) if json_match else None
+            if analysis:
+                return analysis
+            print(f"Malformed combined analysis for {file_path}, falling back to separate calls")
+        except Exception as e:
+            print(f"Error analyzing file {file_path}: {str(e)}")
+        metadata = self.analyze_file_metadata(file_content, file_path, static_metadata)
+        return metadata, self.generate_file_summary(file_content, file_path, metadata)
+
+    def analyze_files_batch(self, files):
+        """Analyze several small files in one LLM call.
+
+        files is a list of (file_path, file_content, static_metadata). Returns ({file_path: (metadata, summary)},
+        {file_path: error}); entries missing from the answer or malformed are analyzed on their own with
+        analyze_file, and files whose analysis failed there too are only in the errors."""
+        static_by_path = {}
+        for file_path, file_content, static_metadata in files:
+            static_by_path[file_path] = static_metadata if static_metadata is not None else extract_static_metadata(file_content, file_path)
+        results = {}
+        errors = {}
+        
+        def analyze_individually(file_path, file_content):
+            try:
+                results[file_path] = self.analyze_file(file_content, file_path, static_by_path[file_path])
+            except FileAnalysisError as e:
+                errors[file_path] = str(e)
+        
+        if len(files) == 1 or FILE_ANALYSIS_MODE == 'separate':
+            for file_path, file_content, _ in files:
+                analyze_individually(file_path, file_content)
+            return results, errors
+        
+        file_sections = "\n\n".join(f"File: {file_path}\n```\n{file_content}\n```" for file_path, file_content, _ in files)
+        prompt = f"""Analyze each of these {len(files)} code files for developers who are new to the codebase.
+
+{file_sections}
+
+Return ONLY a JSON array with one object per file, in the same order:
+[{{"path": "<file path>", "metadata": {{...}}, "summary": "..."}}, ...]
+
+metadata has these fields:
+{self.metadata_fields_prompt(all(static is not None for static in static_by_path.values()))}
+
+summary is 2-5 sentences on what the file does, how it fits into the application and anything a new developer should know.
+
+Return only valid JSON, no other text."""
+
+        try:
+            response = self.call_llm([{"role": "user", "content": prompt}],
+                                     max_tokens=LLM_MAX_OUTPUT_TOKENS + BATCH_OUTPUT_TOKENS_PER_FILE * len(files))
+            for entry in iter_json_objects(response):
+                file_path = entry.get('path')
+                if file_path in static_by_path and file_path not in results:
+                    analysis = self.parse_file_analysis(entry, static_by_path[file_path])
+                    if analysis:
+                        results[file_path] = analysis
+        except Exception as e:
+            print(f"Error analyzing batch of {len(files)} files: {str(e)}")
+        
+        missing = [(file_path, file_content) for file_path, file_content, _ in files if file_path not in results]
+        if missing:
+            print(f"Batched analysis returned no usable entry for {len(missing)} of {len(files)} files, analyzing them individually")
+        for file_path, file_content in missing:
+            analyze_individually(file_path, file_content)
+        return results, errors
+
+    def file_record(self, file_content, metadata, summary, blob_sha):
+        return {
+            'content': file_content[:1000000],  # Store first 1000000 chars
+            'metadata': metadata,
+            'summary': summary,
+            'size': len(file_content),
+            'blob_sha': blob_sha,
+            'processed_at': datetime.now().isoformat()
+        }
+
+    def process_file(self, owner, repo, file_path, file_content=None, pat_token=None, static_metadata=None, cache_stats=None, blob_sha=None,
+                     file_filter=None, content_skipped=None, cache_scope=None):
+        """Fetch (unless already downloaded), analyze and summarize one file.
+
+        Analyses are looked up by git blob SHA and path within cache_scope first (see analysis_scope), so
+        files seen before cost no LLM calls; without a scope the analysis cache is not used.
+        Returns the stored file record, or None if the file has no text content or its content is skipped
+        by file_filter (recorded by path in content_skipped). A failed analysis raises FileAnalysisError and is not cached,
+        so the caller records the file as failed and retries it."""
+        if file_content is None:
+            file_content = self.get_file_content(owner, repo, file_path, pat_token)
+            reason = file_filter.content_skip_reason(file_content) if file_filter and file_content else None
+            if reason:
+                if content_skipped is not None:
+                    content_skipped[file_path] = reason
+                return None
+        if not file_content:
+            return None
+        
+        # Prefer the SHA from the Git tree so refreshes compare like with like
+        blob_sha = blob_sha or git_blob_sha(file_content)
+        cached = analysis_cache.get(blob_sha, file_path, cache_scope, cache_stats) if cache_scope else None
+        if cached:
+            metadata, summary = cached['metadata'], cached['summary']
+        else:
+            metadata, summary = self.analyze_file(file_content, file_path, static_metadata)
+            if cache_scope:
+                analysis_cache.put(blob_sha, file_path, cache_scope, metadata, summary)
+        
+        return self.file_record(file_content, metadata, summary, blob_sha)
+
+    def process_files_batch(self, files, cache_stats=None, cache_scope=None):
+        """Analyze already-downloaded small files together, returning ({file_path: file record}, {file_path: error}).
+
+        files is a list of (file_path, file_content, static_metadata, blob_sha); analyses cached within
+        cache_scope are used first and only the remaining files share an LLM call. Failed analyses are not cached."""
+        records = {}
+        uncached = []
+        for file_path, file_content, static_metadata, blob_sha in files:
+            if not file_content:
+                records[file_path] = None
+                continue
+            blob_sha = blob_sha or git_blob_sha(file_content)
+            cached = analysis_cache.get(blob_sha, file_path, cache_scope, cache_stats) if cache_scope else None
+            if cached:
+                records[file_path] = self.file_record(file_content, cached['metadata'], cached['summary'], blob_sha)
+            else:
+                uncached.append((file_path, file_content, static_metadata, blob_sha))
+        
+        errors = {}
+        if uncached:
+            analyses, errors = self.analyze_files_batch([(file_path, file_content, static_metadata) for file_path, file_content, static_metadata, _ in uncached])
+            for file_path, file_content, _, blob_sha in uncached:
+                if file_path not in analyses:
+                    continue
+                metadata, summary = analyses[file_path]
+                if cache_scope:
+                    analysis_cache.put(blob_sha, file_path, cache_scope, metadata, summary)
+                records[file_path] = self.file_record(file_content, metadata, summary, blob_sha)
+        return records, errors
 
     def generate_common_questions(self, repo_data):
         """Generate common Q&A pairs for the repository"""
@@ -357,80 +2733,899 @@ Focus on practical questions about:
 Return only valid JSON array, no other text."""
 
         try:
-            response = self.call_llm([{"role": "user", "content": prompt}])
-            json_match = re.search(r'\[.*\]', response, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                return []
-        except Exception as e:
-            print(f"Error generating common questions: {str(e)}")
-            return []
-
-    def analyze_repository_structure(self, structure, owner, repo):
-        """Analyze overall repository structure using LLM"""
-        structure_text = json.dumps(structure, indent=2)[:1000000]  # Limit size
+            response = self.call_llm([{"role": "user", "content": prompt}])
+            json_match = re.search(r'\[.*\]', response, re.DOTALL)
+            if json_match:
+                return json.loads(json_match.group())
+            else:
+                return []
+        except Exception as e:
+            print(f"Error generating common questions: {str(e)}")
+            return []
+
+    def analyze_repository_structure(self, structure, owner, repo):
+        """Analyze overall repository structure using LLM"""
+        # Render the tree as an indented listing; deeper entries are dropped first when it doesn't fit
+        builder = PromptBuilder(PROMPT_TOKEN_BUDGET // 2)
+        def add_items(items, depth):
+            for item in items:
+                if item['type'] == 'dir':
+                    builder.add(f"{'  ' * depth}{item['name']}/", priority=depth, label=item['path'])
+                    add_items(item.get('children', []), depth + 1)
+                else:
+                    builder.add(f"{'  ' * depth}{item['name']} ({item.get('size', 0)} bytes)", priority=depth, label=item['path'])
+        add_items(structure, 0)
+        structure_text, report = builder.build()
+        if report['dropped']:
+            structure_text += f"\n... {len(report['dropped'])} deeper entries omitted"
+        
+        prompt = f"""Analyze this repository structure and provide insights:
+
+Repository: {owner}/{repo}
+Structure:
+{structure_text}
+
+Provide analysis in JSON format with these fields:
+- architecture_type: Type of application (web app, library, microservice, etc.)
+- main_technologies: List of main programming languages/frameworks identified
+- project_structure: Description of how the project is organized
+- entry_points: Likely main files where execution starts
+- build_system: Build tools or package managers detected
+- testing_approach: Testing files/frameworks found
+- documentation_files: README, docs, or other documentation found
+- key_directories: Important directories and their purposes
+
+Return only valid JSON, no other text."""
+
+        try:
+            response = self.call_llm([{"role": "user", "content": prompt}])
+            json_match = re.search(r'\{.*\}', response, re.DOTALL)
+            if json_match:
+                return json.loads(json_match.group())
+            else:
+                return {"error": "Failed to parse structure analysis"}
+        except Exception as e:
+            print(f"Error analyzing repository structure: {str(e)}")
+            return {"error": f"Structure analysis failed: {str(e)}"}
+
+processor = RepositoryProcessor()
+
+def emit_progress(data):
+    """Emit progress data as Server-Sent Events"""
+    return f"data: {json.dumps(data)}\n\n"
+
+# Background processing jobs. /process-repo only validates and enqueues; a local worker pool runs
+# the pipeline, so a closed tab or proxy timeout no longer stops processing, and state is persisted
+# in the 'jobs' collection so any server process can report on it.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_ACTIVE_STATUSES = ['queued', 'running']
+# A queued/running job whose heartbeat is older than this was lost with its process
+JOB_STALE_SECONDS = 600
+# The owning process refreshes the heartbeat of its queued and running jobs this often
+JOB_HEARTBEAT_SECONDS = 60
+# Job documents are written at most this often while progress events stream in
+JOB_PERSIST_INTERVAL_SECONDS = 2
+JOB_LOG_LINES = 50
+JOB_RETENTION_SECONDS = 3600
+JOB_POLL_SECONDS = 2
+
+class Job:
+    """In-memory side of a job: the full event list and a condition subscribers wait on"""
+    def __init__(self, job_id, key, params):
+        self.job_id = job_id
+        self.key = key
+        self.params = params  # includes the PAT, which is never persisted
+        self.events = []
+        self.status = 'queued'
+        self.finished_at = None
+        self.last_persist = 0.0
+        self.condition = threading.Condition()
+
+class JobManager:
+    """Runs repository processing jobs on a local worker pool with a persisted state machine:
+    queued -> running -> done | failed. Concurrent submissions for the same repository
+    (same owner/repo, or same user for private repositories) share one job."""
+    def __init__(self, workers=JOB_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='job')
+        self.jobs = {}
+        self.active = {}  # dedup key -> job_id
+        # Guards jobs and active only; Firestore calls are made outside it
+        self.lock = threading.Lock()
+        self.heartbeat_thread = None
+    
+    def job_ref(self, job_id):
+        return db.collection('jobs').document(job_id)
+    
+    def dedup_key(self, owner, repo, uid, is_private):
+        repo_key = f"{owner}/{repo}".lower()
+        # Private repositories are only ever shared with the same user
+        return f"{uid}:{repo_key}" if is_private else repo_key
+    
+    def submit(self, owner, repo, repo_id, github_url, uid, is_private=False, pat_token=None, refresh=False):
+        """Enqueue a job, or join the running one for the same repository; returns (job_id, joined)"""
+        key = self.dedup_key(owner, repo, uid, is_private)
+        with self.lock:
+            self.prune()
+            job_id = self.active.get(key)
+        job_id = job_id or self.find_remote_job(key)
+        if job_id:
+            self.join(job_id, uid, repo_id)
+            return job_id, True
+        
+        job_id = str(uuid.uuid4())
+        now = datetime.now().isoformat()
+        self.job_ref(job_id).set({
+            'job_id': job_id,
+            'key': key,
+            'owner': owner,
+            'repo': repo,
+            'github_url': github_url,
+            'is_private': is_private,
+            'repo_id': repo_id,
+            'uids': [uid],
+            'repo_ids': {uid: repo_id},
+            'status': 'queued',
+            'queryable': False,
+            'progress': 0,
+            'status_text': 'Queued',
+            'log': [],
+            'log_count': 0,
+            'error': None,
+            'created_at': now,
+            'heartbeat_at': time.time(),
+        })
+        job = Job(job_id, key, {
+            'owner': owner, 'repo': repo, 'repo_id': repo_id, 'github_url': github_url, 'uid': uid,
+            'is_private': is_private, 'pat_token': pat_token, 'refresh': refresh,
+        })
+        with self.lock:
+            # Another submission for the same repository may have registered its job meanwhile
+            existing_job_id = self.active.get(key)
+            if existing_job_id is None:
+                self.jobs[job_id] = job
+                self.active[key] = job_id
+                self._start_heartbeat()
+        if existing_job_id:
+            self.job_ref(job_id).delete()
+            self.join(existing_job_id, uid, repo_id)
+            return existing_job_id, True
+        self.executor.submit(self.run, job)
+        return job_id, False
+    
+    def join(self, job_id, uid, repo_id):
+        """Record a user joining a job so the finished repository is shared with them too"""
+        self.job_ref(job_id).update({'uids': firestore.ArrayUnion([uid]), f'repo_ids.{uid}': repo_id})
+        # Once the first files are queryable, the joining user gets the partial snapshot right away
+        job_data = self.job_ref(job_id).get().to_dict() or {}
+        if job_data.get('queryable'):
+            try:
+                grant_access(uid, repo_id, load_repository_header(resolve_snapshot(job_data['uids'][0], job_data['repo_id'])))
+            except Exception as e:
+                print(f"Error sharing the partial result of job {job_id}: {str(e)}")
+    
+    def _start_heartbeat(self):
+        if self.heartbeat_thread is None:
+            self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True)
+            self.heartbeat_thread.start()
+    
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                self.heartbeat()
+            except Exception as e:
+                print(f"Error refreshing job heartbeats: {str(e)}")
+    
+    def heartbeat(self):
+        """Refresh heartbeat_at of this process's queued and running jobs, which may go minutes
+        without a persisted event, so other processes don't report them as lost"""
+        with self.lock:
+            job_ids = [job_id for job_id, job in self.jobs.items() if job.status in JOB_ACTIVE_STATUSES]
+        if not job_ids:
+            return
+        writer = BatchWriter()
+        now = time.time()
+        for job_id in job_ids:
+            writer.update(self.job_ref(job_id), {'heartbeat_at': now})
+        writer.commit()
+    
+    def find_remote_job(self, key):
+        """An active job for the key started by another server process, if its heartbeat is fresh"""
+        query = db.collection('jobs').where('key', '==', key).where('status', 'in', JOB_ACTIVE_STATUSES)
+        for doc in query.stream():
+            if time.time() - (doc.get('heartbeat_at') or 0) < JOB_STALE_SECONDS:
+                return doc.id
+        return None
+    
+    def prune(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished_at and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+    
+    def run(self, job):
+        self.publish(job, {"status_text": "Running"}, status='running', extra={'started_at': datetime.now().isoformat()})
+        final_event = {"error": "Processing ended without a result"}
+        try:
+            for event in process_repository_events(**job.params):
+                if event.get('error') or event.get('complete'):
+                    final_event = event
+                    break
+                if event.get('queryable'):
+                    # Users who joined so far get the partial snapshot too; later joiners get it on submit
+                    try:
+                        self.job_ref(job.job_id).update({'queryable': True})
+                        self.share_with_joiners(job, job.params['repo_id'], partial=True)
+                    except Exception as e:
+                        print(f"Error sharing the partial result of job {job.job_id}: {str(e)}")
+                self.publish(job, event)
+        except Exception as e:
+            final_event = {"error": f"Unexpected error: {str(e)}"}
+        
+        # Stop accepting joiners, then share the result with everyone who joined
+        with self.lock:
+            if self.active.get(job.key) == job.job_id:
+                del self.active[job.key]
+        if final_event.get('complete'):
+            try:
+                self.share_with_joiners(job, job.params['repo_id'])
+            except Exception as e:
+                print(f"Error sharing job {job.job_id} result: {str(e)}")
+        status = 'failed' if final_event.get('error') else 'done'
+        if status == 'failed':
+            for uid in (self.job_ref(job.job_id).get().to_dict() or {}).get('repo_ids', {job.params['uid']: None}):
+                quota.refund(uid, 'repo')
+        job.finished_at = time.time()
+        self.publish(job, final_event, status=status, extra={'finished_at': datetime.now().isoformat(), 'error': final_event.get('error')})
+    
+    def share_with_joiners(self, job, repo_id, partial=False):
+        """Give every user who joined the job access to the snapshot, finished or partial"""
+        job_data = self.job_ref(job.job_id).get().to_dict() or {}
+        joiners = {uid: joined_repo_id for uid, joined_repo_id in job_data.get('repo_ids', {}).items() if uid != job.params['uid']}
+        if not joiners:
+            return
+        snapshot = load_repository_header(resolve_snapshot(job.params['uid'], repo_id))
+        for uid, joined_repo_id in joiners.items():
+            grant_access(uid, joined_repo_id, snapshot)
+        if partial:
+            self.publish(job, {"log": f"🤝 Shared the files analyzed so far with {len(joiners)} other user(s)"})
+        else:
+            self.publish(job, {"log": f"🤝 Shared the result with {len(joiners)} other user(s)"})
+    
+    def publish(self, job, event, status=None, extra=None):
+        """Record an event for subscribers and persist the job state, throttled for plain progress"""
+        with job.condition:
+            if status:
+                job.status = status
+            job.events.append(event)
+            job.condition.notify_all()
+        
+        now = time.time()
+        if status or now - job.last_persist >= JOB_PERSIST_INTERVAL_SECONDS:
+            job.last_persist = now
+            logs = [e['log'] for e in job.events if e.get('log')]
+            update = {'status': job.status, 'heartbeat_at': now, 'log': logs[-JOB_LOG_LINES:], 'log_count': len(logs)}
+            for e in reversed(job.events):
+                if 'progress' in e:
+                    update['progress'] = e['progress']
+                    break
+            for e in reversed(job.events):
+                if e.get('status'):
+                    update['status_text'] = e['status']
+                    break
+            update.update(extra or {})
+            try:
+                self.job_ref(job.job_id).update(update)
+            except Exception as e:
+                print(f"Error persisting job {job.job_id}: {str(e)}")
+    
+    def status(self, job_id):
+        """The persisted job state; active jobs whose process died are reported as failed"""
+        job_doc = self.job_ref(job_id).get()
+        if not job_doc.exists:
+            return None
+        job_data = job_doc.to_dict()
+        if (job_data['status'] in JOB_ACTIVE_STATUSES and job_id not in self.jobs
+                and time.time() - (job_data.get('heartbeat_at') or 0) > JOB_STALE_SECONDS):
+            job_data.update({'status': 'failed', 'error': 'Processing was interrupted. Please submit the repository again.'})
+            self.job_ref(job_id).update({'status': 'failed', 'error': job_data['error']})
+        return job_data
+    
+    def subscribe(self, job_id, after=0):
+        """Yield (index, event) from position `after` until the job finishes.
+
+        Jobs running in this process stream every event; jobs owned by another process are
+        followed by polling their persisted state."""
+        job = self.jobs.get(job_id)
+        if job is None:
+            yield from self.poll(job_id)
+            return
+        index = after
+        while True:
+            with job.condition:
+                while index >= len(job.events) and job.status in JOB_ACTIVE_STATUSES:
+                    job.condition.wait(timeout=15)
+                    if index >= len(job.events):
+                        break
+                events = job.events[index:]
+                finished = job.status not in JOB_ACTIVE_STATUSES
+            for event in events:
+                index += 1
+                yield index, event
+            if finished and index >= len(job.events):
+                return
+            if not events:
+                yield index, None  # keep-alive
+    
+    def poll(self, job_id):
+        seen_logs = 0
+        while True:
+            job_data = self.status(job_id)
+            if job_data is None:
+                yield 0, {"error": "Job not found"}
+                return
+            # Only the last JOB_LOG_LINES lines are persisted
+            log_count = job_data.get('log_count', 0)
+            for line in job_data.get('log', [])[-(log_count - seen_logs):] if log_count > seen_logs else []:
+                yield 0, {"log": line}
+            seen_logs = log_count
+            if job_data['status'] == 'done':
+                yield 0, {"progress": 100, "status": job_data.get('status_text'), "repo_id": job_data.get('repo_id'), "complete": True}
+                return
+            if job_data['status'] == 'failed':
+                yield 0, {"error": job_data.get('error')}
+                return
+            yield 0, {"progress": job_data.get('progress', 0), "status": job_data.get('status_text')}
+            time.sleep(JOB_POLL_SECONDS)
+
+job_manager = JobManager()
+
+# Files are analyzed most useful first. After the first tier the snapshot is saved as partial, so
+# questions can be answered while the rest is analyzed.
+PRIORITY_FIRST_TIER_FILES = int(os.environ.get("PRIORITY_FIRST_TIER_FILES", 25))
+# Optional limits on one processing run (0 = unlimited); files left over are analyzed on the next refresh
+PROCESSING_TIME_BUDGET_SECONDS = float(os.environ.get("PROCESSING_TIME_BUDGET_SECONDS", 0))
+PROCESSING_TOKEN_BUDGET = int(os.environ.get("PROCESSING_TOKEN_BUDGET", 0))
+# Files touched by this many recent commits rank higher (0 skips the extra GitHub calls)
+RECENT_COMMITS_FOR_RANKING = 5
+PRIORITY_FILE_NAMES = {
+    'readme.md', 'readme.rst', 'readme.txt', 'readme', 'setup.py', 'setup.cfg', 'pyproject.toml',
+    'requirements.txt', 'package.json', 'cargo.toml', 'go.mod', 'pom.xml', 'build.gradle', 'gemfile',
+    'dockerfile', 'docker-compose.yml', 'makefile', 'tsconfig.json', 'manage.py', 'settings.py'
+}
+
+def rank_files(file_paths, structure_summary=None, static_metadata=None, file_sizes=None, recently_changed=None):
+    """Order files by expected value for answering questions, most useful first.
+
+    Signals: entry points named by the architecture analysis, READMEs and build/config files, how
+    many other files import the file (from the static extractors), recent changes, depth and size."""
+    static_metadata = static_metadata or {}
+    file_sizes = file_sizes or {}
+    recently_changed = recently_changed or set()
+    entry_points = [str(entry).lower() for entry in (structure_summary or {}).get('entry_points', []) or []]
+    
+    # Import fan-in: match imported module names against dotted paths and file stems
+    modules = {}
+    for file_path in file_paths:
+        stem = os.path.splitext(file_path)[0]
+        if stem.endswith('/__init__') or stem.endswith('/index'):
+            stem = stem.rsplit('/', 1)[0]  # a package is imported by its directory name
+        for name in {stem.replace('/', '.'), stem.rsplit('/', 1)[-1]}:
+            modules.setdefault(name.lower(), []).append(file_path)
+    fan_in = {}
+    for file_path in file_paths:
+        for imported in (static_metadata.get(file_path) or {}).get('imports', []) or []:
+            imported = str(imported).lower().lstrip('.')
+            for target in modules.get(imported, modules.get(imported.rsplit('.', 1)[-1], [])):
+                if target != file_path:
+                    fan_in[target] = fan_in.get(target, 0) + 1
+    
+    def score(file_path):
+        lower_path = file_path.lower()
+        name = lower_path.rsplit('/', 1)[-1]
+        value = 0.0
+        if any(entry == lower_path or entry == name or lower_path in entry for entry in entry_points):
+            value += 100
+        if name in PRIORITY_FILE_NAMES:
+            value += 60
+        value += 10 * math.log2(1 + fan_in.get(file_path, 0))
+        if file_path in recently_changed:
+            value += 20
+        value -= 2 * lower_path.count('/')
+        value -= min(file_sizes.get(file_path, 0) / 20000, 20)
+        return value
+    
+    return sorted(file_paths, key=lambda file_path: (-score(file_path), file_path))
+
+def process_repository_events(owner, repo, repo_id, github_url, uid, is_private=False, pat_token=None, refresh=False):
+    """Fetch, analyze, index and save a repository snapshot for the user's repo_id, yielding progress
+    events as dicts. Unchanged files are carried over from the user's previous snapshot or, for public
+    repositories, the latest snapshot anyone processed.
+
+    Ends with an event carrying "complete" or "error"; run by the job workers, not the request."""
+    run_started_at = time.time()
+    stages = StageTimer('processing')
+    try:
+        stages.start('load_previous')
+        access = load_access(uid, repo_id)
+        previous_snapshot_id = access['snapshot_id'] if access else resolve_snapshot(uid, repo_id)
+        # Users who can already query a finished snapshot keep it until this run completes
+        publish_partial = previous_snapshot_id is None or bool(access and access.get('partial'))
+        if previous_snapshot_id is None and not is_private:
+            latest = public_repository_ref(owner, repo).get()
+            previous_snapshot_id = latest.get('snapshot_id') if latest.exists else None
+        previous_repo_data = load_repository_header(previous_snapshot_id) if previous_snapshot_id else None
+        if previous_repo_data and previous_repo_data.get('partial'):
+            # An unfinished run is resumed from its checkpoint rather than diffed against
+            previous_snapshot_id, previous_repo_data = None, None
+        
+        # Get repository structure
+        stages.start('fetch_tree')
+        yield {"progress": 10, "status": "Fetching repository structure", "log": "🔍 Analyzing repository structure..."}
+        try:
+            commit_sha = None
+            if USE_GIT_TREES_API:
+                structure, commit_sha = processor.get_repository_tree(owner, repo, pat_token=pat_token)
+            else:
+                structure = processor.get_repository_structure(owner, repo, pat_token=pat_token)
+            if not structure:
+                yield {"error": "Repository not found or is empty. Check URL and PAT if private."}
+                return
+            yield {"progress": 20, "status": "Repository structure fetched", "log": f"📊 Found {len(structure)} top-level items"}
+        except Exception as e:
+            yield {"error": f"Failed to fetch repository structure: {str(e)}. Ensure the URL is correct and PAT is valid for private repos."}
+            return
+        
+        # Reuse the snapshot of this commit if it was already processed, by this user or anyone for public repositories
+        snapshot_id = snapshot_id_for(owner, repo, commit_sha, uid, is_private)
+        snapshot = load_repository_header(snapshot_id) if commit_sha else None
+        if snapshot and not snapshot.get('partial'):
+            if not (refresh and snapshot_incomplete(snapshot)):
+                grant_access(uid, repo_id, snapshot)
+                yield {"progress": 100, "status": "Repository already up to date", "log": f"✅ Using the existing analysis of {owner}/{repo}@{commit_sha[:7]}", "repo_id": repo_id, "complete": True}
+                return
+            # Refreshing the same commit completes it in place: only the deferred and failed files are missing from it
+            previous_snapshot_id, previous_repo_data = snapshot_id, snapshot
+            yield {"log": f"⏯️ Continuing {owner}/{repo}@{commit_sha[:7]}: {len(snapshot.get('deferred_files', []))} deferred and {len(snapshot.get('failed_files', []))} failed files"}
+        # Commit-less snapshots are rewritten in place; a new commit gets a new snapshot that shares unchanged files
+        in_place = snapshot_id == previous_snapshot_id
+        
+        # Collect processable files along with their blob SHAs from the tree
+        stages.start('collect_files')
+        yield {"progress": 25, "status": "Identifying code files", "log": "📁 Collecting code files for analysis..."}
+        # Vendored, generated and oversized files are dropped before anything is downloaded
+        file_filter = processor.load_file_filter(owner, repo, structure, pat_token)
+        skipped = file_filter.apply(structure)
+        if skipped:
+            yield {"log": f"🧹 Skipping {sum(skipped.values())} files ({describe_skipped(skipped)})", "skipped": skipped}
+        processable_files = []
+        file_shas = {}
+        file_sizes = {}
+        
+        def collect_files(items, path_prefix=""):
+            for item in items:
+                if item['type'] == 'file' and item.get('processable'):
+                    processable_files.append(item['path'])
+                    file_sizes[item['path']] = item.get('size', 0)
+                    if item.get('sha'):
+                        file_shas[item['path']] = item['sha']
+                elif item['type'] == 'dir' and 'children' in item:
+                    collect_files(item['children'], item['path'] + "/")
+        
+        collect_files(structure)
+        
+        # Resume an interrupted run of the same commit: files it already analyzed were checkpointed
+        resumed = {}
+        manifest = load_manifest(snapshot_id)
+        if manifest and manifest.get('status') == 'in_progress' and manifest.get('commit_sha') == commit_sha:
+            checkpointed_records = load_file_records(snapshot_id, {})
+            resumed = {
+                path: checkpointed_records[path] for path in manifest.get('done', [])
+                if path in checkpointed_records and path in file_shas and checkpointed_records[path].get('blob_sha') == file_shas[path]
+            }
+            if resumed:
+                yield {"log": f"⏯️ Resuming an interrupted run: {len(resumed)} files were already analyzed"}
+        else:
+            manifest = None
+        
+        # On refresh, diff the new tree against the stored blob SHAs and keep unchanged files as they are
+        files_to_process = processable_files
+        processed_files = {}
+        files_to_save = []
+        files_to_index = []  # files whose search and vector index entries must be (re)built
+        deleted_records = {}
+        deleted = []
+        file_sources = {}  # unchanged files stored by an earlier snapshot -> that snapshot's id
+        content_skipped = {}  # files skipped for their downloaded content -> reason
+        structure_changed = True
+        if previous_repo_data:
+            previous_files = load_file_records(previous_snapshot_id, previous_repo_data)
+            previous_shas = {path: record.get('blob_sha') for path, record in previous_files.items()}
+            for path in resumed:
+                # Checkpointed files already carry the new SHA but are not in the saved indexes yet
+                previous_shas[path] = None
+            # Unchanged blobs that were skipped for their content last time are skipped again without downloading them
+            if file_filter.skip_minified:
+                content_skipped = {
+                    path: entry['reason'] for path, entry in previous_repo_data.get('content_skipped_files', {}).items()
+                    if path in file_shas and entry.get('blob_sha') == file_shas[path]
+                }
+                if content_skipped:
+                    remembered = {}
+                    for reason in content_skipped.values():
+                        remembered[reason] = remembered.get(reason, 0) + 1
+                    skipped = count_skipped(skipped, remembered)
+                    yield {"log": f"🧹 Skipping {len(content_skipped)} unchanged files skipped last time ({describe_skipped(remembered)})", "skipped": skipped}
+            files_to_process = [
+                path for path in processable_files
+                if (path not in file_shas or previous_shas.get(path) != file_shas[path]) and path not in content_skipped
+            ]
+            processed_files = {
+                path: record for path, record in previous_files.items()
+                if path in file_shas and path not in files_to_process
+            }
+            added = [path for path in files_to_process if path not in previous_shas]
+            deleted = [path for path in previous_shas if path not in file_shas]
+            if in_place:
+                deleted_records = {path: previous_files[path] for path in deleted}
+            if 'files' not in previous_repo_data and (in_place or previous_repo_data.get('commit_sha')):
+                # Unchanged files keep their documents: the snapshot's own, or those of the snapshot storing them.
+                # Snapshots of a commit are never rewritten except to add files, so sharing their documents is safe.
+                previous_sources = load_file_sources(previous_snapshot_id, previous_repo_data)
+                file_sources = {
+                    path: previous_sources.get(path, previous_snapshot_id) for path in processed_files
+                    if not in_place or path in previous_sources
+                }
+            else:
+                # Unchanged files are copied into the new snapshot: a pre-sharding repository gets its own
+                # documents, and a commit-less snapshot may be rewritten in place, so it is not shared
+                if 'files' not in previous_repo_data:
+                    contents = load_file_contents(previous_snapshot_id, list(processed_files), previous_repo_data)
+                    processed_files = {path: dict(strip_listing_fields(record), content=contents.get(path, ''))
+                                       for path, record in processed_files.items()}
+                files_to_save.extend(processed_files)
+            previous_top_level = {item['name'] for item in load_structure(previous_snapshot_id, previous_repo_data)}
+            structure_changed = (
+                {item['name'] for item in structure} != previous_top_level
+                or (len(added) + len(deleted)) / max(len(processable_files), 1) > STRUCTURE_REFRESH_THRESHOLD
+            )
+            yield {"log": f"🔁 {len(added)} added, {len(files_to_process) - len(added)} modified, {len(deleted)} deleted, {len(processed_files)} unchanged"}
+        
+        # Analyze overall structure
+        stages.start('architecture')
+        if structure_changed:
+            yield {"progress": 30, "status": "Analyzing repository architecture", "log": "🏗️ Analyzing overall architecture..."}
+            structure_summary = processor.analyze_repository_structure(structure, owner, repo)
+        else:
+            structure_summary = previous_repo_data.get('structure_summary', {})
+        
+        # Checkpointed files are loaded back instead of being analyzed again
+        stages.start('resume')
+        files_to_analyze = [path for path in files_to_process if path not in resumed]
+        checkpointed = set(resumed)
+        if resumed:
+            contents = load_file_contents(snapshot_id, list(resumed))
+            for path, record in resumed.items():
+                processed_files[path] = dict(strip_listing_fields(record), content=contents.get(path, ''))
+                files_to_save.append(path)
+                files_to_index.append(path)
+        checkpoint = ProcessingCheckpoint(snapshot_id, commit_sha, files_to_analyze, manifest)
+        
+        # Removed the 50-file limit to allow processing of all identified files.
+        # This ensures that all relevant files are available for AI context.
+        yield {"progress": 40, "status": f"Processing {len(files_to_analyze)} files", "log": f"🔄 Starting analysis of {len(files_to_analyze)} code files..."}
+        
+        # Download all file contents in one archive request, falling back to per-file fetches
+        stages.start('download')
+        archive_contents = None
+        if USE_ARCHIVE_DOWNLOAD and len(files_to_analyze) >= ARCHIVE_DOWNLOAD_MIN_FILES:
+            yield {"progress": 40, "status": "Downloading repository archive", "log": "📦 Downloading repository archive..."}
+            try:
+                archive_contents = {}
+                wanted_paths = set(files_to_analyze)
+                for file_path, raw_content in processor.iter_archive_files(owner, repo, commit_sha or "HEAD", pat_token, wanted_paths):
+                    archive_contents[file_path] = processor.decode_file_content(raw_content)
+                yield {"log": f"📦 Downloaded {len(archive_contents)} files in one archive"}
+                
+                # Minified and generated-looking contents are not worth an LLM call
+                archive_skipped = {}
+                for file_path, file_content in list(archive_contents.items()):
+                    reason = file_filter.content_skip_reason(file_content) if file_content else None
+                    if reason:
+                        del archive_contents[file_path]
+                        files_to_analyze.remove(file_path)
+                        content_skipped[file_path] = reason
+                        archive_skipped[reason] = archive_skipped.get(reason, 0) + 1
+                if archive_skipped:
+                    skipped = count_skipped(skipped, archive_skipped)
+                    yield {"log": f"🧹 Skipping {sum(archive_skipped.values())} downloaded files ({describe_skipped(archive_skipped)})", "skipped": skipped}
+            except Exception as e:
+                archive_contents = None
+                yield {"log": f"⚠️ Archive download failed ({str(e)}), fetching files individually"}
+        
+        # Extract functions/classes/imports locally, in a process pool for large repositories
+        stages.start('static_analysis')
+        static_metadata = {}
+        if archive_contents and len(archive_contents) >= STATIC_ANALYSIS_POOL_THRESHOLD:
+            yield {"log": f"🧮 Extracting code structure from {len(archive_contents)} files..."}
+            static_metadata = extract_static_metadata_bulk(archive_contents)
+        elif archive_contents:
+            static_metadata = {path: extract_static_metadata(content, path) for path, content in archive_contents.items()}
+        
+        # Analyze the most useful files first; the first tier is saved as a partial snapshot users can query
+        stages.start('ranking')
+        recently_changed = set()
+        if RECENT_COMMITS_FOR_RANKING and commit_sha and files_to_analyze:
+            try:
+                recently_changed = processor.get_recently_changed_paths(owner, repo, commit_sha, pat_token, RECENT_COMMITS_FOR_RANKING)
+            except Exception as e:
+                print(f"Could not fetch recent commits for {owner}/{repo}: {str(e)}")
+        files_to_analyze = rank_files(files_to_analyze, structure_summary, static_metadata, file_sizes, recently_changed)
+        first_tier = set()
+        if publish_partial and not in_place and len(files_to_analyze) > PRIORITY_FIRST_TIER_FILES:
+            first_tier = set(files_to_analyze[:PRIORITY_FIRST_TIER_FILES])
+        if files_to_analyze:
+            yield {"log": f"🎯 Analyzing the most relevant files first: {', '.join(files_to_analyze[:3])}"}
+        
+        def snapshot_header(**extra):
+            repo_data = {
+                'repo_id': snapshot_id,
+                'snapshot_key': f"{owner}/{repo}@{commit_sha}" if commit_sha else None,
+                'owner': owner,
+                'repo': repo,
+                'github_url': github_url,
+                'commit_sha': commit_sha,
+                'is_private': is_private, # Store if it's a private repo
+                'structure': structure,
+                'structure_summary': structure_summary,
+                'files': processed_files,
+                'processed_at': datetime.now().isoformat(),
+                'total_files': len(processable_files),
+                'processed_files': len(processed_files),
+                'failed_files': sorted(failures),
+                'deferred_files': sorted(deferred),
+                'skipped_files': skipped,
+                # Blob SHAs of files skipped for their content, so refreshes skip them unchanged without downloading
+                'content_skipped_files': {path: {'blob_sha': file_shas[path], 'reason': reason}
+                                          for path, reason in content_skipped.items() if path in file_shas},
+                'processed_by_uid': uid # Store UID of the user who processed it
+            }
+            repo_data.update(extra)
+            return repo_data
+        
+        def shared_file_sources():
+            """The file_sources blob: shared files that this run did not write a document of its own for"""
+            saved = set(files_to_save)
+            return group_file_sources({path: source_id for path, source_id in file_sources.items()
+                                       if path in processed_files and path not in saved})
+        
+        analyzed_tokens = 0
+        deferred = []
+        budget_exhausted = False
+        
+        def over_budget():
+            if PROCESSING_TIME_BUDGET_SECONDS and time.time() - run_started_at > PROCESSING_TIME_BUDGET_SECONDS:
+                return True
+            return bool(PROCESSING_TOKEN_BUDGET and analyzed_tokens > PROCESSING_TOKEN_BUDGET)
+        
+        # Process files in parallel, queued in priority order; progress is reported in completion order
+        stages.start('analyze_files')
+        cache_stats = {'hits': 0, 'misses': 0}
+        cache_scope = analysis_scope(owner, repo, uid, is_private)
+        fetch_skipped = {}
+        total_files = len(files_to_analyze)
+        completed = 0
+        failures = {}
+        executor = ThreadPoolExecutor(max_workers=max(1, FILE_PROCESSING_CONCURRENCY))
+        try:
+            futures = {}
+            batch, batch_tokens = [], 0
+            for file_path in files_to_analyze:
+                if archive_contents is not None:
+                    # Files missing from the archive are binary or undecodable
+                    file_content = archive_contents.get(file_path)
+                    if file_content is None:
+                        completed += 1
+                        continue
+                else:
+                    file_content = None
+                
+                # Small downloaded files share an LLM call; everything else is analyzed on its own
+                file_tokens = estimate_tokens(file_content) if file_content is not None else None
+                if file_tokens is not None and file_tokens <= BATCH_FILE_MAX_TOKENS:
+                    if batch and (len(batch) >= BATCH_MAX_FILES or batch_tokens + file_tokens > BATCH_PROMPT_TOKEN_BUDGET):
+                        futures[executor.submit(processor.process_files_batch, batch, cache_stats, cache_scope)] = ([entry[0] for entry in batch], True)
+                        batch, batch_tokens = [], 0
+                    batch.append((file_path, file_content, static_metadata.get(file_path), file_shas.get(file_path)))
+                    batch_tokens += file_tokens
+                    continue
+                future = executor.submit(processor.process_file, owner, repo, file_path, file_content, pat_token, static_metadata.get(file_path), cache_stats, file_shas.get(file_path),
+                                         file_filter, fetch_skipped, cache_scope)
+                futures[future] = ([file_path], False)
+            if batch:
+                futures[executor.submit(processor.process_files_batch, batch, cache_stats, cache_scope)] = ([entry[0] for entry in batch], True)
+            
+            for future in as_completed(futures):
+                file_paths, batched = futures[future]
+                if future.cancelled():
+                    # Left for the next refresh because the budget ran out
+                    completed += len(file_paths)
+                    deferred.extend(file_paths)
+                    continue
+                try:
+                    file_records, file_errors = future.result() if batched else ({file_paths[0]: future.result()}, {})
+                except Exception as e:
+                    file_records, file_errors = {}, {file_path: str(e) for file_path in file_paths}
+                for file_path in file_paths:
+                    completed += 1
+                    progress = 40 + (completed / total_files) * 40  # 40-80% for file processing
+                    if file_path in file_errors:
+                        failures[file_path] = file_errors[file_path]
+                        checkpoint.file_failed(file_path)
+                        yield {"progress": progress, "log": f"❌ Error processing {file_path}: {file_errors[file_path]}"}
+                    else:
+                        file_record = file_records.get(file_path)
+                        if file_record:
+                            processed_files[file_path] = file_record
+                            files_to_save.append(file_path)
+                            files_to_index.append(file_path)
+                            checkpoint.file_done(file_path, file_record)
+                            checkpointed.add(file_path)
+                            analyzed_tokens += int(file_record.get('size', 0) / 3.5)
+                        yield {"progress": progress, "status": f"Processed {completed}/{total_files} files", "log": f"📄 Analyzed {file_path}"}
+                
+                # Once the first tier is in, save what exists so far as a partial snapshot that can be queried
+                if first_tier:
+                    first_tier.difference_update(file_paths)
+                    if not first_tier:
+                        checkpoint.flush()
+                        partial_data = snapshot_header(partial=True, common_qa=[])
+                        save_repository(snapshot_id, partial_data, {path: processed_files[path] for path in files_to_save if path not in checkpointed},
+                                        blobs={'bm25': BM25Index.from_file_records(processed_files).to_dict(), 'file_sources': shared_file_sources()})
+                        checkpointed.update(files_to_save)
+                        grant_access(uid, repo_id, partial_data)
+                        yield {"log": f"💬 {len(processed_files)} files are ready, questions can be asked while the rest is analyzed",
+                               "repo_id": repo_id, "queryable": True}
+                
+                if not budget_exhausted and over_budget():
+                    budget_exhausted = True
+                    for pending_future in futures:
+                        pending_future.cancel()
+                    yield {"log": "⏸️ Processing budget reached, remaining files are left for the next refresh"}
+        finally:
+            # Stop queued work if the client disconnects mid-stream
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        # Give failed files a bounded number of further attempts instead of dropping them
+        stages.start('retries')
+        for retry_round in range(PROCESSING_RETRY_ROUNDS):
+            if not failures or over_budget():
+                break
+            yield {"log": f"🔁 Retrying {len(failures)} failed files (pass {retry_round + 1} of {PROCESSING_RETRY_ROUNDS})"}
+            time.sleep(2 ** retry_round)
+            
+            def retry_file(file_path):
+                file_content = archive_contents.get(file_path) if archive_contents is not None else None
+                try:
+                    return file_path, processor.process_file(owner, repo, file_path, file_content, pat_token, static_metadata.get(file_path), cache_stats, file_shas.get(file_path),
+                                                             file_filter, fetch_skipped, cache_scope), None
+                except Exception as e:
+                    return file_path, None, str(e)
+            
+            with ThreadPoolExecutor(max_workers=max(1, FILE_PROCESSING_CONCURRENCY)) as retry_executor:
+                for file_path, file_record, error in retry_executor.map(retry_file, list(failures)):
+                    if error:
+                        failures[file_path] = error
+                        continue
+                    del failures[file_path]
+                    checkpoint.file_recovered(file_path, file_record)
+                    if file_record:
+                        processed_files[file_path] = file_record
+                        files_to_save.append(file_path)
+                        files_to_index.append(file_path)
+                        checkpointed.add(file_path)
+                    yield {"log": f"📄 Analyzed {file_path} on retry"}
+        if failures:
+            yield {"log": f"⚠️ {len(failures)} files could not be analyzed, refresh to retry them: {', '.join(sorted(failures)[:10])}"}
+        if deferred:
+            yield {"log": f"⏸️ {len(deferred)} lower-priority files were not analyzed within the budget; refresh to continue"}
+        if fetch_skipped:
+            content_skipped.update(fetch_skipped)
+            skip_stats = {}
+            for reason in fetch_skipped.values():
+                skip_stats[reason] = skip_stats.get(reason, 0) + 1
+            skipped = count_skipped(skipped, skip_stats)
+            yield {"log": f"🧹 Skipped {sum(skip_stats.values())} fetched files ({describe_skipped(skip_stats)})", "skipped": skipped}
+        checkpoint.flush()
+        
+        if cache_stats['hits']:
+            yield {"log": f"♻️ Reused cached analysis for {cache_stats['hits']} of {cache_stats['hits'] + cache_stats['misses']} files"}
+        
+        # Build the keyword search index, updating the previous one in place on refresh
+        stages.start('search_index')
+        previous_index = None
+        if previous_repo_data and 'files' not in previous_repo_data:
+            previous_index = load_blob(previous_snapshot_id, previous_repo_data, 'bm25')
+        if previous_index is not None:
+            search_index = BM25Index.from_dict(previous_index)
+            search_index.remove_files(set(files_to_process) | set(deleted))
+            for file_path in files_to_index:
+                search_index.add_file(file_path, processed_files[file_path])
+        else:
+            search_index = BM25Index.from_file_records(processed_files)
+        yield {"log": f"🔎 Indexed {len(processed_files)} files ({len(search_index.documents)} search documents)"}
+        
+        yield {"progress": 80, "status": "Generating documentation", "log": "📚 Generating common questions and documentation..."}
+        
+        # Prepare repository data
+        repo_data = snapshot_header()
+        
+        # Embed files and chunks for semantic search, updating the previous index on refresh
+        stages.start('vector_index')
+        vector_index = None
+        if previous_repo_data:
+            vector_index = load_saved_vector_index(previous_snapshot_id, previous_repo_data)
+        if vector_index is not None:
+            vector_index.matrix = np.array(vector_index.matrix)  # copy out of the read-only memory map
+            vector_index.remove_files(set(files_to_process) | set(deleted))
+            vector_index.add_files({file_path: processed_files[file_path] for file_path in files_to_index})
+        else:
+            vector_index = VectorIndex.build(processed_files)
+        try:
+            vector_index.save(vector_index_dir(snapshot_id), repo_data['processed_at'])
+        except OSError as e:
+            # Not fatal: the stored copy is loaded on first use
+            yield {"log": f"⚠️ Could not save vector index: {str(e)}"}
         
-        prompt = f"""Analyze this repository structure and provide insights:
-
-Repository: {owner}/{repo}
-Structure:
-{structure_text}
-
-Provide analysis in JSON format with these fields:
-- architecture_type: Type of application (web app, library, microservice, etc.)
-- main_technologies: List of main programming languages/frameworks identified
-- project_structure: Description of how the project is organized
-- entry_points: Likely main files where execution starts
-- build_system: Build tools or package managers detected
-- testing_approach: Testing files/frameworks found
-- documentation_files: README, docs, or other documentation found
-- key_directories: Important directories and their purposes
-
-Return only valid JSON, no other text."""
-
+        # Generate common Q&A (kept from the previous run when the structure barely changed)
+        stages.start('common_questions')
+        if structure_changed:
+            common_qa = processor.generate_common_questions(repo_data)
+        else:
+            common_qa = previous_repo_data.get('common_qa', [])
+        repo_data['common_qa'] = common_qa
+        
+        yield {"progress": 90, "status": "Saving to database", "log": "💾 Saving processed data to database..."}
+        
+        # Save to Firestore
+        stages.start('save')
         try:
-            response = self.call_llm([{"role": "user", "content": prompt}])
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                return {"error": "Failed to parse structure analysis"}
+            # Files written by the checkpoint are already stored
+            save_repository(snapshot_id, repo_data, {path: processed_files[path] for path in files_to_save if path not in checkpointed},
+                            deleted_records, blobs={'bm25': search_index.to_dict(), 'file_sources': shared_file_sources(),
+                                                    'vectors': vector_index.to_dict(repo_data['processed_at'])})
+            checkpoint.complete(failures)
+            grant_access(uid, repo_id, repo_data)
+            if not is_private and commit_sha:
+                public_repository_ref(owner, repo).set({'snapshot_id': snapshot_id, 'commit_sha': commit_sha, 'processed_at': repo_data['processed_at']})
+            stages.stop()
+            yield {"log": f"⏱️ Time by stage: {stages.describe()}"}
+            yield {"progress": 100, "status": "Processing complete!", "log": "✅ Repository successfully processed and saved!", "repo_id": repo_id, "complete": True}
         except Exception as e:
-            print(f"Error analyzing repository structure: {str(e)}")
-            return {"error": f"Structure analysis failed: {str(e)}"}
-
-processor = RepositoryProcessor()
-
-def emit_progress(data):
-    """Emit progress data as Server-Sent Events"""
-    return f"data: {json.dumps(data)}\n\n"
+            yield {"error": f"Failed to save to database: {str(e)}"}
+            return
+        
+    except Exception as e:
+        yield {"error": f"Unexpected error: {str(e)}"}
+    finally:
+        stages.stop()
 
 @app.route('/process-repo', methods=['POST'])
 def process_repository():
     data = request.get_json()
     github_url = data.get('github_url')
-    uid = data.get('uid') # Get UID from request
-    is_private = data.get('is_private', False)
+    uid = g.uid
+    # The client's flag only asks for a PAT; whether snapshots are shared follows GitHub's answer
+    requested_private = data.get('is_private', False)
     pat_token = data.get('pat_token')
+    refresh = data.get('refresh', False)
 
     def generate():
         try:
-            if not uid:
-                yield emit_progress({"error": "User not authenticated. Please log in."})
-                return
-
-            # Check user limits before processing
-            user_limits = get_user_limits(uid)
-            if user_limits['repos_processed'] >= MAX_REPOS_PER_DAY:
-                yield emit_progress({"error": f"Daily repository processing limit ({MAX_REPOS_PER_DAY}) exceeded. Please try again tomorrow."})
-                return
-
             if not github_url:
                 yield emit_progress({"error": "GitHub URL is required"})
                 return
             
-            if is_private and not pat_token:
+            if requested_private and not pat_token:
                 yield emit_progress({"error": "Personal Access Token is required for private repositories."})
                 return
 
@@ -442,133 +3637,133 @@ def process_repository():
             except ValueError as e:
                 yield emit_progress({"error": str(e)})
                 return
+            is_private = processor.is_private_repository(owner, repo, pat_token)
             
-            # Check if repository already processed
-            repo_doc = db.collection('repositories').document(repo_id).get()
-            if repo_doc.exists:
+            # Check if repository already processed; a refresh re-analyzes only what changed since then.
+            # A partial snapshot means a run is still going (it is joined) or was interrupted (it resumes).
+            existing_snapshot_id = repo_cache.snapshot_id(uid, repo_id)
+            if not refresh and existing_snapshot_id and not (repo_cache.header(existing_snapshot_id) or {}).get('partial'):
                 yield emit_progress({"progress": 100, "status": "Repository already processed", "log": "✅ Repository found in database", "repo_id": repo_id, "complete": True})
                 return
             
-            # Get repository structure
-            yield emit_progress({"progress": 10, "status": "Fetching repository structure", "log": "🔍 Analyzing repository structure..."})
+            # A commit someone already analyzed is shared instantly instead of being processed again
             try:
-                structure = processor.get_repository_structure(owner, repo, pat_token=pat_token)
-                if not structure:
-                    yield emit_progress({"error": "Repository not found or is empty. Check URL and PAT if private."})
-                    return
-                yield emit_progress({"progress": 20, "status": "Repository structure fetched", "log": f"📊 Found {len(structure)} top-level items"})
-            except Exception as e:
-                yield emit_progress({"error": f"Failed to fetch repository structure: {str(e)}. Ensure the URL is correct and PAT is valid for private repos."})
-                return
+                commit_sha = processor.resolve_commit_sha(owner, repo, pat_token=pat_token) if USE_GIT_TREES_API else None
+            except Exception:
+                commit_sha = None  # the job reports GitHub errors
+            head_snapshot_id = snapshot_id_for(owner, repo, commit_sha, uid, is_private) if commit_sha else None
+            snapshot = load_repository_header(head_snapshot_id) if head_snapshot_id else None
+            if snapshot and (snapshot.get('partial') or (refresh and snapshot_incomplete(snapshot))):
+                snapshot = None
             
-            # Analyze overall structure
-            yield emit_progress({"progress": 25, "status": "Analyzing repository architecture", "log": "🏗️ Analyzing overall architecture..."})
-            structure_summary = processor.analyze_repository_structure(structure, owner, repo)
-            
-            # Collect processable files
-            yield emit_progress({"progress": 30, "status": "Identifying code files", "log": "📁 Collecting code files for analysis..."})
-            processable_files = []
-            
-            def collect_files(items, path_prefix=""):
-                for item in items:
-                    if item['type'] == 'file' and item.get('processable'):
-                        processable_files.append(item['path'])
-                    elif item['type'] == 'dir' and 'children' in item:
-                        collect_files(item['children'], item['path'] + "/")
+            # Refreshing a repository whose head is still the analyzed commit costs nothing
+            if snapshot and existing_snapshot_id == head_snapshot_id:
+                yield emit_progress({"progress": 100, "status": "Repository already up to date", "log": f"✅ {owner}/{repo}@{commit_sha[:7]} is already analyzed", "repo_id": repo_id, "complete": True})
+                return
             
-            collect_files(structure)
+            # Count the repository against today's limit; a failed job gives it back
+            if not quota.try_consume(uid, 'repo'):
+                yield emit_progress({"error": f"Daily repository processing limit ({MAX_REPOS_PER_DAY}) exceeded. Please try again tomorrow."})
+                return
+            if snapshot:
+                grant_access(uid, repo_id, snapshot)
+                yield emit_progress({"progress": 100, "status": "Repository already processed", "log": f"✅ Using the existing analysis of {owner}/{repo}@{commit_sha[:7]}", "repo_id": repo_id, "complete": True})
+                return
             
-            # Removed the 50-file limit to allow processing of all identified files.
-            # This ensures that all relevant files are available for AI context.
-            yield emit_progress({"progress": 40, "status": f"Processing {len(processable_files)} files", "log": f"🔄 Starting analysis of {len(processable_files)} code files..."})
+            # Processing runs as a background job; this stream only relays its progress, so closing it
+            # does not stop the job and the client can resubscribe through /job-events
+            try:
+                job_id, joined = job_manager.submit(owner, repo, repo_id, github_url, uid, is_private, pat_token, refresh)
+            except Exception:
+                quota.refund(uid, 'repo')
+                raise
+            if joined:
+                yield emit_progress({"job_id": job_id, "log": "🤝 This repository is already being processed, following that job"})
+            else:
+                yield emit_progress({"job_id": job_id, "log": f"🗂️ Queued processing job {job_id[:8]}"})
             
-            # Process files
-            processed_files = {}
-            for i, file_path in enumerate(processable_files):
-                try:
-                    progress = 40 + (i / len(processable_files)) * 40  # 40-80% for file processing
-                    yield emit_progress({"progress": progress, "status": f"Processing {file_path}", "log": f"📄 Analyzing {file_path}..."})
-                    
-                    # Get file content
-                    file_content = processor.get_file_content(owner, repo, file_path, pat_token)
-                    if not file_content:
-                        continue
-                    
-                    # Analyze metadata
-                    metadata = processor.analyze_file_metadata(file_content, file_path)
-                    
-                    # Generate summary
-                    summary = processor.generate_file_summary(file_content, file_path, metadata)
-                    
-                    processed_files[file_path] = {
-                        'content': file_content[:1000000],  # Store first 1000000 chars
-                        'metadata': metadata,
-                        'summary': summary,
-                        'size': len(file_content),
-                        'processed_at': datetime.now().isoformat()
-                    }
-                    
-                    # Brief pause to prevent rate limiting
-                    time.sleep(0.1)
-                    
-                except Exception as e:
-                    yield emit_progress({"log": f"❌ Error processing {file_path}: {str(e)}"})
+            for _, event in job_manager.subscribe(job_id):
+                if event is None:
+                    yield ": keep-alive\n\n"
                     continue
-            
-            yield emit_progress({"progress": 80, "status": "Generating documentation", "log": "📚 Generating common questions and documentation..."})
-            
-            # Prepare repository data
-            repo_data = {
-                'repo_id': repo_id,
-                'owner': owner,
-                'repo': repo,
-                'github_url': github_url,
-                'is_private': is_private, # Store if it's a private repo
-                'structure': structure,
-                'structure_summary': structure_summary,
-                'files': processed_files,
-                'processed_at': datetime.now().isoformat(),
-                'total_files': len(processable_files),
-                'processed_files': len(processed_files),
-                'processed_by_uid': uid # Store UID of the user who processed it
-            }
-            
-            # Generate common Q&A
-            common_qa = processor.generate_common_questions(repo_data)
-            repo_data['common_qa'] = common_qa
-            
-            yield emit_progress({"progress": 90, "status": "Saving to database", "log": "💾 Saving processed data to database..."})
-            
-            # Save to Firestore
-            try:
-                db.collection('repositories').document(repo_id).set(repo_data)
-                increment_user_limit(uid, 'repo') # Increment repo limit for the user
-                yield emit_progress({"progress": 100, "status": "Processing complete!", "log": "✅ Repository successfully processed and saved!", "repo_id": repo_id, "complete": True})
-            except Exception as e:
-                yield emit_progress({"error": f"Failed to save to database: {str(e)}"})
-                return
+                if event.get('repo_id'):
+                    # Users who joined a shared job get their own copy of the repository
+                    event = dict(event, repo_id=repo_id)
+                yield emit_progress(event)
             
         except Exception as e:
             yield emit_progress({"error": f"Unexpected error: {str(e)}"})
     
     return Response(generate(), mimetype='text/plain')
 
+@app.route('/job-status', methods=['GET'])
+def job_status():
+    try:
+        job_id = request.args.get('job_id')
+        uid = g.uid
+        if not job_id:
+            return jsonify({"error": "Job ID (job_id) is required"}), 400
+        
+        # Jobs of other users are reported as missing rather than forbidden
+        job_data = job_manager.status(job_id)
+        if job_data is None or uid not in job_data.get('uids', []):
+            return jsonify({"error": "Job not found"}), 404
+        
+        return jsonify({
+            'job_id': job_id,
+            'status': job_data['status'],
+            'progress': job_data.get('progress', 0),
+            'status_text': job_data.get('status_text'),
+            'log': job_data.get('log', []),
+            'error': job_data.get('error'),
+            'repo_id': job_data.get('repo_ids', {}).get(uid, job_data.get('repo_id')),
+            'created_at': job_data.get('created_at'),
+            'started_at': job_data.get('started_at'),
+            'finished_at': job_data.get('finished_at'),
+        }), 200
+    
+    except Exception as e:
+        print(f"Error in job_status: {str(e)}")
+        return jsonify({"error": f"An error occurred while fetching the job status: {str(e)}"}), 500
+
+@app.route('/job-events', methods=['GET'])
+def job_events():
+    """Subscribe to a job's progress as Server-Sent Events; `after` resumes from an event index"""
+    job_id = request.args.get('job_id')
+    uid = g.uid
+    after = request.args.get('after', 0, type=int)
+    if not job_id:
+        return jsonify({"error": "Job ID (job_id) is required"}), 400
+    job_data = job_manager.status(job_id)
+    if job_data is None or uid not in job_data.get('uids', []):
+        return jsonify({"error": "Job not found"}), 404
+    # Users who joined the job see their own repo_id
+    repo_id = job_data.get('repo_ids', {}).get(uid)
+    
+    def generate():
+        for index, event in job_manager.subscribe(job_id, after):
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            if event.get('repo_id'):
+                event = dict(event, repo_id=repo_id or event['repo_id'])
+            yield emit_progress(dict(event, index=index))
+    
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/ask-question', methods=['POST'])
 def ask_question():
+    consumed = False
     try:
         data = request.get_json()
         repo_id = data.get('repo_id')
         question = data.get('question')
         session_id = data.get('session_id')
-        uid = data.get('uid') # Get UID from request
-        
-        if not uid:
-            return jsonify({"error": "User not authenticated. Please log in."}), 401
-
-        # Check user limits before answering
-        user_limits = get_user_limits(uid)
-        if user_limits['messages_sent'] >= MAX_MESSAGES_PER_DAY:
-            return jsonify({"error": f"Daily message limit ({MAX_MESSAGES_PER_DAY}) exceeded. Please try again tomorrow."}), 429
+        uid = g.uid
+        # "debug": true adds a per-request timing breakdown to the response
+        debug = bool(data.get('debug'))
+        if debug:
+            start_trace()
         
         if not repo_id or not question:
             return jsonify({"error": "Repository ID and question are required"}), 400
@@ -577,61 +3772,66 @@ def ask_question():
         if not session_id:
             session_id = str(uuid.uuid4())
             
-        # Get repository data from Firestore
-        repo_doc = db.collection('repositories').document(repo_id).get()
-        if not repo_doc.exists:
+        # Get repository data from Firestore, through the user's access record
+        snapshot_id = repo_cache.snapshot_id(uid, repo_id)
+        repo_data = repo_cache.header(snapshot_id) if snapshot_id else None
+        if not repo_data:
             return jsonify({"error": "Repository not found"}), 404
         
-        repo_data = repo_doc.to_dict()
+        # Count the message against today's limit up front; it is given back if answering fails
+        if not quota.try_consume(uid, 'message'):
+            return jsonify({"error": f"Daily message limit ({MAX_MESSAGES_PER_DAY}) exceeded. Please try again tomorrow."}), 429
+        consumed = True
+        repo_data['files'] = repo_cache.file_records(snapshot_id, repo_data)
         
-        # Fetch chat history for the session under the user's collection
         chat_history_ref = db.collection('users').document(uid).collection('chats').document(session_id)
-        chat_history_doc = chat_history_ref.get()
         
-        current_chat_history = []
-        if chat_history_doc.exists:
-            current_chat_history = chat_history_doc.to_dict().get('history', [])
-        
-        # Check if question is very similar to common Q&A (more flexible matching)
-        common_qa = repo_data.get('common_qa', [])
-        question_words = set(question.lower().split())
-        
-        for qa in common_qa:
-            qa_words = set(qa['question'].lower().split())
-            # Check for significant word overlap
-            overlap = len(question_words.intersection(qa_words))
-            if overlap >= 2 and overlap / len(question_words.union(qa_words)) > 0.3:
-                # Save the current Q&A to history before returning
-                # For common_qa, relevant_context is not explicitly generated, so we pass an empty list
-                new_qa_pair = {"question": question, "answer": qa['answer'], "timestamp": datetime.now().isoformat(), "context_files": []}
-                current_chat_history.append(new_qa_pair)
-                # Keep only the last 10 pairs
-                current_chat_history = current_chat_history[-10:]
-                chat_history_ref.set({'history': current_chat_history, 'repo_id': repo_id}) # Store repo_id with chat history
-
-                increment_user_limit(uid, 'message') # Increment message limit
-                return jsonify({
-                    "answer": qa['answer'], 
-                    "source": "common_qa",
-                    "matched_question": qa['question'],
-                    "session_id": session_id # Return session ID
-                })
+        # Answer repeated and near-duplicate questions (including the common Q&A) from the answer cache
+        with span('ask', stage='answer_cache'):
+            cached = answer_cache.lookup(snapshot_id, repo_data, question)
+        if cached:
+            response = {
+                "answer": cached['answer'], 
+                "source": "cache",
+                "matched_question": cached['question'],
+                "session_id": session_id # Return session ID
+            }
+            if debug:
+                response['debug'] = finish_trace()
+            response = jsonify(response)
+            
+            # The chat history is read and written once the answer has been sent, like the streaming route
+            new_qa_pair = {"question": question, "answer": cached['answer'], "timestamp": datetime.now().isoformat(), "context_files": cached['files']}
+            
+            def save_cached_turn():
+                try:
+                    save_chat_turn(chat_history_ref, load_chat_session(chat_history_ref), repo_id, new_qa_pair)
+                except Exception as e:
+                    print(f"Error saving chat history for session {session_id}: {str(e)}")
+            
+            response.call_on_close(save_cached_turn)
+            return response
+        
+        # Fetch chat history for the session under the user's collection
+        chat_session = load_chat_session(chat_history_ref)
         
         # Use AI-guided search for relevant content
-        relevant_context = search_relevant_content(repo_data, question)
+        with span('ask', stage='retrieval'):
+            relevant_context = search_relevant_content(repo_data, question)
         
         # Generate answer with enhanced context, including chat history
-        answer = generate_answer_with_context(question, relevant_context, repo_data, current_chat_history)
+        standalone = not chat_session['history'] and not chat_session.get('summary')
+        with span('ask', stage='generation'):
+            answer, prompt_report = generate_answer_with_context(question, relevant_context, repo_data, chat_session['history'], chat_session.get('summary'))
         
-        # Save the new Q&A pair to history, including the relevant files
+        # Save the new Q&A pair to history, referencing the relevant files by path and content hash
         new_qa_pair = {"question": question, "answer": answer, "timestamp": datetime.now().isoformat(), "context_files": relevant_context}
-        current_chat_history.append(new_qa_pair)
-        # Keep only the last 10 pairs
-        current_chat_history = current_chat_history[-10:]
-        chat_history_ref.set({'history': current_chat_history, 'repo_id': repo_id}) # Save to Firestore, store repo_id
+        save_chat_turn(chat_history_ref, chat_session, repo_id, new_qa_pair)
+        # Only answers that did not depend on earlier turns are shared with other askers
+        if standalone:
+            answer_cache.store(snapshot_id, repo_data, question, answer, new_qa_pair['context_files'])
 
-        increment_user_limit(uid, 'message') # Increment message limit
-        return jsonify({
+        response = {
             "answer": answer, 
             "source": "ai_analysis",
             "files_analyzed": len(relevant_context),
@@ -639,26 +3839,128 @@ def ask_question():
                 {"file": item['path'], "reason": item.get('reason', '')} 
                 for item in relevant_context
             ],
+            "context_dropped": prompt_report['dropped'],
             "session_id": session_id # Return session ID
-        })
+        }
+        if debug:
+            response['debug'] = finish_trace()
+        return jsonify(response)
         
     except Exception as e:
         print(f"Error in ask_question: {str(e)}")
+        # Nothing was cached or saved to the chat history; give the message back
+        if consumed:
+            quota.refund(uid, 'message')
         return jsonify({"error": f"An error occurred while processing your question: {str(e)}"}), 500
 
+@app.route('/ask-question-stream', methods=['POST'])
+def ask_question_stream():
+    """Streaming variant of /ask-question: relays answer deltas as Server-Sent Events"""
+    data = request.get_json()
+    repo_id = data.get('repo_id')
+    question = data.get('question')
+    session_id = data.get('session_id') or str(uuid.uuid4())
+    uid = g.uid
+    
+    if not repo_id or not question:
+        return jsonify({"error": "Repository ID and question are required"}), 400
+    
+    snapshot_id = repo_cache.snapshot_id(uid, repo_id)
+    repo_data = repo_cache.header(snapshot_id) if snapshot_id else None
+    if not repo_data:
+        return jsonify({"error": "Repository not found"}), 404
+    
+    # Count the message against today's limit up front; it is given back if no answer is produced
+    if not quota.try_consume(uid, 'message'):
+        return jsonify({"error": f"Daily message limit ({MAX_MESSAGES_PER_DAY}) exceeded. Please try again tomorrow."}), 429
+    repo_data['files'] = repo_cache.file_records(snapshot_id, repo_data)
+    
+    chat_history_ref = db.collection('users').document(uid).collection('chats').document(session_id)
+    
+    answered = []
+    
+    def generate():
+        try:
+            yield from answer_events()
+        finally:
+            if not answered:
+                quota.refund(uid, 'message')
+    
+    def answer_events():
+        # Cache hits are sent before the chat history is read and written
+        cached = answer_cache.lookup(snapshot_id, repo_data, question)
+        if cached:
+            answered.append(True)
+            yield emit_progress({"delta": cached['answer']})
+            yield emit_progress({"done": True, "answer": cached['answer'], "source": "cache",
+                                 "matched_question": cached['question'], "session_id": session_id})
+            new_qa_pair = {"question": question, "answer": cached['answer'], "timestamp": datetime.now().isoformat(), "context_files": cached['files']}
+            save_chat_turn(chat_history_ref, load_chat_session(chat_history_ref), repo_id, new_qa_pair)
+            return
+        
+        chat_session = load_chat_session(chat_history_ref)
+        standalone = not chat_session['history'] and not chat_session.get('summary')
+        with span('ask', stage='retrieval'):
+            relevant_context = search_relevant_content(repo_data, question)
+        prompt, prompt_report = build_answer_prompt(question, relevant_context, repo_data, chat_session['history'], chat_session.get('summary'))
+        analysis_summary = [{"file": item['path'], "reason": item.get('reason', '')} for item in relevant_context]
+        yield emit_progress({"session_id": session_id, "analysis_summary": analysis_summary})
+        
+        answer_parts = []
+        completed = False
+        try:
+            for delta in processor.stream_llm([{"role": "user", "content": prompt}]):
+                answer_parts.append(delta)
+                yield emit_progress({"delta": delta})
+            completed = True
+        except GeneratorExit:
+            # Client disconnected; the partial answer is still saved below
+            raise
+        except Exception as e:
+            yield emit_progress({"error": f"An error occurred while generating the answer: {str(e)}"})
+        finally:
+            # Persist whatever was generated, on completion or when the client disconnects mid-stream
+            answer = ''.join(answer_parts)
+            if answer:
+                answered.append(True)
+                new_qa_pair = {"question": question, "answer": answer, "timestamp": datetime.now().isoformat(),
+                               "context_files": relevant_context, "complete": completed}
+                save_chat_turn(chat_history_ref, chat_session, repo_id, new_qa_pair)
+                if completed and standalone:
+                    answer_cache.store(snapshot_id, repo_data, question, answer, new_qa_pair['context_files'])
+        
+        if completed:
+            yield emit_progress({"done": True, "answer": answer, "source": "ai_analysis", "files_analyzed": len(relevant_context),
+                                 "analysis_summary": analysis_summary, "context_dropped": prompt_report['dropped'],
+                                 "session_id": session_id})
+    
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/get-user-processed-repos', methods=['GET'])
 def get_user_processed_repos():
     try:
-        uid = request.args.get('uid')
-        if not uid:
-            return jsonify({"error": "User ID (uid) is required"}), 400
+        uid = g.uid
 
-        repos_ref = db.collection('repositories')
-        query = repos_ref.where('processed_by_uid', '==', uid)
-        
         processed_repos = []
+        for doc in db.collection('users').document(uid).collection('repos').stream():
+            access = doc.to_dict()
+            processed_repos.append({
+                'repo_id': doc.id,
+                'owner': access.get('owner'),
+                'repo': access.get('repo'),
+                'github_url': access.get('github_url'),
+                'processed_at': access.get('processed_at'),
+                'partial': access.get('partial', False)
+            })
+        
+        # Repositories processed before access records existed
+        listed = {repo['repo_id'] for repo in processed_repos}
+        repos_ref = db.collection('repositories')
+        query = repos_ref.where('processed_by_uid', '==', uid).select(['owner', 'repo', 'github_url', 'processed_at', 'snapshot_key'])
         for doc in query.stream():
             repo_data = doc.to_dict()
+            if doc.id in listed or repo_data.get('snapshot_key'):
+                continue
             processed_repos.append({
                 'repo_id': doc.id,
                 'owner': repo_data.get('owner'),
@@ -679,12 +3981,9 @@ def get_user_processed_repos():
 @app.route('/get-user-chat-sessions', methods=['GET'])
 def get_user_chat_sessions():
     try:
-        uid = request.args.get('uid')
+        uid = g.uid
         repo_id = request.args.get('repo_id')
 
-        if not uid:
-            return jsonify({"error": "User ID (uid) is required"}), 400
-
         chats_ref = db.collection('users').document(uid).collection('chats')
         
         query = chats_ref
@@ -699,7 +3998,7 @@ def get_user_chat_sessions():
                 'session_id': doc.id,
                 'repo_id': session_data.get('repo_id'),
                 'last_message_timestamp': session_data.get('history', [{}])[-1].get('timestamp') if session_data.get('history') else None,
-                'first_question': session_data.get('history', [{}])[0].get('question') if session_data.get('history') else None
+                'first_question': session_data.get('first_question') or (session_data.get('history', [{}])[0].get('question') if session_data.get('history') else None)
             })
         
         # Sort sessions by last message timestamp, newest first
@@ -714,11 +4013,11 @@ def get_user_chat_sessions():
 @app.route('/get-chat-history', methods=['GET'])
 def get_chat_history():
     try:
-        uid = request.args.get('uid')
+        uid = g.uid
         session_id = request.args.get('session_id')
 
-        if not uid or not session_id:
-            return jsonify({"error": "User ID (uid) and Session ID (session_id) are required"}), 400
+        if not session_id:
+            return jsonify({"error": "Session ID (session_id) is required"}), 400
 
         chat_history_ref = db.collection('users').document(uid).collection('chats').document(session_id)
         chat_history_doc = chat_history_ref.get()
@@ -733,12 +4032,86 @@ def get_chat_history():
         return jsonify({"error": f"An error occurred while fetching chat history: {str(e)}"}), 500
 
 def search_relevant_content(repo_data, question):
-    """Direct content search that uses Firebase data effectively"""
+    """Rank every file with the BM25 and vector indexes (fused) and return the best matches with full data.
+
+    With USE_LLM_FILE_SELECTION the LLM picks 3-5 files from the top-ranked candidates instead."""
     
     files = repo_data.get('files', {})
     if not files:
         return []
     
+    try:
+        keyword_ranked = repo_cache.search_index(repo_data['repo_id'], repo_data, files).search(question)
+        semantic_ranked = repo_cache.vector_index(repo_data['repo_id'], repo_data, files).search(question, SEARCH_CANDIDATE_FILES)
+        reasons = {}
+        for file_path, score, chunk in semantic_ranked:
+            reasons[file_path] = f"Semantic match (similarity {score:.2f}{', best in ' + chunk if chunk else ''})"
+        for file_path, score, chunk in keyword_ranked[:SEARCH_CANDIDATE_FILES]:
+            keyword_reason = f"Keyword match (BM25 {score:.1f}{', best in ' + chunk if chunk else ''})"
+            reasons[file_path] = f"{keyword_reason}; {reasons[file_path]}" if file_path in reasons else keyword_reason
+        ranked = [
+            file_path for file_path in fuse_rankings(
+                [file_path for file_path, _, _ in keyword_ranked[:SEARCH_CANDIDATE_FILES]],
+                [file_path for file_path, _, _ in semantic_ranked]
+            )
+            if file_path in files
+        ]
+        
+        if USE_LLM_FILE_SELECTION:
+            candidates = ranked[:SEARCH_CANDIDATE_FILES] or list(files.keys())[:SEARCH_CANDIDATE_FILES]
+            selected_files = select_files_with_llm(repo_data, candidates, question)
+            reasons.update({file_path: 'Selected by AI as relevant to the question' for file_path in selected_files})
+        else:
+            selected_files = ranked[:SEARCH_RESULT_FILES]
+        
+        if not selected_files:
+            # Fallback: select files based on keywords
+            for file_path in files.keys():
+                if any(keyword in file_path.lower() or keyword in files[file_path].get('summary', '').lower() 
+                       for keyword in ['main', 'index', 'app', 'config', 'setup']):
+                    selected_files.append(file_path)
+                    reasons[file_path] = 'Likely entry point or configuration file'
+                    if len(selected_files) >= 5:
+                        break
+        
+        # Return full file data for selected files, loading contents for just these files
+        selected_files = [file_path for file_path in selected_files if file_path in files]
+        contents = repo_cache.file_contents(repo_data['repo_id'], [p for p in selected_files if 'content' not in files[p]], repo_data)
+        relevant_context = []
+        for file_path in selected_files:
+            file_data = files[file_path]
+            relevant_context.append({
+                'path': file_path,
+                'summary': file_data.get('summary', ''),
+                'content': file_data.get('content', contents.get(file_path, '')),
+                'metadata': file_data.get('metadata', {}),
+                'blob_sha': file_data.get('blob_sha'),
+                'type': 'full_analysis',
+                'reason': reasons.get(file_path, '')
+            })
+        
+        print(f"Returning {len(relevant_context)} files with full data")  # Debug log
+        return relevant_context
+        
+    except Exception as e:
+        print(f"Error in file selection: {str(e)}")
+        # Fallback: return first few files
+        fallback_files = list(files.keys())[:3]
+        contents = repo_cache.file_contents(repo_data['repo_id'], [p for p in fallback_files if 'content' not in files[p]], repo_data)
+        return [{
+            'path': file_path,
+            'summary': files[file_path].get('summary', ''),
+            'content': files[file_path].get('content', contents.get(file_path, '')),
+            'metadata': files[file_path].get('metadata', {}),
+            'blob_sha': files[file_path].get('blob_sha'),
+            'type': 'fallback',
+            'reason': 'Fallback selection due to AI selection error'
+        } for file_path in fallback_files]
+
+def select_files_with_llm(repo_data, candidates, question):
+    """Ask the LLM to pick the 3-5 most relevant files among the ranked candidates"""
+    files = repo_data.get('files', {})
+    
     # Get repository context
     structure_summary = repo_data.get('structure_summary', {})
     repo_context = f"""Repository: {repo_data.get('owner')}/{repo_data.get('repo')}
@@ -748,21 +4121,21 @@ Entry Points: {', '.join(structure_summary.get('entry_points', []))}"""
     
     # Create file analysis for AI
     file_summaries = []
-    for file_path, file_data in files.items():
+    for file_path in candidates:
+        file_data = files[file_path]
         file_info = {
             'path': file_path,
             'purpose': file_data.get('metadata', {}).get('main_purpose', 'Unknown'),
             'summary': file_data.get('summary', '')[:1000000],  # Truncate for context
             'functions': file_data.get('metadata', {}).get('functions', [])[:5],
             'classes': file_data.get('metadata', {}).get('classes', [])[:5],
-            'content_preview': file_data.get('content', '')[:300]  # First 300 chars
+            'content_preview': file_data.get('content_preview') or file_data.get('content', '')[:300]  # First 300 chars
         }
         file_summaries.append(file_info)
     
     # Let AI select relevant files
-# Let AI select relevant files
     newline = chr(10)
-    file_analysis = newline.join([f"File: {f['path']}\nPurpose: {f['purpose']}\nSummary: {f['summary']}\nFunctions: {', '.join(f['functions'])}\nClasses: {', '.join(f['classes'])}\nPreview: {f['content_preview'][:1000000]}...\n---" for f in file_summaries[:15]])
+    file_analysis = newline.join([f"File: {f['path']}\nPurpose: {f['purpose']}\nSummary: {f['summary']}\nFunctions: {', '.join(f['functions'])}\nClasses: {', '.join(f['classes'])}\nPreview: {f['content_preview'][:1000000]}...\n---" for f in file_summaries])
 
     selection_prompt = f"""{repo_context}
 
@@ -782,97 +4155,297 @@ Consider:
 - Configuration files for setup questions
 - Main application files for architecture questions"""
 
+    response = processor.call_llm([{"role": "user", "content": selection_prompt}])
+    print(f"AI Selection Response: {response}")  # Debug log
+    
+    # Extract JSON array from response
+    json_match = re.search(r'\[.*?\]', response, re.DOTALL)
+    if not json_match:
+        return candidates[:SEARCH_RESULT_FILES]
+    selected_files = json.loads(json_match.group())
+    print(f"Selected files: {selected_files}")  # Debug log
+    return selected_files
+
+# Answer cache: repeated and near-duplicate questions about the same repository version are answered
+# from memory. Near duplicates are found with MinHash signatures over question shingles, banded for LSH.
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", 500))  # per repository
+ANSWER_CACHE_MAX_REPOS = 200
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", 24 * 3600))
+# Minimum Jaccard similarity between question shingle sets for a near-duplicate hit
+ANSWER_CACHE_MIN_SIMILARITY = 0.6
+# Questions with fewer content words than this depend on context too much to be shared
+ANSWER_CACHE_MIN_TERMS = 2
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16  # 4 rows per band: pairs with Jaccard ~0.5 collide in at least one band half the time
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_random = np.random.RandomState(20240601)
+_MINHASH_A = _minhash_random.randint(1, 2 ** 31 - 1, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+_MINHASH_B = _minhash_random.randint(0, 2 ** 31 - 1, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+
+def normalize_question(question):
+    return ' '.join(re.findall(r'[a-z0-9_]+', question.lower()))
+
+def question_shingles(question):
+    """Content words (with a naive plural strip) and adjacent word pairs"""
+    terms = [term[:-1] if len(term) > 3 and term.endswith('s') and not term.endswith('ss') else term
+             for term in normalize_question(question).split() if term not in SEARCH_STOP_WORDS and len(term) > 1]
+    return set(terms) | {f"{a} {b}" for a, b in zip(terms, terms[1:])}, len(terms)
+
+def minhash_signature(shingles):
+    hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles], dtype=np.uint64)
+    return ((np.outer(hashes, _MINHASH_A) + _MINHASH_B) % _MINHASH_PRIME).min(axis=0)
+
+def lsh_band_keys(signature):
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(MINHASH_BANDS)]
+
+class AnswerCache:
+    """Per-repository LRU/TTL cache of answers with exact and MinHash/LSH near-duplicate lookup.
+
+    Each repository's entries belong to one processed version; a lookup against a newer version
+    (or invalidate() after reprocessing) starts over, preloaded with the repository's common Q&A."""
+    def __init__(self, max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl_seconds=ANSWER_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.repos = OrderedDict()  # repo_id -> {'version', 'entries': OrderedDict, 'buckets': {band key: set}}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+    
+    def _repo(self, repo_id, repo_data):
+        version = repo_data.get('processed_at')
+        repo = self.repos.get(repo_id)
+        if repo is None or repo['version'] != version:
+            repo = {'version': version, 'entries': OrderedDict(), 'buckets': {}}
+            self.repos[repo_id] = repo
+            for qa in repo_data.get('common_qa', []):
+                self._add(repo, qa['question'], qa['answer'], [], 'common_qa', pinned=True)
+            while len(self.repos) > ANSWER_CACHE_MAX_REPOS:
+                self.repos.popitem(last=False)
+        self.repos.move_to_end(repo_id)
+        return repo
+    
+    def _add(self, repo, question, answer, files, origin, pinned=False):
+        key = normalize_question(question)
+        if key in repo['entries']:
+            self._remove(repo, key)
+        shingles, _ = question_shingles(question)
+        entry = {
+            'question': question, 'answer': answer, 'files': files, 'origin': origin, 'shingles': shingles,
+            'band_keys': lsh_band_keys(minhash_signature(shingles)) if shingles else [],
+            'expires_at': None if pinned else time.time() + self.ttl_seconds,
+        }
+        repo['entries'][key] = entry
+        for band_key in entry['band_keys']:
+            repo['buckets'].setdefault(band_key, set()).add(key)
+        # Evict least recently used answers; pinned common Q&A entries are kept
+        evictable = [k for k, e in repo['entries'].items() if e['expires_at'] is not None]
+        for old_key in evictable[:max(len(evictable) - self.max_entries, 0)]:
+            self._remove(repo, old_key)
+    
+    def _remove(self, repo, key):
+        entry = repo['entries'].pop(key)
+        for band_key in entry['band_keys']:
+            bucket = repo['buckets'].get(band_key)
+            if bucket:
+                bucket.discard(key)
+                if not bucket:
+                    del repo['buckets'][band_key]
+    
+    def _live(self, repo, key):
+        entry = repo['entries'].get(key)
+        if entry and entry['expires_at'] is not None and entry['expires_at'] < time.time():
+            self._remove(repo, key)
+            return None
+        return entry
+    
+    def lookup(self, repo_id, repo_data, question):
+        """Return the cached entry for the question or a near duplicate, or None"""
+        with self.lock:
+            repo = self._repo(repo_id, repo_data)
+            key = normalize_question(question)
+            entry = self._live(repo, key)
+            if entry:
+                self.hits += 1
+                repo['entries'].move_to_end(key)
+                return entry
+            
+            shingles, term_count = question_shingles(question)
+            if term_count < ANSWER_CACHE_MIN_TERMS:
+                self.misses += 1
+                return None
+            candidates = set()
+            for band_key in lsh_band_keys(minhash_signature(shingles)):
+                candidates |= repo['buckets'].get(band_key, set())
+            best, best_similarity = None, ANSWER_CACHE_MIN_SIMILARITY
+            for candidate_key in candidates:
+                candidate = self._live(repo, candidate_key)
+                if not candidate:
+                    continue
+                similarity = len(shingles & candidate['shingles']) / len(shingles | candidate['shingles'])
+                if similarity >= best_similarity:
+                    best, best_similarity = candidate_key, similarity
+            if best is None:
+                self.misses += 1
+                return None
+            self.near_hits += 1
+            repo['entries'].move_to_end(best)
+            return repo['entries'][best]
+    
+    def store(self, repo_id, repo_data, question, answer, files):
+        """Cache an answer; files are {path, content_hash} references to the files it used"""
+        if question_shingles(question)[1] < ANSWER_CACHE_MIN_TERMS:
+            return
+        with self.lock:
+            self._add(self._repo(repo_id, repo_data), question, answer, files, 'ai_analysis')
+    
+    def invalidate(self, repo_id):
+        with self.lock:
+            self.repos.pop(repo_id, None)
+    
+    def stats(self):
+        with self.lock:
+            entries = sum(len(repo['entries']) for repo in self.repos.values())
+            return {'repositories': len(self.repos), 'entries': entries, 'hits': self.hits,
+                    'near_duplicate_hits': self.near_hits, 'misses': self.misses}
+
+answer_cache = AnswerCache()
+
+# Chat history: recent turns are kept verbatim up to a token budget, older turns are folded into a rolling summary
+CHAT_HISTORY_MAX_TURNS = int(os.environ.get("CHAT_HISTORY_MAX_TURNS", 10))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get("CHAT_HISTORY_TOKEN_BUDGET", 4000))
+CHAT_HISTORY_MIN_TURNS = 2
+CHAT_SUMMARY_MAX_TOKENS = 600
+
+def history_file_refs(context_files):
+    """Reduce context files to {path, content_hash} references for storage in chat history"""
+    refs = []
+    for item in context_files:
+        content_hash = item.get('content_hash') or item.get('blob_sha')
+        if not content_hash and item.get('content') is not None:
+            content_hash = git_blob_sha(item['content'])
+        refs.append({'path': item['path'], 'content_hash': content_hash})
+    return refs
+
+@traced('firestore', op='load_chat_session')
+def load_chat_session(chat_ref):
+    """Read a chat session, compacting legacy entries that embedded file contents"""
+    chat_doc = chat_ref.get()
+    session = chat_doc.to_dict() if chat_doc.exists else {}
+    history = session.get('history', [])
+    for qa in history:
+        qa['context_files'] = history_file_refs(qa.get('context_files', []))
+    session['history'] = history
+    return session
+
+def history_turn_tokens(qa):
+    return estimate_tokens(qa['question']) + estimate_tokens(qa['answer']) + 10 * len(qa.get('context_files', []))
+
+def summarize_conversation(summary, turns):
+    """Fold older Q&A turns into the rolling conversation summary"""
+    transcript = "\n".join(f"Q: {qa['question']}\nA: {qa['answer']}" for qa in turns)
+    prompt = f"""Update the running summary of a conversation about a code repository with the new turns below.
+Keep the facts, file names and decisions a developer would need to continue the conversation. Respond with the summary only, at most {CHAT_SUMMARY_MAX_TOKENS * 3} characters.
+
+Current summary:
+{summary or '(none)'}
+
+New turns:
+{truncate_to_tokens(transcript, FILE_PROMPT_TOKEN_BUDGET)}"""
     try:
-        response = processor.call_llm([{"role": "user", "content": selection_prompt}])
-        print(f"AI Selection Response: {response}")  # Debug log
-        
-        # Extract JSON array from response
-        import re
-        json_match = re.search(r'\[.*?\]', response, re.DOTALL)
-        if json_match:
-            selected_files = json.loads(json_match.group())
-            print(f"Selected files: {selected_files}")  # Debug log
-        else:
-            # Fallback: select files based on keywords
-            question_lower = question.lower()
-            selected_files = []
-            for file_path in files.keys():
-                if any(keyword in file_path.lower() or keyword in files[file_path].get('summary', '').lower() 
-                       for keyword in ['main', 'index', 'app', 'config', 'setup']):
-                    selected_files.append(file_path)
-                    if len(selected_files) >= 5:
-                        break
-        
-        # Return full file data for selected files
-        relevant_context = []
-        for file_path in selected_files:
-            if file_path in files:
-                file_data = files[file_path]
-                relevant_context.append({
-                    'path': file_path,
-                    'summary': file_data.get('summary', ''),
-                    'content': file_data.get('content', ''),
-                    'metadata': file_data.get('metadata', {}),
-                    'type': 'full_analysis',
-                    'reason': 'Selected by AI as relevant to the question'
-                })
-        
-        print(f"Returning {len(relevant_context)} files with full data")  # Debug log
-        return relevant_context
-        
+        updated = processor.call_llm([{"role": "user", "content": prompt}])
     except Exception as e:
-        print(f"Error in file selection: {str(e)}")
-        # Fallback: return first few files
-        fallback_files = list(files.keys())[:3]
-        return [{
-            'path': file_path,
-            'summary': files[file_path].get('summary', ''),
-            'content': files[file_path].get('content', ''),
-            'metadata': files[file_path].get('metadata', {}),
-            'type': 'fallback',
-            'reason': 'Fallback selection due to AI selection error'
-        } for file_path in fallback_files]
+        print(f"Error summarizing conversation: {str(e)}")
+        questions = "; ".join(qa['question'] for qa in turns)
+        updated = f"{summary}\nEarlier questions: {questions}" if summary else f"Earlier questions: {questions}"
+    return truncate_to_tokens(updated.strip(), CHAT_SUMMARY_MAX_TOKENS)
 
-def generate_answer_with_context(question, relevant_context, repo_data, chat_history):
-    """Generate answer using LLM with relevant context and chat history"""
+@traced('firestore', op='save_chat_turn')
+def save_chat_turn(chat_ref, session, repo_id, qa_pair):
+    """Append a turn; once the history budget is exceeded, fold the oldest turns into the summary
+    until half the budget is free, so the summary is updated every few turns rather than every turn"""
+    qa_pair['context_files'] = history_file_refs(qa_pair.get('context_files', []))
+    history = session.get('history', []) + [qa_pair]
+    folded = []
+    def over_budget(max_turns, max_tokens):
+        return len(history) > CHAT_HISTORY_MIN_TURNS and (
+            len(history) > max_turns or sum(history_turn_tokens(qa) for qa in history) > max_tokens)
+    if over_budget(CHAT_HISTORY_MAX_TURNS, CHAT_HISTORY_TOKEN_BUDGET):
+        while over_budget(CHAT_HISTORY_MAX_TURNS // 2, CHAT_HISTORY_TOKEN_BUDGET // 2):
+            folded.append(history.pop(0))
     
-    # Build context string
-    context_parts = []
+    summary = session.get('summary', '')
+    if folded:
+        summary = summarize_conversation(summary, folded)
+    
+    session.update({
+        'history': history,
+        'summary': summary,
+        'summarized_turns': session.get('summarized_turns', 0) + len(folded),
+        'first_question': session.get('first_question') or (folded or history)[0]['question'],
+        'repo_id': repo_id, # Store repo_id with chat history
+    })
+    chat_ref.set(session)
+    return session
+
+def build_answer_prompt(question, relevant_context, repo_data, chat_history, conversation_summary=None):
+    """Assemble the answer prompt within PROMPT_TOKEN_BUDGET; returns (prompt, report of dropped sections).
+
+    Priority order: repository overview, current files' purpose, recent conversation, summaries,
+    then code chunks ranked by overlap with the question, then older context."""
+    builder = PromptBuilder(PROMPT_TOKEN_BUDGET - estimate_tokens(question))
     
     # Add repository overview
     structure_summary = repo_data.get('structure_summary', {})
-    context_parts.append(f"Repository: {repo_data.get('owner')}/{repo_data.get('repo')}")
-    context_parts.append(f"Architecture: {structure_summary.get('architecture_type', 'Unknown')}")
-    context_parts.append(f"Technologies: {', '.join(structure_summary.get('main_technologies', []))}")
+    builder.add(f"Repository: {repo_data.get('owner')}/{repo_data.get('repo')}", priority=0)
+    builder.add(f"Architecture: {structure_summary.get('architecture_type', 'Unknown')}", priority=0)
+    builder.add(f"Technologies: {', '.join(structure_summary.get('main_technologies', []))}", priority=0)
     
-    # Add chat history, including context files from previous turns
+    # Add the rolling summary of older turns, then the recent turns; newer turns are kept first
+    if conversation_summary:
+        builder.add(f"\nSummary of Earlier Conversation:\n{conversation_summary}", priority=2.5, label="conversation summary", truncatable=True)
     if chat_history:
-        context_parts.append("\nPrevious Conversation History (last 10 Q&A pairs):")
+        current_hashes = {path: record.get('blob_sha') for path, record in repo_data.get('files', {}).items()}
+        builder.add(f"\nPrevious Conversation History (last {len(chat_history)} Q&A pairs):", priority=0)
         for i, qa in enumerate(chat_history):
-            context_parts.append(f"Q{i+1}: {qa['question']}")
-            context_parts.append(f"A{i+1}: {qa['answer']}")
+            age = len(chat_history) - i
+            builder.add(f"Q{i+1}: {qa['question']}", priority=3 + age * 0.01, label=f"history Q{i+1}")
+            builder.add(f"A{i+1}: {qa['answer']}", priority=3 + age * 0.01, label=f"history A{i+1}", truncatable=True)
             if qa.get('context_files'):
-                context_parts.append("Files referenced in Q&A:")
-                for file_item in qa['context_files']:
-                    context_parts.append(f"  - {file_item['path']}")
-                    if file_item.get('summary'):
-                        context_parts.append(f"    Summary: {file_item['summary'][:1000000]}...")
-                    if file_item.get('content'):
-                        context_parts.append(f"    Code snippet:\n```\n{file_item['content'][:1000000]}...\n```")
+                refs = []
+                for ref in qa['context_files']:
+                    changed = ref.get('content_hash') and current_hashes.get(ref['path']) not in (None, ref['content_hash'])
+                    refs.append(f"{ref['path']} (changed since)" if changed else ref['path'])
+                builder.add(f"Files referenced in Q{i+1}: {', '.join(refs)}", priority=5 + age * 0.01)
     
     # Add relevant file information for the current turn
     if relevant_context:
-        context_parts.append("\nRelevant Files for Current Question:")
+        builder.add("\nRelevant Files for Current Question:", priority=0)
+        question_terms = set(tokenize_code(question))
+        file_chunks = []
+        for file_rank, item in enumerate(relevant_context):
+            for chunk in chunk_code(item.get('content') or '', item['path'], item.get('metadata', {}).get('symbols')):
+                overlap = len(question_terms & set(tokenize_code(chunk['text'])))
+                file_chunks.append((item['path'], chunk, (-overlap, file_rank, chunk['start_line'])))
+        chunk_priority = {
+            (file_path, chunk['start_line']): 4 + rank / 1000
+            for rank, (file_path, chunk, _) in enumerate(sorted(file_chunks, key=lambda entry: entry[2]))
+        }
+        
         for item in relevant_context:
-            context_parts.append(f"\nFile: {item['path']}")
-            context_parts.append(f"Purpose: {item.get('metadata', {}).get('main_purpose', 'N/A')}")
-            context_parts.append(f"Summary: {item.get('summary', 'N/A')[:1000000]}...")
+            builder.add(f"\nFile: {item['path']}", priority=1)
+            builder.add(f"Purpose: {item.get('metadata', {}).get('main_purpose', 'N/A')}", priority=1)
+            builder.add(f"Summary: {item.get('summary', 'N/A')}", priority=2, label=f"summary of {item['path']}", truncatable=True)
             
-            # Add code snippet if relevant
-            if item.get('content'):
-                context_parts.append(f"Code snippet:\n```\n{item['content'][:1000000]}...\n```")
+            # Add code snippets, one fenced block per chunk so dropped chunks leave valid markdown
+            for file_path, chunk, _ in file_chunks:
+                if file_path == item['path']:
+                    builder.add(f"Code snippet (lines {chunk['start_line']}-{chunk['end_line']}):\n```\n{chunk['text']}\n```",
+                                priority=chunk_priority[(file_path, chunk['start_line'])],
+                                label=f"{file_path}:{chunk['start_line']}-{chunk['end_line']}")
     
-    context = "\n".join(context_parts)
+    context, report = builder.build()
     
     # Create prompt for LLM
     prompt = f"""You are CodeCompass, an AI assistant helping developers understand a codebase. Answer the user's question based on the repository context and previous conversation history provided.
@@ -891,16 +4464,39 @@ Provide a helpful, detailed answer that:
 6. Takes into account the previous conversation to maintain context and avoid redundancy.
 
 If you cannot find specific information to answer the question, say so and suggest what the user might look for or where they might find the answer."""
+    
+    if report['dropped'] or report['truncated']:
+        print(f"Answer prompt: {report['used_tokens']}/{report['budget_tokens']} tokens, dropped {len(report['dropped'])} sections, truncated {len(report['truncated'])}")
+    return prompt, report
 
-    try:
-        response = processor.call_llm([{"role": "user", "content": prompt}])
-        return response
-    except Exception as e:
-        return f"I apologize, but I encountered an error generating an answer: {str(e)}. Please try rephrasing your question or ask about something more specific."
+def generate_answer_with_context(question, relevant_context, repo_data, chat_history, conversation_summary=None):
+    """Generate answer using LLM with relevant context and chat history; returns (answer, prompt report).
+    LLM errors propagate so a failed answer is neither cached nor counted against the user's quota."""
+    prompt, report = build_answer_prompt(question, relevant_context, repo_data, chat_history, conversation_summary)
+    response = processor.call_llm([{"role": "user", "content": prompt}])
+    return response, report
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus scrape endpoint: span latencies, request/token counters and cache statistics"""
+    # Metrics reveal traffic, cache contents and costs, so they are only served to a scraper holding the token
+    if not METRICS_TOKEN:
+        return jsonify({"error": "Metrics are disabled; set METRICS_TOKEN to enable them"}), 404
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode(), METRICS_TOKEN.encode()):
+        return jsonify({"error": "Metrics token required"}), 401
+    cache_stats = {'analysis_cache': analysis_cache.stats(), 'repo_cache': repo_cache.stats(),
+                   'github_http_cache': github_http_cache.stats(), 'answer_cache': answer_cache.stats()}
+    gauges = {'codecompass_cache': [
+        ({'cache': cache, 'stat': stat}, value)
+        for cache, stats in cache_stats.items() for stat, value in stats.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    ]}
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat()})
+    return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat(), "analysis_cache": analysis_cache.stats(), "repo_cache": repo_cache.stats(), "github_http_cache": github_http_cache.stats(), "answer_cache": answer_cache.stats()})
 
 if __name__ == '__main__':
     print("🧭 CodeCompass Backend Starting...")
@@ -0,0 +1,343 @@
+"""In-memory stand-in for the parts of the Firestore client that app.py uses.
+
+Documents live in one dict keyed by their full path ("users/u1/usage/2024-01-01"). Values are
+deep-copied on the way in and out, like a real round trip, and every RPC-shaped call (document get,
+get_all, query stream, batch commit, transaction) can sleep for a configurable latency and is
+counted, so a benchmark can report how many Firestore operations a run needed.
+
+install() patches firebase_admin so that importing app.py needs neither credentials nor network:
+credentials and initialize_app become no-ops, firestore.client() returns the fake and
+auth.verify_id_token accepts tokens of the form "bench-<uid>".
+"""
+import copy
+import threading
+import time
+import uuid
+
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1.transforms import ArrayRemove, ArrayUnion, Increment, Sentinel
+
+BENCH_TOKEN_PREFIX = 'bench-'
+
+
+def bench_token(uid):
+    """ID token the patched auth.verify_id_token accepts for uid"""
+    return f"{BENCH_TOKEN_PREFIX}{uid}"
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        value = self._data or {}
+        for part in field_path.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        return copy.deepcopy(value)
+
+
+class FakeDocumentReference:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return FakeCollectionReference(self.client, self.path.rsplit('/', 1)[0])
+
+    def collection(self, name):
+        return FakeCollectionReference(self.client, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None):
+        self.client._rpc('reads')
+        with self.client.lock:
+            return FakeSnapshot(self, copy.deepcopy(self.client.documents.get(self.path)))
+
+    def set(self, data, merge=False):
+        self.client._rpc('commits')
+        with self.client.lock:
+            self.client._set(self.path, data, merge)
+        self.client._count('documents_written')
+
+    def update(self, data):
+        self.client._rpc('commits')
+        with self.client.lock:
+            self.client._update(self.path, data)
+        self.client._count('documents_written')
+
+    def delete(self):
+        self.client._rpc('commits')
+        with self.client.lock:
+            self.client._delete(self.path)
+        self.client._count('documents_written')
+
+
+class FakeQuery:
+    OPERATORS = {
+        '==': lambda value, operand: value == operand,
+        '!=': lambda value, operand: value != operand,
+        '<': lambda value, operand: value is not None and value < operand,
+        '<=': lambda value, operand: value is not None and value <= operand,
+        '>': lambda value, operand: value is not None and value > operand,
+        '>=': lambda value, operand: value is not None and value >= operand,
+        'in': lambda value, operand: value in operand,
+        'not-in': lambda value, operand: value not in operand,
+        'array_contains': lambda value, operand: isinstance(value, list) and operand in value,
+    }
+
+    def __init__(self, client, path, filters=(), fields=None, limit_count=None):
+        self.client = client
+        self.path = path
+        self.filters = filters
+        self.fields = fields
+        self.limit_count = limit_count
+
+    def where(self, field_path, op_string, value):
+        if op_string not in self.OPERATORS:
+            raise NotImplementedError(f"Fake Firestore does not support the {op_string!r} operator")
+        return FakeQuery(self.client, self.path, self.filters + ((field_path, op_string, value),), self.fields, self.limit_count)
+
+    def select(self, field_paths):
+        return FakeQuery(self.client, self.path, self.filters, list(field_paths), self.limit_count)
+
+    def limit(self, count):
+        return FakeQuery(self.client, self.path, self.filters, self.fields, count)
+
+    def _matches(self, data):
+        return all(self.OPERATORS[op](data.get(field), operand) for field, op, operand in self.filters)
+
+    def stream(self, transaction=None):
+        self.client._rpc('queries')
+        prefix = self.path + '/'
+        results = []
+        with self.client.lock:
+            for path in sorted(self.client.documents):
+                # Direct children only, not documents in subcollections
+                if not path.startswith(prefix) or '/' in path[len(prefix):]:
+                    continue
+                data = self.client.documents[path]
+                if not self._matches(data):
+                    continue
+                if self.fields is not None:
+                    data = {field: value for field, value in data.items() if field in self.fields}
+                results.append(FakeSnapshot(FakeDocumentReference(self.client, path), copy.deepcopy(data)))
+                if self.limit_count is not None and len(results) >= self.limit_count:
+                    break
+        self.client._count('documents_read', len(results))
+        return iter(results)
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction))
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.id = path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return FakeDocumentReference(self.client, self.path.rsplit('/', 1)[0]) if '/' in self.path else None
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self.client, f"{self.path}/{document_id or uuid.uuid4().hex}")
+
+    def add(self, data):
+        reference = self.document()
+        reference.set(data)
+        return None, reference
+
+
+class FakeWriteBatch:
+    """Collects writes and applies them together on commit()"""
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def set(self, reference, data, merge=False):
+        self.writes.append(('set', reference.path, copy.deepcopy(data), merge))
+
+    def update(self, reference, data):
+        self.writes.append(('update', reference.path, copy.deepcopy(data), None))
+
+    def delete(self, reference):
+        self.writes.append(('delete', reference.path, None, None))
+
+    def __len__(self):
+        return len(self.writes)
+
+    def _apply(self):
+        with self.client.lock:
+            # Like Firestore, a batch is all or nothing: check updates before writing anything
+            pending = set()
+            for kind, path, _, _ in self.writes:
+                if kind == 'update' and path not in self.client.documents and path not in pending:
+                    raise NotFound(f"No document to update: {path}")
+                if kind == 'set':
+                    pending.add(path)
+            for kind, path, data, merge in self.writes:
+                if kind == 'set':
+                    self.client._set(path, data, merge)
+                elif kind == 'update':
+                    self.client._update(path, data)
+                else:
+                    self.client._delete(path)
+        self.client._count('documents_written', len(self.writes))
+        self.writes = []
+
+    def commit(self):
+        self.client._rpc('commits')
+        self._apply()
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Transactions hold the client lock from the first read to the commit, so they never conflict"""
+    def __init__(self, client):
+        super().__init__(client)
+        self.in_progress = False
+
+
+def transactional(to_wrap):
+    """Stand-in for firestore.transactional: runs the function once under the client lock and commits"""
+    def run(transaction, *args, **kwargs):
+        client = transaction.client
+        client._rpc('transactions')
+        with client.lock:
+            transaction.in_progress = True
+            try:
+                result = to_wrap(transaction, *args, **kwargs)
+                transaction._apply()
+            finally:
+                transaction.in_progress = False
+        return result
+    return run
+
+
+class FakeFirestore:
+    """The client: db.collection(), db.batch(), db.transaction() and db.get_all()"""
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.documents = {}
+        self.lock = threading.RLock()
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {'reads': 0, 'queries': 0, 'commits': 0, 'transactions': 0,
+                          'documents_read': 0, 'documents_written': 0}
+
+    def _count(self, kind, n=1):
+        with self.stats_lock:
+            self.stats[kind] += n
+
+    def _rpc(self, kind):
+        self._count(kind)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def document(self, path):
+        return FakeDocumentReference(self, path)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return FakeTransaction(self)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        self._rpc('reads')
+        references = list(references)
+        with self.lock:
+            snapshots = [FakeSnapshot(reference, copy.deepcopy(self.documents.get(reference.path))) for reference in references]
+        self._count('documents_read', sum(1 for snapshot in snapshots if snapshot.exists))
+        return iter(snapshots)
+
+    def summary(self):
+        """Operation counts plus the number of stored documents"""
+        with self.stats_lock:
+            summary = dict(self.stats)
+        with self.lock:
+            summary['documents_stored'] = len(self.documents)
+        return summary
+
+    # Writes, called with self.lock held
+    def _resolve(self, old, value):
+        if isinstance(value, Increment):
+            return (old if isinstance(old, (int, float)) else 0) + value.value
+        if isinstance(value, ArrayUnion):
+            existing = list(old) if isinstance(old, list) else []
+            return existing + [item for item in value.values if item not in existing]
+        if isinstance(value, ArrayRemove):
+            return [item for item in (old if isinstance(old, list) else []) if item not in value.values]
+        return copy.deepcopy(value)
+
+    def _write_field(self, document, field_path, value, nested_merge):
+        parts = field_path.split('.') if nested_merge is None else [field_path]
+        target = document
+        for part in parts[:-1]:
+            if not isinstance(target.get(part), dict):
+                target[part] = {}
+            target = target[part]
+        if isinstance(value, Sentinel):
+            target.pop(parts[-1], None)
+        elif nested_merge and isinstance(value, dict) and isinstance(target.get(parts[-1]), dict):
+            for key, item in value.items():
+                self._write_field(target[parts[-1]], key, item, True)
+        else:
+            target[parts[-1]] = self._resolve(target.get(parts[-1]), value)
+
+    def _set(self, path, data, merge):
+        document = self.documents.get(path) if merge else None
+        if document is None:
+            document = {}
+        for field, value in data.items():
+            # set(merge=True) merges nested maps; a plain set replaces the document
+            self._write_field(document, field, value, merge)
+        self.documents[path] = document
+
+    def _update(self, path, data):
+        document = self.documents.get(path)
+        if document is None:
+            raise NotFound(f"No document to update: {path}")
+        for field_path, value in data.items():
+            # update() treats dots as nested field paths
+            self._write_field(document, field_path, value, None)
+
+    def _delete(self, path):
+        self.documents.pop(path, None)
+
+
+def install(latency_ms=0.0):
+    """Patch firebase_admin before app.py is imported; returns the FakeFirestore app.db will be"""
+    import firebase_admin
+    from firebase_admin import auth, credentials, firestore
+
+    client = FakeFirestore(latency_ms)
+    credentials.Certificate = lambda *args, **kwargs: None
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    firestore.client = lambda *args, **kwargs: client
+    firestore.transactional = transactional
+
+    def verify_id_token(id_token, *args, **kwargs):
+        if not id_token.startswith(BENCH_TOKEN_PREFIX):
+            raise ValueError("Not a benchmark token")
+        uid = id_token[len(BENCH_TOKEN_PREFIX):]
+        return {'uid': uid, 'email': f"{uid}@bench.invalid", 'exp': time.time() + 3600}
+
+    auth.verify_id_token = verify_id_token
+    return client
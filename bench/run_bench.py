@@ -0,0 +1,412 @@
+"""Offline end-to-end benchmark for app.py.
+
+Starts the GitHub and OpenRouter stubs (bench/stubs.py) in a separate process, installs the
+in-memory Firestore (bench/fake_firestore.py), imports app.py pointed at all three and drives it
+the way the frontend does: every simulated user processes a repository through /process-repo,
+following the progress stream until the job completes, then asks questions through /ask-question
+or /ask-question-stream. Requests go through the Flask test client or, with --transport http, a
+real threaded server on a local port.
+
+The report is one JSON document: per-phase throughput and p50/p95/p99 latency, the requests
+each stub received, Firestore operation counts and peak memory. Compare two runs with e.g.
+
+    python bench/run_bench.py --users 8 --files 120 --output before.json
+    python bench/run_bench.py --users 8 --files 120 --output after.json
+
+Daily quotas are lifted for the run, and app.py's own log output goes to --app-log (discarded
+by default) so it doesn't drown the report.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_ROOT)
+
+import requests
+
+import fake_firestore
+import stubs
+
+QUESTIONS = [
+    "How do I run this application?",
+    "Where is the main entry point?",
+    "What does Handler1 do?",
+    "How are the helper functions used?",
+    "Which modules depend on each other?",
+    "How is the project structured?",
+    "What does module_3 implement?",
+    "Where would I add a new handler?",
+    "How are totals computed?",
+    "What dependencies does the project use?",
+    "How do the JavaScript and Python parts fit together?",
+    "What should a new developer read first?",
+]
+
+
+def percentile(sorted_values, fraction):
+    """Linearly interpolated percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def latency_summary(seconds):
+    values = sorted(seconds)
+    if not values:
+        return None
+    return {
+        'p50': round(percentile(values, 0.50) * 1000, 2),
+        'p95': round(percentile(values, 0.95) * 1000, 2),
+        'p99': round(percentile(values, 0.99) * 1000, 2),
+        'mean': round(sum(values) / len(values) * 1000, 2),
+        'max': round(values[-1] * 1000, 2),
+    }
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+
+def read_events(lines):
+    """Decode the `data: {...}` lines of a progress or answer stream"""
+    for line in lines:
+        if line.startswith('data: '):
+            yield json.loads(line[len('data: '):])
+
+
+class TestClientTransport:
+    """Calls the app in-process through Flask's test client, one client per worker thread"""
+    name = 'testclient'
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        return self.local.client
+
+    def post_json(self, path, body, headers):
+        response = self.client().post(path, json=body, headers=headers)
+        return response.status_code, response.get_json(silent=True) or {}
+
+    @contextlib.contextmanager
+    def post_stream(self, path, body, headers):
+        response = self.client().post(path, json=body, headers=headers, buffered=False)
+        def lines():
+            pending = b''
+            for chunk in response.response:
+                pending += chunk if isinstance(chunk, bytes) else chunk.encode()
+                *complete, pending = pending.split(b'\n')
+                for line in complete:
+                    yield line.decode()
+            if pending:
+                yield pending.decode()
+        try:
+            yield response.status_code, lines()
+        finally:
+            response.close()
+
+    def close(self):
+        pass
+
+
+class HttpTransport:
+    """Serves the app with Werkzeug's threaded server on a local port and calls it over HTTP"""
+    name = 'http'
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        # One access log line per request would flood the terminal the report is printed to
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.local = threading.local()
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def post_json(self, path, body, headers):
+        response = self.session().post(self.base_url + path, json=body, headers=headers, timeout=600)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, {}
+
+    @contextlib.contextmanager
+    def post_stream(self, path, body, headers):
+        with self.session().post(self.base_url + path, json=body, headers=headers, stream=True, timeout=600) as response:
+            yield response.status_code, response.iter_lines(decode_unicode=True)
+
+    def close(self):
+        self.server.shutdown()
+
+
+class Phase:
+    """Latency samples and outcomes of one kind of request"""
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.first_event = []
+        self.outcomes = {}
+        self.errors = []
+        self.started = self.finished = None
+
+    def record(self, seconds, outcome, first_event=None, error=None):
+        with self.lock:
+            self.latencies.append(seconds)
+            if first_event is not None:
+                self.first_event.append(first_event)
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            if error and len(self.errors) < 10:
+                self.errors.append(error)
+
+    def run(self, tasks, concurrency):
+        self.started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for future in [pool.submit(task) for task in tasks]:
+                future.result()
+        self.finished = time.perf_counter()
+
+    def report(self, first_event_label):
+        wall = (self.finished or 0) - (self.started or 0)
+        report = {
+            'requests': len(self.latencies),
+            'outcomes': self.outcomes,
+            'wall_seconds': round(wall, 3),
+            'throughput_per_second': round(len(self.latencies) / wall, 3) if wall > 0 else None,
+            'latency_ms': latency_summary(self.latencies),
+        }
+        if self.first_event:
+            report[f"{first_event_label}_ms"] = latency_summary(self.first_event)
+        if self.errors:
+            report['errors'] = self.errors
+        return report
+
+
+def process_repository(transport, phase, uid, repo_name):
+    """POST /process-repo and follow the progress stream to the end"""
+    body = {'github_url': f"https://github.com/{stubs.BENCH_OWNER}/{repo_name}"}
+    headers = {'Authorization': f"Bearer {fake_firestore.bench_token(uid)}"}
+    started = time.perf_counter()
+    queryable_at = None
+    outcome, error, repo_id = 'incomplete', None, None
+    try:
+        with transport.post_stream('/process-repo', body, headers) as (status, lines):
+            if status != 200:
+                outcome, error = f"http_{status}", f"{uid}: HTTP {status}"
+            for event in read_events(lines):
+                repo_id = event.get('repo_id') or repo_id
+                if event.get('queryable') and queryable_at is None:
+                    queryable_at = time.perf_counter() - started
+                if event.get('error'):
+                    outcome, error = 'error', f"{uid}: {event['error']}"
+                    break
+                if event.get('complete'):
+                    outcome = 'complete'
+                    break
+    except Exception as e:
+        outcome, error = 'exception', f"{uid}: {e!r}"
+    elapsed = time.perf_counter() - started
+    phase.record(elapsed, outcome, queryable_at if queryable_at is not None else (elapsed if outcome == 'complete' else None), error)
+    return repo_id if outcome == 'complete' else None
+
+
+def ask_question(transport, phase, uid, repo_id, question, stream):
+    """POST /ask-question, or read /ask-question-stream until its done event"""
+    body = {'repo_id': repo_id, 'question': question}
+    headers = {'Authorization': f"Bearer {fake_firestore.bench_token(uid)}"}
+    started = time.perf_counter()
+    first_delta, outcome, error = None, 'incomplete', None
+    try:
+        if stream:
+            with transport.post_stream('/ask-question-stream', body, headers) as (status, lines):
+                if status != 200:
+                    outcome, error = f"http_{status}", f"{uid}: HTTP {status}"
+                for event in read_events(lines):
+                    if event.get('delta') and first_delta is None:
+                        first_delta = time.perf_counter() - started
+                    if event.get('error'):
+                        outcome, error = 'error', f"{uid}: {event['error']}"
+                        break
+                    if event.get('done'):
+                        outcome = event.get('source', 'answered')
+                        break
+        else:
+            status, data = transport.post_json('/ask-question', body, headers)
+            if status == 200:
+                outcome = data.get('source', 'answered')
+            else:
+                outcome, error = f"http_{status}", f"{uid}: {data.get('error', status)}"
+    except Exception as e:
+        outcome, error = 'exception', f"{uid}: {e!r}"
+    phase.record(time.perf_counter() - started, outcome, first_delta, error)
+
+
+def start_stub_process(argv):
+    """Run stubs.py in its own process, so its threads don't compete with the app for the GIL"""
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'stubs.py')] + argv,
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line:
+        process.kill()
+        raise RuntimeError("stubs.py exited before reporting its ports")
+    return process, json.loads(line)
+
+
+def stub_stats(base_url):
+    return requests.get(f"{base_url}/_bench/stats", timeout=10).json()
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0], allow_abbrev=False)
+    run = parser.add_argument_group('load')
+    run.add_argument('--users', type=int, default=4, help='simulated users; user i processes repo i %% --repos')
+    run.add_argument('--questions-per-user', type=int, default=5)
+    run.add_argument('--concurrency', type=int, default=4, help='requests in flight at once')
+    run.add_argument('--transport', choices=('testclient', 'http'), default='testclient')
+    run.add_argument('--ask-endpoint', choices=('ask-question', 'ask-question-stream'), default='ask-question')
+    run.add_argument('--firestore-latency-ms', type=float, default=2, help='delay added to every fake Firestore call')
+    run.add_argument('--file-concurrency', type=int, help='FILE_PROCESSING_CONCURRENCY for the app')
+    run.add_argument('--tracemalloc', action='store_true', help='also report peak Python heap per phase (slows the run down)')
+    run.add_argument('--label', help='free-form name stored in the report')
+    run.add_argument('--output', help='write the JSON report here instead of stdout')
+    run.add_argument('--app-log', default=os.devnull, help="where app.py's print output goes")
+    stubs.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    stub_process, urls = start_stub_process(argv)
+    work_dir = tempfile.mkdtemp(prefix='codecompass-bench-')
+    transport = app_log = None
+    try:
+        os.environ.update({
+            'GITHUB_API_BASE': urls['github'],
+            'OPENROUTER_API_URL': f"{urls['openrouter']}/api/v1/chat/completions",
+            'OPENROUTER_API_KEY': 'bench',
+            # Fresh caches, so every run starts cold
+            'VECTOR_INDEX_DIR': os.path.join(work_dir, 'vector_index'),
+            'HTTP_CACHE_DIR': os.path.join(work_dir, 'http_cache'),
+        })
+        if args.file_concurrency:
+            os.environ['FILE_PROCESSING_CONCURRENCY'] = str(args.file_concurrency)
+        fake_db = fake_firestore.install(args.firestore_latency_ms)
+
+        app_log = open(args.app_log, 'w')
+        with contextlib.redirect_stdout(app_log):
+            import_started = time.perf_counter()
+            import app as codecompass
+            import_seconds = time.perf_counter() - import_started
+        unlimited = 10 ** 9
+        codecompass.MAX_REPOS_PER_DAY = codecompass.MAX_MESSAGES_PER_DAY = unlimited
+        codecompass.QUOTA_LIMITS.update(repo=unlimited, message=unlimited)
+        rss_after_import = peak_rss_bytes()
+
+        transport = HttpTransport(codecompass.app) if args.transport == 'http' else TestClientTransport(codecompass.app)
+        users = [f"bench-user-{index}" for index in range(args.users)]
+        phases = {'process_repo': Phase('process_repo'), 'ask_question': Phase('ask_question')}
+        heap_peaks = {}
+        if args.tracemalloc:
+            tracemalloc.start()
+
+        with contextlib.redirect_stdout(app_log):
+            repo_ids = {}
+            def process(uid, repo_name):
+                repo_ids[uid] = process_repository(transport, phases['process_repo'], uid, repo_name)
+            phases['process_repo'].run([
+                (lambda uid=uid, index=index: process(uid, f"repo-{index % args.repos}"))
+                for index, uid in enumerate(users)
+            ], args.concurrency)
+            if args.tracemalloc:
+                heap_peaks['process_repo'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.reset_peak()
+
+            # Users take turns so that questions from different users interleave; each user steps through
+            # the list from a different offset, so some questions repeat across users sharing a repository
+            phases['ask_question'].run([
+                (lambda uid=uid, question=QUESTIONS[(index * 3 + turn) % len(QUESTIONS)]:
+                    ask_question(transport, phases['ask_question'], uid, repo_ids[uid], question, args.ask_endpoint == 'ask-question-stream'))
+                for turn in range(args.questions_per_user)
+                for index, uid in enumerate(users) if repo_ids.get(uid)
+            ], args.concurrency)
+            if args.tracemalloc:
+                heap_peaks['ask_question'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            # Flush pending quota counters, so their writes are part of the Firestore counts
+            codecompass.quota.sync()
+
+        memory = {'max_rss_bytes': peak_rss_bytes(), 'max_rss_after_import_bytes': rss_after_import}
+        if heap_peaks:
+            memory['tracemalloc_peak_bytes'] = heap_peaks
+        report = {
+            'label': args.label,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'app_log', 'label')},
+            'app_import_seconds': round(import_seconds, 3),
+            'phases': {
+                'process_repo': phases['process_repo'].report('queryable'),
+                'ask_question': phases['ask_question'].report('first_delta'),
+            },
+            'upstream_requests': {
+                'github': stub_stats(urls['github']),
+                'openrouter': stub_stats(urls['openrouter']),
+                'firestore': fake_db.summary(),
+            },
+            'memory': memory,
+        }
+    finally:
+        if transport is not None:
+            transport.close()
+        if app_log is not None:
+            app_log.close()
+        stub_process.terminate()
+        stub_process.wait(timeout=10)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + '\n')
+    else:
+        print(output)
+    failed = sum(count for phase in report['phases'].values() for outcome, count in phase['outcomes'].items()
+                 if outcome not in ('complete', 'ai_analysis', 'cache'))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
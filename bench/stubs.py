@@ -0,0 +1,555 @@
+"""Local stand-ins for the GitHub REST API and OpenRouter's chat completions endpoint.
+
+The GitHub stub serves synthetic repositories (bench/repo-0, bench/repo-1, ...) through the
+endpoints app.py calls: commits (SHA, list and detail), recursive Git trees, Contents and the
+tarball, with ETags and optional rate limiting. The OpenRouter stub answers each of app.py's
+prompts with well-formed JSON or prose after a configurable delay, streams when asked to, and
+returns 429s once a configurable request rate is exceeded.
+
+Both servers count what they were asked for; GET /_bench/stats returns the counts and
+POST /_bench/reset clears them. Run standalone, this prints one JSON line with both base URLs
+and serves until killed:
+
+    python bench/stubs.py --files 200 --depth 4 --llm-latency-ms 300
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import sys
+import tarfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+BENCH_OWNER = 'bench'
+
+# Enough of each language for the static extractors and the file filter to have something to do
+SOURCE_TEMPLATES = {
+    '.py': ('"""{name}: synthetic benchmark module."""\nimport os\nimport json\n\n',
+            'class Handler{n}:\n    """Handles case {n}."""\n\n    def __init__(self, limit={n}):\n        self.limit = limit\n\n'
+            '    def run(self, items):\n        total = 0\n        for item in items[:self.limit]:\n            total += item * {n}\n        return total\n\n\n'
+            'def helper_{n}(values):\n    return [value for value in values if value % {m}]\n\n\n'),
+    '.js': ('// {name}: synthetic benchmark module\nconst path = require("path");\n\n',
+            'class Handler{n} {{\n  constructor(limit = {n}) {{\n    this.limit = limit;\n  }}\n\n  run(items) {{\n'
+            '    return items.slice(0, this.limit).reduce((total, item) => total + item * {n}, 0);\n  }}\n}}\n\n'
+            'function helper{n}(values) {{\n  return values.filter((value) => value % {m});\n}}\n\nmodule.exports.helper{n} = helper{n};\n\n'),
+    '.ts': ('// {name}: synthetic benchmark module\nimport {{ readFileSync }} from "fs";\n\n',
+            'export interface Options{n} {{\n  limit: number;\n}}\n\nexport class Handler{n} {{\n  constructor(private options: Options{n}) {{}}\n\n'
+            '  run(items: number[]): number {{\n    return items.slice(0, this.options.limit).reduce((total, item) => total + item * {n}, 0);\n  }}\n}}\n\n'
+            'export function helper{n}(values: number[]): number[] {{\n  return values.filter((value) => value % {m});\n}}\n\n'),
+    '.go': ('// {name}: synthetic benchmark package\npackage bench\n\nimport "fmt"\n\n',
+            'type Handler{n} struct {{\n\tLimit int\n}}\n\nfunc (h *Handler{n}) Run(items []int) int {{\n\ttotal := 0\n'
+            '\tfor i, item := range items {{\n\t\tif i >= h.Limit {{\n\t\t\tbreak\n\t\t}}\n\t\ttotal += item * {n}\n\t}}\n\treturn total\n}}\n\n'
+            'func Helper{n}(values []int) string {{\n\treturn fmt.Sprint(len(values) % {m})\n}}\n\n'),
+    '.java': ('// {name}: synthetic benchmark class\npackage bench;\n\nimport java.util.List;\n\npublic class {cls} {{\n',
+              '    public static int handler{n}(List<Integer> items) {{\n        int total = 0;\n        for (int item : items) {{\n'
+              '            total += item * {n};\n        }}\n        return total % {m};\n    }}\n\n'),
+}
+SOURCE_FOOTERS = {'.java': '}\n'}
+
+
+def git_blob_sha(data):
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+class SyntheticRepo:
+    """A repository generated from a seed: files of the requested languages spread over nested
+    directories, a README and manifest, optional vendored files and a short commit history"""
+    def __init__(self, owner, name, files=50, depth=3, file_size=2000, languages=('.py', '.js'),
+                 vendored_files=0, commits=5, seed=0):
+        self.owner = owner
+        self.name = name
+        rng = random.Random(f"{seed}/{name}")
+        self.files = {}  # path -> bytes
+
+        directories = ['src']
+        for level in range(depth):
+            # Each level adds a handful of directories under ones from the level above
+            parents = [d for d in directories if d.count('/') == level]
+            for index in range(max(1, int(math.sqrt(files)) // (level + 1))):
+                directories.append(f"{rng.choice(parents)}/pkg{level}_{index}")
+
+        entry_extension = languages[0]
+        self.files[f"src/main{entry_extension}"] = self.source(entry_extension, 'main', file_size, rng)
+        for index in range(files - 1):
+            extension = languages[index % len(languages)]
+            self.files[f"{rng.choice(directories)}/module_{index}{extension}"] = self.source(extension, f"module_{index}", file_size, rng)
+        for index in range(vendored_files):
+            self.files[f"vendor/lib{index % 7}/dep_{index}.js"] = self.source('.js', f"dep_{index}", file_size, rng)
+        self.files['README.md'] = f"# {name}\n\nSynthetic repository for CodeCompass benchmarks.\n\nRun `python src/main.py`.\n".encode()
+        self.files['package.json'] = json.dumps({'name': name, 'version': '1.0.0', 'main': f"src/main{entry_extension}"}, indent=2).encode()
+
+        self.build_trees()
+
+        paths = sorted(self.files)
+        self.commits = []  # oldest first: (sha, changed paths)
+        for index in range(max(1, commits)):
+            sha = hashlib.sha1(f"{owner}/{name}/{self.tree_sha}/{index}".encode()).hexdigest()
+            self.commits.append((sha, rng.sample(paths, min(3, len(paths)))))
+        self.head = self.commits[-1][0]
+        self.tarball_lock = threading.Lock()
+        self.tarball_bytes = None
+
+    def source(self, extension, name, size, rng):
+        header, unit = SOURCE_TEMPLATES.get(extension, SOURCE_TEMPLATES['.py'])
+        cls = ''.join(part.title() for part in name.split('_'))
+        parts = [header.format(name=name, cls=cls)]
+        length = len(parts[0])
+        target = max(200, int(size * rng.uniform(0.5, 1.5)))
+        n = 0
+        while length < target:
+            n += 1
+            part = unit.format(n=n, m=rng.randint(2, 9))
+            parts.append(part)
+            length += len(part)
+        parts.append(SOURCE_FOOTERS.get(extension, ''))
+        return ''.join(parts).encode()
+
+    def build_trees(self):
+        """Tree objects by SHA, each a list of its direct entries, plus the recursive listing"""
+        children = {'': {}}  # directory -> {name: entry}
+        for path, data in sorted(self.files.items()):
+            parts = path.split('/')
+            for depth in range(1, len(parts)):
+                directory = '/'.join(parts[:depth])
+                parent = '/'.join(parts[:depth - 1])
+                children.setdefault(directory, {})
+                children[parent].setdefault(parts[depth - 1], {'path': parts[depth - 1], 'mode': '040000', 'type': 'tree', 'dir': directory})
+            parent = '/'.join(parts[:-1])
+            children[parent][parts[-1]] = {'path': parts[-1], 'mode': '100644', 'type': 'blob', 'sha': git_blob_sha(data), 'size': len(data)}
+
+        self.trees = {}  # tree sha -> direct entries
+        self.directory_entries = {}  # directory path -> direct entries with full paths (Contents API)
+
+        def tree_sha(directory):
+            entries = []
+            for name in sorted(children[directory]):
+                entry = dict(children[directory][name])
+                if entry['type'] == 'tree':
+                    entry['sha'] = tree_sha(entry.pop('dir'))
+                entries.append(entry)
+            sha = hashlib.sha1(json.dumps(entries, sort_keys=True).encode()).hexdigest()
+            self.trees[sha] = entries
+            self.directory_entries[directory] = [
+                {'name': entry['path'], 'path': f"{directory}/{entry['path']}" if directory else entry['path'],
+                 'type': 'dir' if entry['type'] == 'tree' else 'file', 'sha': entry['sha'], 'size': entry.get('size', 0)}
+                for entry in entries
+            ]
+            return sha
+
+        self.tree_sha = tree_sha('')
+
+    def recursive_entries(self, sha, prefix=''):
+        """Every entry below a tree, with paths relative to it, as a recursive Trees API call lists them"""
+        entries = []
+        for entry in self.trees[sha]:
+            entries.append(dict(entry, path=prefix + entry['path']))
+            if entry['type'] == 'tree':
+                entries.extend(self.recursive_entries(entry['sha'], prefix + entry['path'] + '/'))
+        return entries
+
+    def resolve(self, ref):
+        """Commit SHA for HEAD, main or a known commit SHA"""
+        if ref in ('HEAD', 'main', 'master', None, ''):
+            return self.head
+        for sha, _ in self.commits:
+            if sha == ref or (len(ref) >= 7 and sha.startswith(ref)):
+                return sha
+        return None
+
+    def tarball(self):
+        with self.tarball_lock:
+            if self.tarball_bytes is None:
+                buffer = io.BytesIO()
+                top = f"{self.owner}-{self.name}-{self.head[:7]}"
+                with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+                    for path, data in sorted(self.files.items()):
+                        info = tarfile.TarInfo(f"{top}/{path}")
+                        info.size = len(data)
+                        info.mtime = 0
+                        archive.addfile(info, io.BytesIO(data))
+                self.tarball_bytes = buffer.getvalue()
+            return self.tarball_bytes
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, handler, config):
+        super().__init__(address, handler)
+        self.config = config
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.counts = Counter()
+
+    def count(self, **increments):
+        with self.stats_lock:
+            self.counts.update(increments)
+
+    def stats(self):
+        with self.stats_lock:
+            return dict(self.counts)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_json(self, status, data, headers=None):
+        self.send_body(status, json.dumps(data), headers=headers)
+
+    def handle_bench_endpoint(self):
+        """The /_bench/ control endpoints shared by both stubs; returns True if one was called"""
+        if self.path == '/_bench/stats':
+            self.send_json(200, self.server.stats())
+        elif self.path == '/_bench/reset':
+            self.server.reset_stats()
+            self.send_json(200, {'reset': True})
+        else:
+            return False
+        return True
+
+
+class GitHubStubHandler(StubHandler):
+    ROUTE = re.compile(r'^/repos/(?P<owner>[^/]+)/(?P<repo>[^/]+)(?:/(?P<kind>commits|git/trees|contents|tarball)(?:/(?P<rest>.*))?)?$')
+
+    def do_POST(self):
+        if not self.handle_bench_endpoint():
+            self.send_json(404, {'message': 'Not Found'})
+
+    def do_GET(self):
+        if self.handle_bench_endpoint():
+            return
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        match = self.ROUTE.match(url.path)
+        repo = self.server.config['repos'].get((match['owner'], match['repo'])) if match else None
+        kind = (match['kind'] or 'repo').replace('git/', '') if match else 'unknown'
+
+        if self.server.config['github_latency']:
+            time.sleep(self.server.config['github_latency'])
+        rate_headers = self.rate_limit(kind)
+        if rate_headers is None:
+            return
+        if repo is None:
+            self.server.count(**{f"{kind}": 1, 'status_404': 1})
+            return self.send_json(404, {'message': 'Not Found'}, rate_headers)
+
+        status, body, content_type = self.route(repo, kind, unquote(match['rest'] or ''), params)
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            # Conditional requests answered with 304 don't count against GitHub's rate limit
+            self.server.count(**{kind: 1, 'not_modified': 1})
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            for name, value in rate_headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        self.server.count(**{kind: 1, f"status_{status}": 1, 'bytes_sent': len(body)})
+        self.send_body(status, body, content_type, dict(rate_headers, ETag=etag))
+
+    def rate_limit(self, kind):
+        """X-RateLimit headers for this request, or None after answering 403 when the limit is used up"""
+        config = self.server.config
+        limit = config['github_rate_limit']
+        if not limit:
+            return {'X-RateLimit-Limit': '5000', 'X-RateLimit-Remaining': '4999'}
+        window = config['github_rate_window']
+        with self.server.stats_lock:
+            now = time.time()
+            window_start = now - now % window
+            if config.get('github_window_start') != window_start:
+                config['github_window_start'] = window_start
+                config['github_window_used'] = 0
+            config['github_window_used'] += 1
+            remaining = limit - config['github_window_used']
+        headers = {'X-RateLimit-Limit': str(limit), 'X-RateLimit-Remaining': str(max(remaining, 0)),
+                   'X-RateLimit-Reset': str(int(window_start + window))}
+        if remaining < 0:
+            self.server.count(**{kind: 1, 'rate_limited': 1})
+            self.send_json(403, {'message': 'API rate limit exceeded'}, headers)
+            return None
+        return headers
+
+    def route(self, repo, kind, rest, params):
+        """(status, body, content type) for a request to one of the repository endpoints"""
+        if kind == 'repo':
+            return 200, {'full_name': f"{repo.owner}/{repo.name}", 'default_branch': 'main', 'private': False,
+                         'size': sum(len(data) for data in repo.files.values()) // 1024}, 'application/json'
+
+        if kind == 'commits' and rest:
+            sha = repo.resolve(rest)
+            if sha is None:
+                return 404, {'message': 'No commit found'}, 'application/json'
+            if 'application/vnd.github.sha' in self.headers.get('Accept', ''):
+                return 200, sha, 'text/plain'
+            changed = dict(repo.commits)[sha]
+            return 200, {'sha': sha, 'commit': {'tree': {'sha': repo.tree_sha}}, 'files': [{'filename': path, 'status': 'modified'} for path in changed]}, 'application/json'
+
+        if kind == 'commits':
+            head = repo.resolve(params.get('sha', 'HEAD'))
+            shas = [sha for sha, _ in repo.commits]
+            newest_first = list(reversed(shas[:shas.index(head) + 1])) if head else []
+            return 200, [{'sha': sha} for sha in newest_first[:int(params.get('per_page', 30))]], 'application/json'
+
+        if kind == 'trees':
+            sha = repo.tree_sha if repo.resolve(rest) else rest
+            if sha not in repo.trees:
+                return 404, {'message': 'Not Found'}, 'application/json'
+            if params.get('recursive'):
+                limit = self.server.config['tree_truncate_entries']
+                entries = repo.recursive_entries(sha)
+                return 200, {'sha': sha, 'tree': entries[:limit], 'truncated': len(entries) > limit}, 'application/json'
+            return 200, {'sha': sha, 'tree': repo.trees[sha], 'truncated': False}, 'application/json'
+
+        if kind == 'contents':
+            path = rest.strip('/')
+            if path in repo.files:
+                data = repo.files[path]
+                return 200, {'type': 'file', 'name': path.rsplit('/', 1)[-1], 'path': path, 'sha': git_blob_sha(data),
+                             'size': len(data), 'encoding': 'base64', 'content': base64.b64encode(data).decode()}, 'application/json'
+            if path in repo.directory_entries:
+                return 200, repo.directory_entries[path], 'application/json'
+            return 404, {'message': 'Not Found'}, 'application/json'
+
+        if kind == 'tarball':
+            return 200, repo.tarball(), 'application/x-gzip'
+        return 404, {'message': 'Not Found'}, 'application/json'
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Seconds until a request would be allowed; 0 means it was allowed and counted"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class OpenRouterStubHandler(StubHandler):
+    def do_GET(self):
+        if not self.handle_bench_endpoint():
+            self.send_json(404, {'error': {'message': 'Not Found'}})
+
+    def do_POST(self):
+        if self.handle_bench_endpoint():
+            return
+        config = self.server.config
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        prompt = '\n'.join(message.get('content', '') for message in body.get('messages', []))
+        kind, content = self.respond(prompt)
+
+        bucket = config.get('llm_bucket')
+        wait = bucket.take() if bucket else 0
+        if wait:
+            self.server.count(rate_limited=1)
+            reset_ms = int((time.time() + wait) * 1000)
+            return self.send_json(429, {'error': {'code': 429, 'message': 'Rate limit exceeded'}}, {
+                'Retry-After': str(max(1, math.ceil(wait))), 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset_ms)})
+
+        usage = {'prompt_tokens': estimate_tokens(prompt), 'completion_tokens': estimate_tokens(content)}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        self.server.count(requests=1, **{f"kind_{kind}": 1}, prompt_tokens=usage['prompt_tokens'], completion_tokens=usage['completion_tokens'])
+
+        jitter = 1 + random.uniform(-config['llm_jitter'], config['llm_jitter'])
+        first_token_delay = config['llm_latency'] * jitter
+        token_delay = config['llm_token_latency'] * jitter
+        if body.get('stream'):
+            self.server.count(streamed=1)
+            return self.stream(body, content, usage, first_token_delay, token_delay)
+
+        time.sleep(first_token_delay + token_delay * usage['completion_tokens'])
+        self.send_json(200, {
+            'id': f"gen-{random.getrandbits(48):x}", 'model': body.get('model'), 'object': 'chat.completion',
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': usage,
+        })
+
+    def stream(self, body, content, usage, first_token_delay, token_delay):
+        """Server-sent events in OpenRouter's format, written with chunked transfer encoding"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write(text):
+            data = text.encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def event(delta, **extra):
+            return 'data: ' + json.dumps(dict({'model': body.get('model'), 'choices': [{'index': 0, 'delta': delta}]}, **extra)) + '\n\n'
+
+        write(': OPENROUTER PROCESSING\n\n')
+        time.sleep(first_token_delay)
+        words = re.findall(r'\S+\s*', content)
+        for start in range(0, len(words), 4):
+            piece = ''.join(words[start:start + 4])
+            time.sleep(token_delay * estimate_tokens(piece))
+            write(event({'content': piece}))
+        write(event({}, usage=usage))
+        write('data: [DONE]\n\n')
+        self.wfile.write(b"0\r\n\r\n")
+
+    def respond(self, prompt):
+        """(prompt kind, completion) for each prompt app.py sends"""
+        config = self.server.config
+        paths = re.findall(r'^File: (\S+)', prompt, re.MULTILINE)
+
+        def metadata(path):
+            stem = path.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+            return {'main_purpose': f"Implements {stem} for the synthetic application", 'functions': [f"helper_{stem}"],
+                    'classes': [f"Handler{stem.title()}"], 'imports': ['os', 'json'], 'dependencies': [], 'complexity': 'low'}
+
+        def summary(path):
+            return f"{path} implements part of the synthetic application. " + prose(config['llm_summary_tokens'])
+
+        def prose(tokens):
+            words = ['The', 'module', 'wires', 'handlers', 'into', 'the', 'request', 'pipeline', 'and', 'returns', 'totals', 'to', 'callers.']
+            return ' '.join(words[index % len(words)] for index in range(max(1, int(tokens * 0.75))))
+
+        if 'JSON array with one object per file' in prompt:
+            return 'batch_analysis', json.dumps([{'path': path, 'metadata': metadata(path), 'summary': summary(path)} for path in paths])
+        if 'Return ONLY a JSON object of the form {"metadata"' in prompt:
+            return 'file_analysis', json.dumps({'metadata': metadata(paths[0] if paths else 'file'), 'summary': summary(paths[0] if paths else 'file')})
+        if 'extract metadata in JSON format' in prompt:
+            return 'file_metadata', json.dumps(metadata(paths[0] if paths else 'file'))
+        if 'Summarize this code file' in prompt:
+            return 'file_summary', summary(paths[0] if paths else 'file')
+        if 'Analyze this repository structure' in prompt:
+            return 'structure', json.dumps({
+                'architecture_type': 'web app', 'main_technologies': ['Python', 'JavaScript'], 'project_structure': 'Sources under src/',
+                'entry_points': ['src/main.py', 'src/main.js', 'src/main.ts'], 'build_system': 'npm', 'testing_approach': 'none found',
+                'documentation_files': ['README.md'], 'key_directories': {'src': 'application code'}})
+        if 'generate common questions' in prompt:
+            return 'common_qa', json.dumps([{'question': question, 'answer': prose(40)} for question in (
+                'How do I run this application?', 'Where is the main entry point?', 'How are tests run?',
+                'What are the main modules?', 'How is the project structured?', 'What dependencies does it use?',
+                'How do I set up a development environment?', 'What does the handler pipeline do?')])
+        if 'select the 3-5 most relevant files' in prompt:
+            return 'file_selection', json.dumps(paths[:4])
+        if 'Respond with the summary only' in prompt:
+            return 'chat_summary', prose(config['llm_summary_tokens'])
+        return 'answer', prose(config['llm_answer_tokens'])
+
+
+def build_repos(count, **shape):
+    repos = {}
+    for index in range(count):
+        repo = SyntheticRepo(BENCH_OWNER, f"repo-{index}", **shape)
+        repos[(repo.owner, repo.name)] = repo
+    return repos
+
+
+def add_arguments(parser):
+    """Repository shape and upstream behaviour options, shared with run_bench.py"""
+    shape = parser.add_argument_group('synthetic repositories')
+    shape.add_argument('--repos', type=int, default=2, help='distinct repositories (bench/repo-0 ...)')
+    shape.add_argument('--files', type=int, default=60, help='source files per repository')
+    shape.add_argument('--depth', type=int, default=3, help='directory nesting below src/')
+    shape.add_argument('--file-size', type=int, default=2500, help='average source file size in bytes')
+    shape.add_argument('--languages', default='.py,.js,.ts', help='comma-separated extensions, the first one is the entry point language')
+    shape.add_argument('--vendored-files', type=int, default=10, help='files under vendor/ that processing should skip')
+    shape.add_argument('--commits', type=int, default=5, help='commits in each repository history')
+    shape.add_argument('--seed', type=int, default=0)
+
+    github = parser.add_argument_group('GitHub stub')
+    github.add_argument('--github-latency-ms', type=float, default=10)
+    github.add_argument('--github-rate-limit', type=int, default=0, help='requests per window before 403s, 0 for unlimited')
+    github.add_argument('--github-rate-window', type=float, default=60)
+    github.add_argument('--tree-truncate-entries', type=int, default=100000, help='recursive trees longer than this come back truncated')
+
+    llm = parser.add_argument_group('OpenRouter stub')
+    llm.add_argument('--llm-latency-ms', type=float, default=150, help='time to first token')
+    llm.add_argument('--llm-token-ms', type=float, default=1, help='time per completion token')
+    llm.add_argument('--llm-jitter', type=float, default=0.2, help='+/- fraction applied to both delays')
+    llm.add_argument('--llm-rate-limit', type=float, default=0, help='requests per second before 429s, 0 for unlimited')
+    llm.add_argument('--llm-burst', type=int, default=0, help='requests allowed at once before the rate applies (default: one second worth)')
+    llm.add_argument('--llm-answer-tokens', type=int, default=200)
+    llm.add_argument('--llm-summary-tokens', type=int, default=60)
+
+
+def start_stubs(args):
+    """Start both stubs on ephemeral ports in daemon threads; returns (github server, openrouter server)"""
+    repos = build_repos(args.repos, files=args.files, depth=args.depth, file_size=args.file_size,
+                        languages=tuple(ext if ext.startswith('.') else f".{ext}" for ext in args.languages.split(',')),
+                        vendored_files=args.vendored_files, commits=args.commits, seed=args.seed)
+    github = StubServer(('127.0.0.1', 0), GitHubStubHandler, {
+        'repos': repos, 'github_latency': args.github_latency_ms / 1000, 'github_rate_limit': args.github_rate_limit,
+        'github_rate_window': args.github_rate_window, 'tree_truncate_entries': args.tree_truncate_entries})
+    openrouter = StubServer(('127.0.0.1', 0), OpenRouterStubHandler, {
+        'llm_latency': args.llm_latency_ms / 1000, 'llm_token_latency': args.llm_token_ms / 1000, 'llm_jitter': args.llm_jitter,
+        'llm_bucket': TokenBucket(args.llm_rate_limit, args.llm_burst or max(1, int(args.llm_rate_limit))) if args.llm_rate_limit else None,
+        'llm_answer_tokens': args.llm_answer_tokens, 'llm_summary_tokens': args.llm_summary_tokens})
+    for server in (github, openrouter):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return github, openrouter
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0], allow_abbrev=False)
+    add_arguments(parser)
+    # run_bench.py passes its whole command line; the options that only concern it are ignored
+    args, _ = parser.parse_known_args(argv)
+    github, openrouter = start_stubs(args)
+    print(json.dumps({'github': github.url, 'openrouter': openrouter.url}), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,322 @@
+"""Static metadata extraction: functions, classes, imports and dependencies read from source code
+without the LLM. Python sources are parsed with ast, package manifests with json, and other
+languages with per-extension regular expressions.
+
+This module has no side effects on import, so the process pool in app.py can run
+extract_static_metadata in workers without starting Firebase, Flask or the HTTP clients.
+"""
+import ast
+import bisect
+import json
+import os
+import re
+import sys
+
+# Words the loose method patterns pick up from control flow such as "} else if (x) {"
+NON_SYMBOL_KEYWORDS = {
+    'if', 'else', 'for', 'while', 'switch', 'catch', 'return', 'function', 'new', 'do', 'try',
+    'with', 'elif', 'foreach', 'sizeof', 'typeof', 'await', 'throw', 'case', 'using', 'lock'
+}
+
+def _first_group(match):
+    return next(group for group in match.groups() if group)
+
+def _package_dependency(module):
+    """Package name for JS/Dart style imports, None for relative or absolute paths"""
+    if module.startswith(('.', '/', '#', '~')):
+        return None
+    if module.startswith('package:'):
+        module = module[len('package:'):]
+    if module.startswith('node:'):
+        return None
+    parts = module.split('/')
+    return '/'.join(parts[:2]) if module.startswith('@') else parts[0]
+
+def _dotted_dependency(*builtin_prefixes):
+    """Dependency rule for dotted/namespaced imports, ignoring the language's standard library"""
+    def dependency(module):
+        if module.startswith(builtin_prefixes):
+            return None
+        return '.'.join(module.replace('::', '.').replace('\\', '.').split('.')[:2])
+    return dependency
+
+def _go_dependency(module):
+    first = module.split('/')[0]
+    return module if '.' in first else None
+
+def _rust_dependency(module):
+    crate = module.split('::')[0]
+    return None if crate in ('std', 'core', 'alloc', 'crate', 'self', 'super') else crate
+
+def _c_dependency(module):
+    return None
+
+def _all_imports(module):
+    return module
+
+def _regex_spec(functions=(), classes=(), imports=(), dependency=_all_imports, flags=re.MULTILINE):
+    return {
+        'function': [re.compile(pattern, flags) for pattern in functions],
+        'class': [re.compile(pattern, flags) for pattern in classes],
+        'import': [re.compile(pattern, flags) for pattern in imports],
+        'dependency': dependency
+    }
+
+_JS_SPEC = _regex_spec(
+    functions=[
+        r'^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*([A-Za-z_$][\w$]*)',
+        r'^\s*(?:export\s+)?(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*(?::[^=]+)?=\s*(?:async\s+)?(?:function\b|\([^)]*\)\s*(?::[^=]+)?=>|[A-Za-z_$][\w$]*\s*=>)',
+        r'^[ \t]+(?:(?:public|private|protected|static|async|override|readonly|get|set)\s+)*([A-Za-z_$][\w$]*)\s*\([^)]*\)\s*(?::\s*[^{]+)?\{'
+    ],
+    classes=[r'^\s*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?(?:class|interface|enum)\s+([A-Za-z_$][\w$]*)'],
+    imports=[r'''(?:\bfrom\s+|^\s*import\s+|\brequire\s*\(\s*|\bimport\s*\(\s*)['"]([^'"]+)['"]'''],
+    dependency=_package_dependency
+)
+
+_JVM_METHOD = r'^[ \t]*(?:(?:public|private|protected|internal|static|final|abstract|synchronized|native|override|virtual|async|sealed|partial|extern|unsafe|new)\s+)*[\w<>\[\],.?]+\s+([A-Za-z_]\w*)\s*\([^;{)]*\)\s*(?:throws\s+[\w.,\s]+)?\{'
+
+STATIC_EXTRACTOR_SPECS = {
+    '.py': _regex_spec(
+        functions=[r'^\s*(?:async\s+)?def\s+([A-Za-z_]\w*)'],
+        classes=[r'^\s*class\s+([A-Za-z_]\w*)'],
+        imports=[r'^\s*from\s+([\w.]+)\s+import\b', r'^\s*import\s+([\w.]+)'],
+        dependency=lambda module: None if module.startswith('.') or module.split('.')[0] in sys.stdlib_module_names else module.split('.')[0]
+    ),
+    '.js': _JS_SPEC, '.jsx': _JS_SPEC, '.ts': _JS_SPEC, '.tsx': _JS_SPEC,
+    '.vue': _JS_SPEC, '.svelte': _JS_SPEC,
+    '.go': _regex_spec(
+        functions=[r'^func\s+(?:\([^)]*\)\s*)?([A-Za-z_]\w*)'],
+        classes=[r'^type\s+([A-Za-z_]\w*)\s+(?:struct|interface)\b'],
+        imports=[r'^\s*(?:import\s+)?(?:[\w.]+\s+)?"([^"]+)"\s*$'],
+        dependency=_go_dependency
+    ),
+    '.java': _regex_spec(
+        functions=[_JVM_METHOD],
+        classes=[r'^\s*(?:(?:public|private|protected|static|final|abstract|sealed)\s+)*(?:class|interface|enum|record|@interface)\s+([A-Za-z_]\w*)'],
+        imports=[r'^\s*import\s+(?:static\s+)?([\w.]+)'],
+        dependency=_dotted_dependency('java.', 'javax.', 'jdk.', 'sun.')
+    ),
+    '.kt': _regex_spec(
+        functions=[r'\bfun\s+(?:<[^>]*>\s*)?(?:[\w.]+\.)?([A-Za-z_]\w*)\s*\('],
+        classes=[r'^\s*(?:(?:public|private|internal|open|abstract|sealed|data|enum|inner|annotation)\s+)*(?:class|interface|object)\s+([A-Za-z_]\w*)'],
+        imports=[r'^\s*import\s+([\w.]+)'],
+        dependency=_dotted_dependency('java.', 'javax.', 'kotlin.', 'kotlinx.')
+    ),
+    '.scala': _regex_spec(
+        functions=[r'\bdef\s+([A-Za-z_]\w*)'],
+        classes=[r'^\s*(?:(?:case|abstract|sealed|final|implicit)\s+)*(?:class|trait|object)\s+([A-Za-z_]\w*)'],
+        imports=[r'^\s*import\s+([\w.]+)'],
+        dependency=_dotted_dependency('java.', 'javax.', 'scala.')
+    ),
+    '.cs': _regex_spec(
+        functions=[_JVM_METHOD],
+        classes=[r'^\s*(?:(?:public|private|protected|internal|static|abstract|sealed|partial|readonly)\s+)*(?:class|interface|struct|enum|record)\s+([A-Za-z_]\w*)'],
+        imports=[r'^\s*using\s+(?:static\s+)?([\w.]+)\s*;'],
+        dependency=_dotted_dependency('System', 'Microsoft.')
+    ),
+    '.rs': _regex_spec(
+        functions=[r'^\s*(?:pub(?:\([^)]*\))?\s+)?(?:const\s+)?(?:async\s+)?(?:unsafe\s+)?(?:extern\s+"[^"]*"\s+)?fn\s+([A-Za-z_]\w*)'],
+        classes=[r'^\s*(?:pub(?:\([^)]*\))?\s+)?(?:struct|enum|trait|union)\s+([A-Za-z_]\w*)'],
+        imports=[r'^\s*(?:pub(?:\([^)]*\))?\s+)?use\s+([\w:]+)', r'^\s*extern\s+crate\s+(\w+)'],
+        dependency=_rust_dependency
+    ),
+    '.php': _regex_spec(
+        functions=[r'\bfunction\s+&?([A-Za-z_]\w*)\s*\('],
+        classes=[r'^\s*(?:(?:abstract|final|readonly)\s+)*(?:class|interface|trait|enum)\s+([A-Za-z_]\w*)'],
+        imports=[r'^\s*use\s+([\w\\]+)', r'''\b(?:require|include)(?:_once)?\s*\(?\s*['"]([^'"]+)['"]'''],
+        dependency=lambda module: None if module.endswith('.php') else _dotted_dependency()(module)
+    ),
+    '.rb': _regex_spec(
+        functions=[r'^\s*def\s+(?:self\.)?([A-Za-z_]\w*[?!=]?)'],
+        classes=[r'^\s*(?:class|module)\s+([A-Z]\w*(?:::\w+)*)'],
+        imports=[r'''^\s*require\s*\(?\s*['"]([^'"]+)['"]''', r'''^\s*require_relative\s*\(?\s*['"]([^'"]+)['"]'''],
+        dependency=lambda module: None if module.startswith('.') else module.split('/')[0]
+    ),
+    '.swift': _regex_spec(
+        functions=[r'\bfunc\s+([A-Za-z_]\w*)'],
+        classes=[r'^\s*(?:(?:public|private|internal|open|final|fileprivate)\s+)*(?:class|struct|enum|protocol|actor|extension)\s+([A-Za-z_]\w*)'],
+        imports=[r'^\s*import\s+(\w+)'],
+        dependency=lambda module: None if module in ('Foundation', 'Swift', 'UIKit', 'SwiftUI', 'Combine', 'AppKit') else module
+    ),
+    '.dart': _regex_spec(
+        functions=[r'^\s*(?:static\s+)?(?:Future<[^>]*>|Stream<[^>]*>|[\w<>?,]+)\s+([a-z_]\w*)\s*\([^;]*?\)\s*(?:async\*?\s*)?\{'],
+        classes=[r'^\s*(?:abstract\s+)?(?:class|mixin|enum|extension)\s+([A-Za-z_]\w*)'],
+        imports=[r'''^\s*(?:import|export)\s+['"]([^'"]+)['"]'''],
+        dependency=lambda module: None if module.startswith('dart:') else _package_dependency(module)
+    ),
+    '.lua': _regex_spec(
+        functions=[r'\bfunction\s+([A-Za-z_][\w.:]*)\s*\(', r'^\s*(?:local\s+)?([A-Za-z_][\w.]*)\s*=\s*function\b'],
+        imports=[r'''\brequire\s*\(?\s*['"]([^'"]+)['"]''']
+    ),
+    '.sh': _regex_spec(
+        functions=[r'^\s*(?:function\s+)?([A-Za-z_][\w-]*)\s*\(\s*\)', r'^\s*function\s+([A-Za-z_][\w-]*)'],
+        imports=[r'^\s*(?:source|\.)\s+(\S+)'],
+        dependency=_c_dependency
+    ),
+    '.ps1': _regex_spec(
+        functions=[r'^\s*function\s+([\w-]+)'],
+        imports=[r'^\s*Import-Module\s+(\S+)', r'^\s*\.\s+(\S+\.ps1)'],
+        flags=re.MULTILINE | re.IGNORECASE
+    ),
+    '.pl': _regex_spec(
+        functions=[r'^\s*sub\s+(\w+)'],
+        classes=[r'^\s*package\s+([\w:]+)'],
+        imports=[r'^\s*(?:use|require)\s+([A-Za-z][\w:]*)'],
+        dependency=lambda module: None if module in ('strict', 'warnings', 'utf8', 'lib', 'constant', 'parent', 'base') else module
+    ),
+    '.r': _regex_spec(
+        functions=[r'^\s*([A-Za-z_.][\w.]*)\s*(?:<-|=)\s*function\b'],
+        imports=[r'''\b(?:library|require|requireNamespace)\s*\(\s*['"]?([\w.]+)''']
+    ),
+    '.m': _regex_spec(
+        functions=[r'^\s*[-+]\s*\([^)]*\)\s*(\w+)'],
+        classes=[r'^\s*@(?:interface|implementation|protocol)\s+(\w+)'],
+        imports=[r'^\s*#\s*(?:import|include)\s*<([^>]+)>', r'^\s*#\s*(?:import|include)\s*"([^"]+)"'],
+        dependency=_c_dependency
+    ),
+    '.clj': _regex_spec(
+        functions=[r'\(defn-?\s+([^\s\[\]()]+)', r'\(defmacro\s+([^\s\[\]()]+)'],
+        classes=[r'\((?:defrecord|deftype|defprotocol)\s+([^\s\[\]()]+)'],
+        imports=[r'\[\s*([a-z][\w\-]*(?:\.[\w\-]+)+)[\s\]]'],
+        dependency=lambda module: None if module.startswith('clojure.') else module
+    ),
+    '.sql': _regex_spec(
+        functions=[r'\bCREATE\s+(?:OR\s+REPLACE\s+)?(?:FUNCTION|PROCEDURE|TRIGGER)\s+([\w."]+)'],
+        classes=[r'\bCREATE\s+(?:OR\s+REPLACE\s+)?(?:TABLE|VIEW|TYPE)\s+(?:IF\s+NOT\s+EXISTS\s+)?([\w."]+)'],
+        flags=re.MULTILINE | re.IGNORECASE
+    ),
+    '.html': _regex_spec(
+        imports=[r'''<script[^>]+src=["']([^"']+)["']''', r'''<link[^>]+href=["']([^"']+\.css[^"']*)["']'''],
+        dependency=lambda module: module if module.startswith(('http://', 'https://', '//')) else None,
+        flags=re.IGNORECASE
+    ),
+    '.css': _regex_spec(
+        imports=[r'''@import\s+(?:url\()?\s*['"]?([^'");\s]+)'''],
+        dependency=_c_dependency
+    ),
+}
+STATIC_EXTRACTOR_SPECS['.bash'] = STATIC_EXTRACTOR_SPECS['.sh']
+STATIC_EXTRACTOR_SPECS['.scss'] = STATIC_EXTRACTOR_SPECS['.sass'] = STATIC_EXTRACTOR_SPECS['.css']
+
+_C_SPEC = _regex_spec(
+    # Type tokens and the separators between them use disjoint characters, so a line that is not a
+    # definition fails in linear time instead of backtracking over every way to split it
+    functions=[r'^(?:[A-Za-z_][\w:<>,]*[ \t\*&]+)+\**([A-Za-z_~][\w:~]*)\s*\([^;{}()]*\)\s*(?:const\s*)?(?:noexcept\s*)?(?:override\s*)?\{'],
+    classes=[r'^\s*(?:template\s*<[^>]*>\s*)?(?:class|struct|union|enum(?:\s+class)?)\s+([A-Za-z_]\w*)\s*(?::[^;{]*)?\{'],
+    imports=[r'^\s*#\s*include\s*<([^>]+)>', r'^\s*#\s*include\s*"([^"]+)"'],
+    dependency=_c_dependency
+)
+for _ext in ('.c', '.h', '.cpp', '.hpp'):
+    STATIC_EXTRACTOR_SPECS[_ext] = _C_SPEC
+
+def extract_with_patterns(content, spec):
+    """Regex/tokenizer based extraction for languages without a parser in the standard library"""
+    line_starts = [0] + [match.end() for match in re.finditer('\n', content)]
+    symbols = []
+    seen = set()
+    for kind in ('class', 'function'):
+        for pattern in spec[kind]:
+            for match in pattern.finditer(content):
+                name = _first_group(match)
+                line = bisect.bisect_right(line_starts, match.start(1))
+                if name in NON_SYMBOL_KEYWORDS or (name, line) in seen:
+                    continue
+                seen.add((name, line))
+                symbols.append({'name': name, 'kind': kind, 'line': line})
+    symbols.sort(key=lambda symbol: symbol['line'])
+    
+    imports = []
+    for pattern in spec['import']:
+        for match in pattern.finditer(content):
+            module = _first_group(match)
+            if module not in imports:
+                imports.append(module)
+    dependencies = []
+    for module in imports:
+        dependency = spec['dependency'](module)
+        if dependency and dependency not in dependencies:
+            dependencies.append(dependency)
+    
+    return {
+        'functions': [symbol['name'] for symbol in symbols if symbol['kind'] == 'function'],
+        'classes': [symbol['name'] for symbol in symbols if symbol['kind'] == 'class'],
+        'imports': imports,
+        'dependencies': dependencies,
+        'symbols': symbols
+    }
+
+def extract_python_metadata(content):
+    """Extract Python metadata with the ast module"""
+    tree = ast.parse(content)
+    symbols = []
+    
+    def visit(node, scope):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                name = f"{scope}.{child.name}" if scope else child.name
+                kind = 'class' if isinstance(child, ast.ClassDef) else 'function'
+                symbols.append({'name': name, 'kind': kind, 'line': child.lineno, 'end_line': child.end_lineno})
+                visit(child, name)
+            else:
+                visit(child, scope)
+    visit(tree, "")
+    symbols.sort(key=lambda symbol: symbol['line'])
+    
+    imports = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules = ['.' * node.level + (node.module or '')]
+        else:
+            continue
+        for module in modules:
+            if module not in imports:
+                imports.append(module)
+    
+    dependencies = []
+    for module in imports:
+        top_level = module.split('.')[0]
+        if top_level and top_level not in sys.stdlib_module_names and top_level not in dependencies:
+            dependencies.append(top_level)
+    
+    return {
+        'functions': [symbol['name'] for symbol in symbols if symbol['kind'] == 'function'],
+        'classes': [symbol['name'] for symbol in symbols if symbol['kind'] == 'class'],
+        'imports': imports,
+        'dependencies': dependencies,
+        'symbols': symbols
+    }
+
+def extract_json_metadata(content):
+    """Read declared dependencies from package manifests such as package.json or composer.json"""
+    data = json.loads(content)
+    dependencies = []
+    if isinstance(data, dict):
+        for key in ('dependencies', 'devDependencies', 'peerDependencies', 'require', 'require-dev'):
+            if isinstance(data.get(key), dict):
+                dependencies.extend(name for name in data[key] if name not in dependencies)
+    return {'functions': [], 'classes': [], 'imports': [], 'dependencies': dependencies, 'symbols': []}
+
+# Extensions with a real parser; every other extension in STATIC_EXTRACTOR_SPECS uses extract_with_patterns
+METADATA_EXTRACTORS = {
+    '.py': extract_python_metadata,
+    '.json': extract_json_metadata,
+}
+
+def extract_static_metadata(content, file_path):
+    """Extract functions, classes, imports and dependencies (with line numbers) without the LLM.
+
+    Returns None for languages without an extractor."""
+    _, ext = os.path.splitext(file_path.lower())
+    extractor = METADATA_EXTRACTORS.get(ext)
+    if extractor:
+        try:
+            return extractor(content)
+        except (SyntaxError, ValueError, RecursionError):
+            # Unparseable files (e.g. Python 2 sources) still get the pattern-based pass below
+            pass
+    spec = STATIC_EXTRACTOR_SPECS.get(ext)
+    if spec is None:
+        return None
+    return extract_with_patterns(content, spec)
@@ -0,0 +1,35 @@
+"""Unit test setup: app.py is imported once against the in-memory Firestore from bench/.
+
+The fake is installed before the import, so no credentials or network are needed, and local
+caches are pointed at a temporary directory. The fake_db fixture empties the fake between tests.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_ROOT, os.path.join(REPO_ROOT, 'bench')]
+
+import fake_firestore
+
+WORK_DIR = tempfile.mkdtemp(prefix='codecompass-tests-')
+os.environ.setdefault('VECTOR_INDEX_DIR', os.path.join(WORK_DIR, 'vector_index'))
+os.environ.setdefault('HTTP_CACHE_DIR', os.path.join(WORK_DIR, 'http_cache'))
+FAKE_DB = fake_firestore.install()
+
+import app as codecompass
+
+
+@pytest.fixture
+def app():
+    return codecompass
+
+
+@pytest.fixture
+def fake_db():
+    with FAKE_DB.lock:
+        FAKE_DB.documents.clear()
+    FAKE_DB.reset_stats()
+    return FAKE_DB
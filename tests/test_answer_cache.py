@@ -0,0 +1,56 @@
+import pytest
+
+from app import AnswerCache
+
+REPO = {'processed_at': 'run-1', 'common_qa': [{'question': 'How do I run this application?', 'answer': 'python app.py'}]}
+
+
+@pytest.fixture
+def cache():
+    return AnswerCache(max_entries=3, ttl_seconds=60)
+
+
+def test_exact_and_normalized_lookup(cache):
+    cache.store('repo', REPO, 'Where is the quota checked?', 'In QuotaManager.try_consume', [])
+    assert cache.lookup('repo', REPO, 'Where is the quota checked?')['answer'] == 'In QuotaManager.try_consume'
+    assert cache.lookup('repo', REPO, 'where is the QUOTA checked')['answer'] == 'In QuotaManager.try_consume'
+    assert cache.stats()['hits'] == 2
+
+
+def test_near_duplicate_lookup(cache):
+    cache.store('repo', REPO, 'How is the daily usage quota for each user enforced?', 'With usage documents', [])
+    entry = cache.lookup('repo', REPO, 'How is the daily usage quota for each user enforced in the backend?')
+    assert entry is not None and entry['answer'] == 'With usage documents'
+    assert cache.lookup('repo', REPO, 'Which embedder does semantic search use?') is None
+    assert cache.stats()['near_duplicate_hits'] == 1
+
+
+def test_common_questions_are_preloaded_and_pinned(cache):
+    assert cache.lookup('repo', REPO, 'how do I run this application')['origin'] == 'common_qa'
+    for name in ('quota', 'render', 'webhook', 'session', 'archive'):
+        cache.store('repo', REPO, f"Which module implements the {name} feature?", name, [])
+    assert cache.lookup('repo', REPO, 'How do I run this application?') is not None
+    # Only the most recent max_entries answers are kept besides the pinned ones
+    assert cache.lookup('repo', REPO, 'Which module implements the quota feature?') is None
+    assert cache.lookup('repo', REPO, 'Which module implements the archive feature?')['answer'] == 'archive'
+
+
+def test_short_questions_are_not_shared(cache):
+    cache.store('repo', REPO, 'Why?', 'Because', [])
+    assert cache.lookup('repo', REPO, 'Why?') is None
+
+
+def test_entries_belong_to_one_processed_version(cache):
+    cache.store('repo', REPO, 'Where is the quota checked?', 'old answer', [])
+    assert cache.lookup('repo', dict(REPO, processed_at='run-2'), 'Where is the quota checked?') is None
+    cache.store('repo', REPO, 'Where is the quota checked?', 'old answer', [])
+    cache.invalidate('repo')
+    assert cache.lookup('repo', REPO, 'Where is the quota checked?') is None
+    assert cache.lookup('other', REPO, 'Where is the quota checked?') is None
+
+
+def test_expired_entries_are_not_returned(cache, monkeypatch):
+    cache.store('repo', REPO, 'Where is the quota checked?', 'In QuotaManager', [])
+    entry = cache.lookup('repo', REPO, 'Where is the quota checked?')
+    monkeypatch.setitem(entry, 'expires_at', 0)
+    assert cache.lookup('repo', REPO, 'Where is the quota checked?') is None
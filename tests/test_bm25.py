@@ -0,0 +1,43 @@
+from app import BM25Index, tokenize_code
+
+FILES = {
+    'src/auth/token_cache.py': {'metadata': {'functions': ['verify_token'], 'main_purpose': 'Caches verified ID tokens'},
+                                'summary': 'Token cache', 'content': 'def verify_token(token):\n    return cache.get(token)\n'},
+    'src/quota.py': {'metadata': {'classes': ['QuotaManager']}, 'summary': 'Daily usage limits',
+                     'content': 'class QuotaManager:\n    def try_consume(self, uid):\n        pass\n'},
+    'README.md': {'summary': 'Setup instructions', 'content': 'Install the dependencies and run the server.\n'},
+}
+
+
+def test_tokenize_code_splits_identifiers_and_drops_stop_words():
+    assert tokenize_code('parseHTTPResponse') == ['parsehttpresponse', 'parse', 'http', 'response']
+    assert tokenize_code('max_file_size') == ['max_file_size', 'max', 'file', 'size']
+    assert tokenize_code('return self') == []
+
+
+def test_search_ranks_by_path_symbols_and_content():
+    index = BM25Index.from_file_records(FILES)
+    assert index.search('verify token cache')[0][0] == 'src/auth/token_cache.py'
+    assert index.search('QuotaManager try_consume')[0][0] == 'src/quota.py'
+    assert index.search('nothing matches xyzzy') == []
+
+
+def test_search_reports_the_best_matching_chunk():
+    index = BM25Index.from_file_records(FILES)
+    file_path, score, chunk = index.search('try_consume', top_k=1)[0]
+    assert file_path == 'src/quota.py' and score > 0
+    assert chunk == 'lines 1-3'
+
+
+def test_remove_and_add_files_update_the_index():
+    index = BM25Index.from_file_records(FILES)
+    index.remove_files({'src/quota.py'})
+    assert all(result[0] != 'src/quota.py' for result in index.search('QuotaManager'))
+    index.add_file('src/limits.py', {'metadata': {'classes': ['QuotaManager']}, 'content': 'class QuotaManager: pass\n'})
+    assert index.search('QuotaManager')[0][0] == 'src/limits.py'
+
+
+def test_to_dict_round_trip_gives_the_same_ranking():
+    index = BM25Index.from_file_records(FILES)
+    restored = BM25Index.from_dict(index.to_dict())
+    assert restored.search('token cache server') == index.search('token cache server')
@@ -0,0 +1,77 @@
+from app import FileFilter, glob_to_regex, parse_gitattributes, validate_repo_config
+
+
+def tree(*paths, size=100):
+    return [{'name': path.rsplit('/', 1)[-1], 'path': path, 'type': 'file', 'size': size, 'processable': True}
+            for path in paths]
+
+
+def test_validate_repo_config_keeps_valid_keys_and_reports_the_rest():
+    valid, problems = validate_repo_config({
+        'exclude': ['docs/**'],
+        'include': 'vendor/ours/**',
+        'size_limits': {'.json': 200000, '.csv': -1},
+        'skip_minified': False,
+        'colour': 'blue',
+    })
+    assert valid == {'exclude': ['docs/**'], 'skip_minified': False}
+    assert len(problems) == 3
+    assert any("'include'" in problem for problem in problems)
+    assert any("'size_limits'" in problem for problem in problems)
+    assert any("unknown key 'colour'" in problem for problem in problems)
+
+
+def test_validate_repo_config_rejects_non_objects_and_boolean_limits():
+    assert validate_repo_config(['exclude']) == ({}, ["expected an object, got list"])
+    valid, problems = validate_repo_config({'size_limits': {'.py': True}, 'skip_minified': 'no'})
+    assert valid == {}
+    assert len(problems) == 2
+
+
+def test_glob_to_regex_anchoring():
+    assert glob_to_regex('*.min.js').match('static/js/app.min.js')
+    assert glob_to_regex('docs/**').match('docs/guide/intro.md')
+    assert not glob_to_regex('docs/**').match('src/docs/intro.md')
+    assert glob_to_regex('build', base_dir='web').match('web/build/out.js')
+    assert not glob_to_regex('build', base_dir='web').match('build/out.js')
+
+
+def test_skip_reason_built_in_rules():
+    file_filter = FileFilter()
+    assert file_filter.skip_reason('node_modules/left-pad/index.js') == 'vendored'
+    assert file_filter.skip_reason('dist/bundle.js') == 'generated'
+    assert file_filter.skip_reason('src/app.py', size=10 ** 9) == 'too_large'
+    assert file_filter.skip_reason('src/app.py', size=1000) is None
+
+
+def test_config_include_overrides_path_rules_but_not_size_limits():
+    file_filter = FileFilter(config={'include': ['vendor/ours/**'], 'exclude': ['docs/**'], 'size_limits': {'.json': 10}})
+    assert file_filter.skip_reason('vendor/ours/lib.py') is None
+    assert file_filter.skip_reason('vendor/theirs/lib.py') == 'vendored'
+    assert file_filter.skip_reason('docs/index.py') == 'excluded'
+    assert file_filter.skip_reason('data/config.json', size=11) == 'too_large'
+
+
+def test_gitattributes_can_mark_and_unmark_paths():
+    rules = parse_gitattributes("# linguist overrides\ngen/** linguist-generated\nvendor/** -linguist-vendored\n")
+    file_filter = FileFilter(rules)
+    assert file_filter.skip_reason('gen/models.py') == 'generated'
+    assert file_filter.skip_reason('vendor/patched.py') is None
+
+
+def test_content_skip_reason():
+    file_filter = FileFilter()
+    assert file_filter.content_skip_reason('var a=1;' * 5000) == 'minified'
+    assert file_filter.content_skip_reason('// Code generated by protoc-gen-go. DO NOT EDIT.\npackage pb\n') == 'generated'
+    assert file_filter.content_skip_reason('def main():\n    return 0\n') is None
+    assert FileFilter(config={'skip_minified': False}).content_skip_reason('var a=1;' * 5000) is None
+
+
+def test_apply_marks_skipped_files_and_counts_reasons():
+    structure = [{'name': 'src', 'path': 'src', 'type': 'dir', 'children': tree('src/app.py', 'src/vendor/lib.py')}]
+    structure += tree('node_modules/pkg/index.js', 'dist/out.js')
+    skipped = FileFilter().apply(structure)
+    assert skipped == {'vendored': 2, 'generated': 1}
+    app_file, vendored_file = structure[0]['children']
+    assert app_file['processable'] and 'skipped' not in app_file
+    assert 'processable' not in vendored_file and vendored_file['skipped'] == 'vendored'
@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from app import JOB_STALE_SECONDS, Job, JobManager
+
+
+@pytest.fixture
+def manager(fake_db, monkeypatch):
+    manager = JobManager(workers=1)
+    # Jobs are registered but never actually run
+    monkeypatch.setattr(manager, 'run', lambda job: None)
+    return manager
+
+
+def remote_job(manager, job_id, key='octo/repo', status='running', heartbeat_age=0):
+    """A job document as written by another server process"""
+    manager.job_ref(job_id).set({
+        'job_id': job_id, 'key': key, 'status': status, 'uids': ['owner'], 'repo_ids': {'owner': 'repo-owner'},
+        'repo_id': 'repo-owner', 'queryable': False, 'heartbeat_at': time.time() - heartbeat_age,
+    })
+
+
+def test_status_reports_a_stale_remote_job_as_failed(manager):
+    remote_job(manager, 'lost', heartbeat_age=JOB_STALE_SECONDS + 1)
+    job_data = manager.status('lost')
+    assert job_data['status'] == 'failed'
+    assert 'interrupted' in job_data['error']
+    assert manager.job_ref('lost').get().to_dict()['status'] == 'failed'
+
+
+def test_status_keeps_a_remote_job_with_a_fresh_heartbeat(manager):
+    remote_job(manager, 'alive', heartbeat_age=JOB_STALE_SECONDS - 60)
+    assert manager.status('alive')['status'] == 'running'
+    assert manager.status('missing') is None
+
+
+def test_status_never_fails_a_job_this_process_owns(manager):
+    remote_job(manager, 'local', heartbeat_age=JOB_STALE_SECONDS + 1)
+    manager.jobs['local'] = Job('local', 'octo/repo', {})
+    assert manager.status('local')['status'] == 'running'
+
+
+def test_submit_joins_a_fresh_remote_job_but_not_a_stale_one(manager):
+    remote_job(manager, 'stale', heartbeat_age=JOB_STALE_SECONDS + 1)
+    job_id, joined = manager.submit('octo', 'repo', 'repo-u1', 'https://github.com/octo/repo', 'u1')
+    assert not joined and job_id != 'stale'
+
+    remote_job(manager, 'fresh', key='octo/other')
+    job_id, joined = manager.submit('octo', 'other', 'repo-u2', 'https://github.com/octo/other', 'u2')
+    assert (job_id, joined) == ('fresh', True)
+    job_data = manager.job_ref('fresh').get().to_dict()
+    assert job_data['uids'] == ['owner', 'u2']
+    assert job_data['repo_ids']['u2'] == 'repo-u2'
+
+
+def test_heartbeat_refreshes_only_active_local_jobs(manager):
+    for job_id, status in (('queued', 'queued'), ('running', 'running'), ('done', 'done')):
+        remote_job(manager, job_id, key=job_id, status=status, heartbeat_age=JOB_STALE_SECONDS - 1)
+        job = Job(job_id, job_id, {})
+        job.status = status
+        manager.jobs[job_id] = job
+    remote_job(manager, 'remote', key='remote', heartbeat_age=JOB_STALE_SECONDS - 1)
+
+    before = time.time()
+    manager.heartbeat()
+    heartbeats = {job_id: manager.job_ref(job_id).get().to_dict()['heartbeat_at'] for job_id in ('queued', 'running', 'done', 'remote')}
+    assert heartbeats['queued'] >= before and heartbeats['running'] >= before
+    assert heartbeats['done'] < before and heartbeats['remote'] < before
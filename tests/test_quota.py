@@ -0,0 +1,60 @@
+import pytest
+
+from app import MAX_MESSAGES_PER_DAY, MAX_REPOS_PER_DAY, BatchWriter, QuotaManager, usage_ref
+
+
+@pytest.fixture
+def quota(fake_db):
+    # A long sync interval keeps the background thread out of the way; tests call sync() themselves
+    return QuotaManager(sync_seconds=3600)
+
+
+def stored_usage(quota, uid):
+    return usage_ref(uid, quota.today()).get().to_dict() or {}
+
+
+def test_limit_is_enforced_locally_after_the_first_transaction(quota):
+    assert all(quota.try_consume('u1', 'repo') for _ in range(MAX_REPOS_PER_DAY))
+    assert not quota.try_consume('u1', 'repo')
+    assert quota.usage('u1') == {'repos_processed': MAX_REPOS_PER_DAY, 'messages_sent': 0}
+    # Only the first use went through a transaction; the rest is written back by sync()
+    assert stored_usage(quota, 'u1')['repos_processed'] == 1
+    quota.sync()
+    assert stored_usage(quota, 'u1')['repos_processed'] == MAX_REPOS_PER_DAY
+
+
+def test_refund_gives_a_use_back(quota):
+    assert quota.try_consume('u1', 'message')
+    assert quota.try_consume('u1', 'message')
+    quota.refund('u1', 'message')
+    quota.sync()
+    assert quota.usage('u1')['messages_sent'] == 1
+    assert stored_usage(quota, 'u1')['messages_sent'] == 1
+
+
+def test_failed_sync_keeps_increments_pending_until_the_next_sync(quota, monkeypatch):
+    for _ in range(3):
+        assert quota.try_consume('u1', 'message')
+
+    def unavailable(self):
+        raise RuntimeError("Firestore unavailable")
+    monkeypatch.setattr(BatchWriter, 'commit', unavailable)
+    quota.sync()
+    counter = quota.counters[('u1', quota.today())]
+    assert counter['pending']['message'] == 2
+    assert quota.usage('u1')['messages_sent'] == 3
+    assert stored_usage(quota, 'u1')['messages_sent'] == 1
+
+    monkeypatch.undo()
+    quota.sync()
+    assert counter['pending']['message'] == 0
+    assert stored_usage(quota, 'u1')['messages_sent'] == 3
+    assert quota.usage('u1')['messages_sent'] == 3
+
+
+def test_sync_picks_up_usage_from_other_processes(quota):
+    assert quota.try_consume('u1', 'message')
+    usage_ref('u1', quota.today()).set({'messages_sent': MAX_MESSAGES_PER_DAY}, merge=True)
+    quota.sync()
+    assert quota.usage('u1')['messages_sent'] == MAX_MESSAGES_PER_DAY
+    assert not quota.try_consume('u1', 'message')
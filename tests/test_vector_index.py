@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from app import VectorIndex, fuse_rankings, load_vector_index, save_repository, vector_index_dir
+
+FILES = {
+    'src/auth/token_cache.py': {'metadata': {'functions': ['verify_token']}, 'summary': 'Caches verified ID tokens',
+                                'content': 'def verify_token(token):\n    return token_cache.get(token)\n'},
+    'src/quota.py': {'metadata': {'classes': ['QuotaManager']}, 'summary': 'Daily usage limits per user',
+                     'content': 'class QuotaManager:\n    def try_consume(self, uid):\n        return usage_limit\n'},
+    'src/render.py': {'metadata': {'functions': ['render_template']}, 'summary': 'Renders HTML templates',
+                      'content': 'def render_template(name):\n    return html_page(name)\n'},
+}
+
+
+@pytest.fixture(params=['hashing', 'tfidf-svd'])
+def embedder_name(request):
+    return request.param
+
+
+def test_search_finds_the_matching_file(embedder_name):
+    index = VectorIndex.build(FILES, embedder_name)
+    assert index.matrix.dtype == np.float32
+    assert len(index.rows) == index.matrix.shape[0]
+    results = index.search('verify token cache', top_k=2)
+    assert results[0][0] == 'src/auth/token_cache.py'
+    assert len({file_path for file_path, _, _ in results}) == len(results)
+
+
+def test_remove_and_add_files(embedder_name):
+    index = VectorIndex.build(FILES, embedder_name)
+    index.remove_files({'src/quota.py'})
+    assert all(row[0] != 'src/quota.py' for row in index.rows)
+    assert index.matrix.shape[0] == len(index.rows)
+    index.add_files({'src/limits.py': FILES['src/quota.py']})
+    assert index.search('QuotaManager usage limits', top_k=1)[0][0] == 'src/limits.py'
+
+
+def test_save_and_load_are_tied_to_the_processing_run(tmp_path, embedder_name):
+    index = VectorIndex.build(FILES, embedder_name)
+    index.save(str(tmp_path), 'run-1')
+    loaded = VectorIndex.load(str(tmp_path), 'run-1')
+    assert loaded.rows == index.rows
+    assert np.allclose(loaded.matrix, index.matrix)
+    assert loaded.search('render html template') == index.search('render html template')
+    assert VectorIndex.load(str(tmp_path), 'run-2') is None
+    assert VectorIndex.load(str(tmp_path / 'missing'), 'run-1') is None
+
+
+def test_to_dict_round_trip(embedder_name):
+    index = VectorIndex.build(FILES, embedder_name)
+    restored = VectorIndex.from_dict(index.to_dict('run-1'), 'run-1')
+    assert restored.rows == index.rows
+    assert np.array_equal(restored.matrix, index.matrix)
+    assert restored.search('daily usage quota') == index.search('daily usage quota')
+    assert VectorIndex.from_dict(index.to_dict('run-1'), 'run-2') is None
+
+
+def test_another_host_loads_the_stored_index_instead_of_rebuilding(app, fake_db, tmp_path, monkeypatch):
+    index = VectorIndex.build(FILES, 'tfidf-svd')
+    header = {'repo_id': 'repo-1', 'processed_at': 'run-1'}
+    save_repository('repo-1', header, {}, blobs={'vectors': index.to_dict('run-1')})
+    monkeypatch.setattr(app, 'VECTOR_INDEX_DIR', str(tmp_path))
+    monkeypatch.setattr(VectorIndex, 'build', classmethod(lambda cls, *args, **kwargs: pytest.fail("index was rebuilt")))
+
+    loaded = load_vector_index('repo-1', app.load_repository_header('repo-1'), FILES)
+    assert np.array_equal(loaded.matrix, index.matrix)
+    # The stored copy is kept locally for the next load
+    assert VectorIndex.load(vector_index_dir('repo-1'), 'run-1') is not None
+
+
+def test_fuse_rankings_rewards_agreement():
+    fused = fuse_rankings(['a', 'b', 'c'], ['b', 'c', 'd'])
+    assert fused[0] == 'b'
+    assert set(fused) == {'a', 'b', 'c', 'd'}
+    assert fused.index('c') < fused.index('d')
+
+
+def test_fuse_rankings_with_one_or_no_rankings():
+    assert fuse_rankings(['x', 'y', 'z']) == ['x', 'y', 'z']
+    assert fuse_rankings([], []) == []